@@ -34,12 +34,11 @@ Contributors:
 """
 
 import json
-import psutil
-import requests
 import os
 import signal
 import sys
 import threading
+import time
 import urllib
 
 import os.path
@@ -47,17 +46,23 @@ sys.path.append(
 	os.path.abspath(os.path.join(__file__,  "..", "..", "..")))
 
 from bson import json_util, ObjectId
-from flask import Flask, request, Response
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, g, request, Response
 from threading import Thread
 
-from modules.mongodb import mongodb
-from modules.mqtt import mqtt
-
 from components.hiascdi.modules.helpers import helpers
+from components.hiascdi.modules.accounting import accounting
+from components.hiascdi.modules.admission import admission
 from components.hiascdi.modules.broker import broker
+from components.hiascdi.modules.compression import compression
 from components.hiascdi.modules.entities import entities
+from components.hiascdi.modules.registrations import registrations
+from components.hiascdi.modules.slowlog import slowlog
+from components.hiascdi.modules.stats import stats
 from components.hiascdi.modules.types import types
 from components.hiascdi.modules.subscriptions import subscriptions
+from components.hiascdi.modules.tenants import tenants
+from components.hiascdi.modules.tracing import tracing
 
 class HIASCDI():
 	""" HIASCDI NGSIV2 Context Broker.
@@ -78,23 +83,47 @@ class HIASCDI():
 
 		self.err406 = self.confs["errorMessages"]["406"]
 
+		self.admission = admission(self.helpers)
+		self.slowlog = slowlog(self.helpers)
+		self.accounting = accounting(self.helpers)
+		self.tracing = tracing(self.helpers)
+		self.compression = compression(self.helpers)
+		self.stats = stats(self.helpers)
+
+		# Startup progress reported by the health endpoint
+		self.ready = threading.Event()
+		self.components = {"mqtt": "starting", "mongodb": "starting", "broker": "starting"}
+		self.failure = None
+		self.startup = None
+
 		self.helpers.logger.info(
 			self.component + " " + self.version + " initialization complete.")
 
 	def mongoDbConnection(self):
 		""" Initiates the mongodb connection class. """
 
+		# Imported on connection so the driver loads off the import path
+		from modules.mongodb import mongodb
+
 		self.mongodb = mongodb(self.helpers, True)
 		self.mongodb.start()
 
+		# Routes each Fiware-Service to its own database
+		self.tenants = tenants(self.helpers, self.mongodb)
+		self.slowlog.attach(self.tenants)
+		self.components["mongodb"] = "ready"
+
 	def hiascdiConnection(self):
 		""" Configures the Context Broker. """
 
-		self.broker = broker(self.helpers, self.mongodb)
+		self.broker = broker(self.helpers, self.tenants, self.tracing, self.mqtt)
 
 	def iotConnection(self):
 		""" Initiates the iotJumpWay connection. """
 
+		# Imported on connection so the client loads off the import path
+		from modules.mqtt import mqtt
+
 		self.mqtt = mqtt(self.helpers, "HIASCDI", {
 			"host": self.helpers.credentials["iotJumpWay"]["host"],
 			"port": self.helpers.credentials["iotJumpWay"]["mqtt"]["port"],
@@ -107,47 +136,122 @@ class HIASCDI():
 		})
 		self.mqtt.configure()
 		self.mqtt.start()
+		self.components["mqtt"] = "ready"
+
+	def start(self):
+		""" Starts the broker subsystems.
+
+		The iotJumpWay and MongoDB connections are set up concurrently,
+		the broker modules are configured once both are up. Requests
+		are answered with 503 until the broker is ready.
+		"""
+
+		started = time.monotonic()
+
+		try:
+			with ThreadPoolExecutor(max_workers=2) as pool:
+				connections = [pool.submit(self.iotConnection), pool.submit(self.mongoDbConnection)]
+				for connection in connections:
+					connection.result()
+
+			self.hiascdiConnection()
+			self.configureEntities()
+			self.configureTypes()
+			self.configureSubscriptions()
+			self.configureRegistrations()
+			self.components["broker"] = "ready"
+
+			self.stats.start()
+			Thread(target=self.life, args=(), daemon=True).start()
+		except Exception as e:
+			self.failure = str(e)
+			for component, state in self.components.items():
+				if state == "starting":
+					self.components[component] = "failed"
+			self.helpers.logger.error(self.component + " startup failed: " + str(e))
+			return
+
+		self.startup = round(time.monotonic() - started, 3)
+		self.ready.set()
+
+		self.helpers.logger.info(self.component + " ready in " + str(self.startup) + "s.")
+
+	def health(self):
+		""" Gets the readiness of the broker subsystems. """
+
+		if self.ready.is_set():
+			status = "ready"
+		elif self.failure is not None:
+			status = "failed"
+		else:
+			status = "starting"
+
+		return {
+			"status": status,
+			"components": dict(self.components),
+			"startup": self.startup,
+			"error": self.failure
+		}
 
 	def configureEntities(self):
 		""" Configures the HIASCDI entities. """
 
-		self.entities = entities(self.helpers, self.mongodb, self.broker)
+		self.entities = entities(self.helpers, self.tenants, self.broker)
 
 	def configureTypes(self):
 		""" Configures the HIASCDI entity types. """
 
-		self.types = types(self.helpers, self.mongodb, self.broker)
+		self.types = types(self.helpers, self.tenants, self.broker)
 
 	def configureSubscriptions(self):
 		""" Configures the HIASCDI subscriptions. """
 
-		self.subscriptions = subscriptions(self.helpers, self.mongodb, self.broker)
+		self.subscriptions = subscriptions(self.helpers, self.tenants, self.broker)
+
+	def configureRegistrations(self):
+		""" Configures the HIASCDI registrations. """
+
+		self.registrations = registrations(self.helpers, self.tenants, self.broker)
 
 	def getBroker(self):
 
+		snapshot = self.stats.snapshot()
+
 		return {
 			"entities_url": self.confs["endpoints"]["entities_url"],
 			"types_url": self.confs["endpoints"]["types_url"],
 			"subscriptions_url": self.confs["endpoints"]["subscriptions_url"],
 			"registrations_url": self.confs["endpoints"]["registrations_url"],
-			"CPU": psutil.cpu_percent(),
-			"Memory": psutil.virtual_memory()[2],
-			"Diskspace": psutil.disk_usage('/').percent,
-			"Temperature": psutil.sensors_temperatures()['coretemp'][0].current
+			"CPU": snapshot.get("CPU"),
+			"Memory": snapshot.get("Memory"),
+			"Diskspace": snapshot.get("Diskspace"),
+			"Temperature": snapshot.get("Temperature")
 		}
 
 	def processHeaders(self, request):
 		""" Processes the request headers """
 
-		accepted = self.broker.checkAcceptsType(request.headers)
-		content_type = self.broker.checkContentType(request.headers)
+		with self.tracing.span("processHeaders"):
+			accepted = self.broker.checkAcceptsType(request.headers)
+			content_type = self.broker.checkContentType(request.headers)
 
 		return accepted, content_type
 
+	def federate(self, request):
+		""" Checks if the request is fanned out to the federation peers """
+
+		return self.broker.federation.fanout(request.headers)
+
+	def conditions(self, request):
+		""" Gets the conditional request headers """
+
+		return self.broker.getConditions(request.headers)
+
 	def checkBody(self, body, text=False):
 		""" Checks the request body """
 
-		return self.broker.checkBody(body, text)
+		with self.tracing.span("checkBody"):
+			return self.broker.checkBody(body, text)
 
 	def respond(self, responseCode, response, accepted):
 		""" Builds the request response """
@@ -165,27 +269,82 @@ class HIASCDI():
 		response.headers = headers
 		return response
 
+	def admit(self, request):
+		""" Applies admission control to the request """
+
+		rejected = self.admission.admit(request)
+		if rejected is None:
+			return None
+
+		responseCode, retry = rejected
+		response = self.respond(responseCode, json.dumps(
+			self.confs["errorMessages"][str(responseCode)], indent=4), "application/json")
+		response.headers["Retry-After"] = str(retry)
+
+		return response
+
+	def tenant(self, request):
+		""" Scopes the request to its Fiware-Service and Fiware-ServicePath """
+
+		# Subscriptions and registrations are scoped like queries
+		query = request.method == "GET" or request.path.startswith("/subscriptions") \
+			or request.path.startswith("/registrations")
+
+		resolved = self.tenants.resolve(request.headers, query)
+		if resolved is None:
+			return self.respond(400, json.dumps(
+				self.confs["errorMessages"]["400s"], indent=4), "application/json")
+
+		self.tenants.enter(*resolved)
+
+		return None
+
+	def trace(self, request):
+		""" Starts the trace span of the request """
+
+		rule = request.url_rule.rule if request.url_rule is not None else request.path
+
+		self.tracing.begin(request.headers, request.method + " " + rule, {
+			"http.method": request.method,
+			"http.target": request.full_path.rstrip("?"),
+			"tenant": request.headers.get("Fiware-Service", "")
+		})
+
+	def account(self, response, request):
+		""" Closes the MongoDB ledger of the request, adding it to the
+		response when the client asks for it """
+
+		rule = request.url_rule.rule if request.url_rule is not None else request.path
+		current = self.accounting.end(rule, request.method)
+
+		if current is not None and self.accounting.debug(request.headers):
+			response.headers[self.confs["accounting"]["header"]] = self.accounting.header(current)
+
+		return response
+
+	def compress(self, response, request):
+		""" Compresses the request response """
+
+		return self.compression.compress(response, request.headers.get("Accept-Encoding"))
+
 	def life(self):
 		""" Sends vital statistics to HIAS """
 
-		cpu = psutil.cpu_percent()
-		mem = psutil.virtual_memory()[2]
-		hdd = psutil.disk_usage('/').percent
-		tmp = psutil.sensors_temperatures()['coretemp'][0].current
-		r = requests.get('http://ipinfo.io/json?token=' +
-				self.helpers.credentials["iotJumpWay"]["ipinfo"])
-		data = r.json()
-		location = data["loc"].split(',')
+		snapshot = self.stats.snapshot()
+
+		life = {
+			"CPU": str(snapshot.get("CPU")),
+			"Memory": str(snapshot.get("Memory")),
+			"Diskspace": str(snapshot.get("Diskspace")),
+			"Temperature": str(snapshot.get("Temperature"))
+		}
+
+		if snapshot.get("Latitude") is not None:
+			life["Latitude"] = snapshot["Latitude"]
+			life["Longitude"] = snapshot["Longitude"]
 
 		# Send iotJumpWay notification
-		self.mqtt.publish("Life", {
-			"CPU": str(cpu),
-			"Memory": str(mem),
-			"Diskspace": str(hdd),
-			"Temperature": str(tmp),
-			"Latitude": float(location[0]),
-			"Longitude": float(location[1])
-		})
+		self.mqtt.publish("Life", life)
 
 		self.helpers.logger.info("HIASCDI life statistics published.")
 		threading.Timer(300.0, self.life).start()
@@ -195,8 +354,87 @@ class HIASCDI():
 		sys.exit(1)
 
 
-HIASCDI = HIASCDI()
-app = Flask(HIASCDI.component)
+class lazy():
+	""" HIASCDI Lazy Instance.
+
+	Creates the HIASCDI class on first use rather than on import, so
+	that importing the application does not load the configuration,
+	open the log handlers or register the MongoDB listeners.
+	"""
+
+	def __init__(self, factory):
+		""" Initializes the class. """
+
+		self.factory = factory
+		self.instance = None
+		self.lock = threading.Lock()
+
+	def build(self):
+		""" Gets the HIASCDI class, creating it if needed. """
+
+		if self.instance is None:
+			with self.lock:
+				if self.instance is None:
+					self.instance = self.factory()
+
+		return self.instance
+
+	def __getattr__(self, name):
+		return getattr(self.build(), name)
+
+
+HIASCDI = lazy(HIASCDI)
+app = Flask(__name__)
+
+@app.before_request
+def admit():
+	""" Rejects requests over the client rate limits or when overloaded
+	and scopes admitted requests to their tenant. """
+
+	if request.path == "/health":
+		return None
+
+	HIASCDI.trace(request)
+
+	if not HIASCDI.ready.is_set():
+		return HIASCDI.respond(503, json.dumps(
+			HIASCDI.confs["errorMessages"]["503i"], indent=4), "application/json")
+
+	rejected = HIASCDI.admit(request)
+	if rejected is not None:
+		return rejected
+	g.admitted = True
+
+	HIASCDI.accounting.begin()
+
+	return HIASCDI.tenant(request)
+
+@app.teardown_request
+def release(exception=None):
+	""" Releases the in-flight slot of admitted requests. """
+
+	if g.pop("admitted", False):
+		HIASCDI.admission.release()
+
+@app.after_request
+def traced(response):
+	""" Ends the trace span of the request. """
+
+	HIASCDI.tracing.end({"http.status_code": response.status_code})
+
+	return response
+
+@app.after_request
+def account(response):
+	""" Accounts the MongoDB round trips of the request. """
+
+	return HIASCDI.account(response, request)
+
+@app.after_request
+def compress(response):
+	""" Compresses responses according to the request Accept-Encoding. """
+
+	return HIASCDI.compress(response, request)
 
 @app.route('/', methods=['GET'])
 def about():
@@ -210,6 +448,172 @@ def about():
 
 	return HIASCDI.respond(200, json.dumps(json.loads(json_util.dumps(HIASCDI.getBroker())), indent=4), accepted)
 
+@app.route('/health', methods=['GET'])
+def healthGet():
+	""" Responds to GET requests sent to the /v1/health API endpoint. """
+
+	health = HIASCDI.health()
+
+	return HIASCDI.respond(200 if health["status"] == "ready" else 503,
+						json.dumps(health, indent=4), "application/json")
+
+@app.route('/stats', methods=['GET'])
+def statsGet():
+	""" Responds to GET requests sent to the /v1/stats API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	if request.args.get('last') is None:
+		last = None
+	else:
+		try:
+			last = int(request.args.get('last'))
+		except ValueError:
+			return HIASCDI.respond(400, json.dumps(HIASCDI.confs["errorMessages"]["400p"], indent=4),
+								accepted)
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.stats.history(last), indent=4), accepted)
+
+@app.route('/admission', methods=['GET'])
+def admissionGet():
+	""" Responds to GET requests sent to the /v1/admission API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.admission.getCounters(), indent=4), accepted)
+
+@app.route('/notifications', methods=['GET'])
+def notificationsGet():
+	""" Responds to GET requests sent to the /v1/notifications API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.notifications.getCounters(), indent=4),
+						accepted)
+
+@app.route('/forwarding', methods=['GET'])
+def forwardingGet():
+	""" Responds to GET requests sent to the /v1/forwarding API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.forwarding.getCounters(), indent=4),
+						accepted)
+
+@app.route('/federation', methods=['GET'])
+def federationGet():
+	""" Responds to GET requests sent to the /v1/federation API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.federation.getCounters(), indent=4),
+						accepted)
+
+@app.route('/tracing', methods=['GET'])
+def tracingGet():
+	""" Responds to GET requests sent to the /v1/tracing API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.tracing.getCounters(), indent=4),
+						accepted)
+
+@app.route('/accounting', methods=['GET'])
+def accountingGet():
+	""" Responds to GET requests sent to the /v1/accounting API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.accounting.getCounters(), indent=4),
+						accepted)
+
+@app.route('/slowqueries', methods=['GET'])
+def slowQueriesGet():
+	""" Responds to GET requests sent to the /v1/slowqueries API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	try:
+		limit = int(request.args.get("limit", 50))
+	except ValueError:
+		return HIASCDI.respond(400, json.dumps(HIASCDI.confs["errorMessages"]["400p"], indent=4),
+							accepted)
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.slowlog.getQueries(limit,
+							request.args.get("collection")), indent=4, default=str), accepted)
+
+@app.route('/results', methods=['GET'])
+def resultsGet():
+	""" Responds to GET requests sent to the /v1/results API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.results.getCounters(), indent=4),
+						accepted)
+
+@app.route('/invalidation', methods=['GET'])
+def invalidationGet():
+	""" Responds to GET requests sent to the /v1/invalidation API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.invalidation.getCounters(), indent=4),
+						accepted)
+
+@app.route('/tenants', methods=['GET'])
+def tenantsGet():
+	""" Responds to GET requests sent to the /v1/tenants API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.tenants.getCounters(
+		HIASCDI.broker.storage.total), indent=4),
+						accepted)
+
 @app.route('/entities', methods=['POST'])
 def entitiesPost():
 	""" Responds to POST requests sent to the /v1/entities API endpoint. """
@@ -235,7 +639,57 @@ def entitiesGet():
 	if content_type is False:
 		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
 
-	return HIASCDI.entities.getEntities(request.args, accepted)
+	return HIASCDI.entities.getEntities(request.args, accepted,
+									HIASCDI.conditions(request), HIASCDI.federate(request))
+
+@app.route('/op/import', methods=['POST'])
+def entitiesImport():
+	""" Responds to POST requests sent to the /v1/op/import API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type != "application/x-ndjson":
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.entities.importEntities(request.stream, accepted)
+
+@app.route('/op/export', methods=['GET'])
+def entitiesExport():
+	""" Responds to GET requests sent to the /v1/op/export API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.entities.exportEntities(request.args, accepted)
+
+@app.route('/op/stream', methods=['GET'])
+def entitiesStream():
+	""" Responds to GET requests sent to the /v1/op/stream API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.entities.streamEntities(request.args, accepted)
+
+@app.route('/streams', methods=['GET'])
+def streamsGet():
+	""" Responds to GET requests sent to the /v1/streams API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.respond(200, json.dumps(HIASCDI.broker.streams.getCounters(), indent=4),
+						accepted)
 
 @app.route('/entities/<_id>', methods=['GET'])
 def entityGet(_id):
@@ -270,7 +724,8 @@ def entityGet(_id):
 	else:
 		metadata = request.args.get('metadata')
 
-	return HIASCDI.entities.getEntity(typeof, _id, attrs, options, metadata, False, accepted)
+	return HIASCDI.entities.getEntity(typeof, _id, attrs, options, metadata, False, accepted,
+								HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs', methods=['GET'])
 def entityAttrsGet(_id):
@@ -305,7 +760,8 @@ def entityAttrsGet(_id):
 	else:
 		metadata = request.args.get('metadata')
 
-	return HIASCDI.entities.getEntity(typeof, _id, attrs, options, metadata, True, accepted)
+	return HIASCDI.entities.getEntity(typeof, _id, attrs, options, metadata, True, accepted,
+								HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs', methods=['POST'])
 def entityPost(_id):
@@ -334,7 +790,8 @@ def entityPost(_id):
 	else:
 		options = request.args.get('options')
 
-	return HIASCDI.entities.updateEntityPost(_id, typeof, query, options, accepted)
+	return HIASCDI.entities.updateEntityPost(_id, typeof, query, options, accepted,
+										HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs', methods=['PATCH'])
 def entityPatch(_id):
@@ -367,7 +824,8 @@ def entityPatch(_id):
 	if request.args.get('type') is None:
 		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400b"], accepted)
 
-	return HIASCDI.entities.updateEntityPatch(_id, typeof, query, options, accepted)
+	return HIASCDI.entities.updateEntityPatch(_id, typeof, query, options, accepted,
+										HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs', methods=['PUT'])
 def entityPut(_id):
@@ -396,7 +854,8 @@ def entityPut(_id):
 	else:
 		options = request.args.get('options')
 
-	return HIASCDI.entities.updateEntityPut(_id, typeof, query, options, accepted)
+	return HIASCDI.entities.updateEntityPut(_id, typeof, query, options, accepted,
+										HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>', methods=['DELETE'])
 def entityDelete(_id):
@@ -444,7 +903,8 @@ def entityAttrsGetAttr(_id, _attr):
 	else:
 		metadata = request.args.get('metadata')
 
-	return HIASCDI.entities.getEntityAttribute(typeof, _id, _attr, metadata, False, accepted)
+	return HIASCDI.entities.getEntityAttribute(typeof, _id, _attr, metadata, False, accepted,
+										HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs/<_attr>', methods=['PUT'])
 def entityAttrPut(_id, _attr):
@@ -471,7 +931,8 @@ def entityAttrPut(_id, _attr):
 	else:
 		typeof = request.args.get('type')
 
-	return HIASCDI.entities.updateEntityAttrPut(_id, _attr, typeof, query, accepted)
+	return HIASCDI.entities.updateEntityAttrPut(_id, _attr, typeof, query, False, accepted,
+										content_type, HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs/<_attr>', methods=['DELETE'])
 def entityAttrDelete(_id,_attr):
@@ -517,7 +978,8 @@ def entityAttrsGetAttrValue(_id, _attr):
 	else:
 		typeof = request.args.get('type')
 
-	return HIASCDI.entities.getEntityAttribute(typeof, _id, _attr, None, True, accepted)
+	return HIASCDI.entities.getEntityAttribute(typeof, _id, _attr, None, True, accepted,
+										HIASCDI.conditions(request))
 
 @app.route('/entities/<_id>/attrs/<_attr>/value', methods=['PUT'])
 def entityAttrsPutAttrValue(_id, _attr):
@@ -544,7 +1006,8 @@ def entityAttrsPutAttrValue(_id, _attr):
 	else:
 		typeof = request.args.get('type')
 
-	return HIASCDI.entities.updateEntityAttrPut(_id, _attr, typeof, query, True, accepted, content_type)
+	return HIASCDI.entities.updateEntityAttrPut(_id, _attr, typeof, query, True, accepted,
+										content_type, HIASCDI.conditions(request))
 
 @app.route('/types', methods=['GET'])
 def typesGet():
@@ -556,7 +1019,7 @@ def typesGet():
 	if content_type is False:
 		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
 
-	return HIASCDI.types.getTypes(request.args, accepted)
+	return HIASCDI.types.getTypes(request.args, accepted, HIASCDI.federate(request))
 
 @app.route('/types', methods=['POST'])
 def typesPost():
@@ -682,18 +1145,91 @@ def subscriptionDelete(_subscription):
 
 	return HIASCDI.subscriptions.deleteSubscription(_subscription, accepted)
 
+@app.route('/registrations', methods=['GET'])
+def registrationsGet():
+	""" Responds to GET requests sent to the /v1/registrations API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	return HIASCDI.registrations.getRegistrations(request.args, accepted)
+
+@app.route('/registrations', methods=['POST'])
+def registrationsPost():
+	""" Responds to POST requests sent to the /v1/registrations API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	query = HIASCDI.checkBody(request)
+	if query is False:
+		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400p"], accepted)
+
+	return HIASCDI.registrations.createRegistration(query, accepted)
+
+@app.route('/registrations/<_registration>', methods=['GET'])
+def registrationGet(_registration):
+	""" Responds to GET requests sent to the /v1/registrations/<_registration> API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	if _registration is None:
+		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400b"], accepted)
+
+	return HIASCDI.registrations.getRegistration(_registration, accepted)
+
+@app.route('/registrations/<_registration>', methods=['PATCH'])
+def registrationPatch(_registration):
+	""" Responds to PATCH requests sent to the /v1/registrations/<_registration> API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	if _registration is None:
+		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400b"], accepted)
+
+	query = HIASCDI.checkBody(request)
+	if query is False:
+		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400p"], accepted)
+
+	return HIASCDI.registrations.updateRegistration(_registration, query, accepted)
+
+@app.route('/registrations/<_registration>', methods=['DELETE'])
+def registrationDelete(_registration):
+	""" Responds to DELETE requests sent to the /v1/registrations/<_registration> API endpoint. """
+
+	accepted, content_type = HIASCDI.processHeaders(request)
+	if accepted is False:
+		return HIASCDI.respond(406, HIASCDI.confs["errorMessages"][str(406)], "application/json")
+	if content_type is False:
+		return HIASCDI.respond(415, HIASCDI.confs["errorMessages"][str(415)], "application/json")
+
+	if _registration is None:
+		return HIASCDI.respond(400, HIASCDI.helpers.confs["errorMessages"]["400b"], accepted)
+
+	return HIASCDI.registrations.deleteRegistration(_registration, accepted)
+
 def main():
+	HIASCDI.build()
+
 	signal.signal(signal.SIGINT, HIASCDI.signal_handler)
 	signal.signal(signal.SIGTERM, HIASCDI.signal_handler)
 
-	HIASCDI.iotConnection()
-	HIASCDI.mongoDbConnection()
-	HIASCDI.hiascdiConnection()
-	HIASCDI.configureEntities()
-	HIASCDI.configureTypes()
-	HIASCDI.configureSubscriptions()
-
-	Thread(target=HIASCDI.life, args=(), daemon=True).start()
+	# Serves the health endpoint while the subsystems connect
+	Thread(target=HIASCDI.start, args=(), daemon=True).start()
 
 	app.run(host=HIASCDI.helpers.confs["host"],
 			port=HIASCDI.helpers.confs["port"])
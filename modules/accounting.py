@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" HIASCDI Accounting Module.
+
+This module accounts for the MongoDB round trips of each HIASCDI
+request.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import contextvars
+import threading
+
+import bson
+
+from pymongo import monitoring
+
+# The ledger of the request being served
+ledger = contextvars.ContextVar("ledger", default=None)
+
+
+class counter(monitoring.CommandListener):
+	""" HIASCDI MongoDB Accounting Listener.
+
+	Feeds MongoDB command replies to the ledger of the current request.
+	"""
+
+	def __init__(self, accounting):
+		""" Initializes the class. """
+
+		self.accounting = accounting
+
+	def started(self, event):
+		self.accounting.started(event)
+
+	def succeeded(self, event):
+		self.accounting.observe(event, event.reply)
+
+	def failed(self, event):
+		self.accounting.observe(event, None)
+
+
+class entry():
+	""" HIASCDI Request Ledger.
+
+	The MongoDB operations, documents and bytes of one request. Storage
+	queries on several partitions run on pool threads, so the ledger
+	is locked.
+	"""
+
+	def __init__(self):
+		""" Initializes the class. """
+
+		self.ops = 0
+		self.docs = 0
+		self.bytes = 0
+		self.micros = 0
+		self.repeats = {}
+		self.pending = {}
+		self.lock = threading.Lock()
+
+	def add(self, operation, docs, size, micros):
+		""" Adds an operation to the ledger. """
+
+		with self.lock:
+			self.ops += 1
+			self.docs += docs
+			self.bytes += size
+			self.micros += micros
+			self.repeats[operation] = self.repeats.get(operation, 0) + 1
+
+	def repeated(self):
+		""" Gets the operation issued most often and its count. """
+
+		with self.lock:
+			if not self.repeats:
+				return None, 0
+			operation = max(self.repeats, key=self.repeats.get)
+			return operation, self.repeats[operation]
+
+
+class accounting():
+	""" HIASCDI Accounting Module.
+
+	This module accounts for the MongoDB round trips of each HIASCDI
+	request.
+
+	A MongoDB command listener adds every operation to the ledger of
+	the request that issued it, with the documents it returned or
+	changed and the size of its reply. Totals are kept per route, a
+	request over the round trip budget, or repeating the same operation
+	on a collection more often than allowed, is logged as a likely
+	N+1 access pattern. Clients can ask for the ledger of a request in
+	a debug response header.
+	"""
+
+	# Commands that are not issued by request handlers
+	ignored = ["hello", "isMaster", "ismaster", "ping", "endSessions", "killCursors"]
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Accounting Module"
+
+		self.confs = self.helpers.confs["accounting"]
+
+		self.routes = {}
+		self.lock = threading.Lock()
+
+		if self.confs["enabled"]:
+			# Must be registered before the MongoDB client is created
+			monitoring.register(counter(self))
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def begin(self):
+		""" Opens the ledger of the current request. """
+
+		if self.confs["enabled"]:
+			ledger.set(entry())
+
+	def documents(self, name, reply):
+		""" Gets the number of documents an operation returned or changed. """
+
+		if reply is None:
+			return 0
+		if "cursor" in reply:
+			cursor = reply["cursor"]
+			return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+		if "values" in reply:
+			return len(reply["values"])
+
+		return reply.get("n", 0)
+
+	def started(self, event):
+		""" Keeps the collection of an operation of the current request. """
+
+		current = ledger.get()
+		if current is None or event.command_name in self.ignored:
+			return
+
+		collection = event.command.get(event.command_name)
+		if event.command_name == "getMore":
+			collection = event.command.get("collection")
+
+		current.pending[(event.connection_id, event.request_id)] = collection
+
+	def observe(self, event, reply):
+		""" Adds an operation to the ledger of the current request. """
+
+		current = ledger.get()
+		if current is None or event.command_name in self.ignored:
+			return
+
+		collection = current.pending.pop((event.connection_id, event.request_id), None)
+		size = len(bson.encode(reply)) if self.confs["bytes"] and reply is not None else 0
+
+		current.add(event.command_name + " " + str(collection),
+					self.documents(event.command_name, reply), size, event.duration_micros)
+
+	def end(self, route, method):
+		""" Closes the ledger of the current request.
+
+		Adds it to the totals of its route, logs requests over the round
+		trip budget and returns the ledger, or None if accounting is off.
+		"""
+
+		current = ledger.get()
+		if current is None:
+			return None
+		ledger.set(None)
+
+		key = method + " " + route
+		operation, repeats = current.repeated()
+
+		with self.lock:
+			totals = self.routes.setdefault(key, {
+				"requests": 0, "ops": 0, "docs": 0, "bytes": 0,
+				"maxOps": 0, "overBudget": 0, "repeated": 0
+			})
+			totals["requests"] += 1
+			totals["ops"] += current.ops
+			totals["docs"] += current.docs
+			totals["bytes"] += current.bytes
+			totals["maxOps"] = max(totals["maxOps"], current.ops)
+			if current.ops > self.confs["budget"]:
+				totals["overBudget"] += 1
+			if repeats > self.confs["repeats"]:
+				totals["repeated"] += 1
+
+		if current.ops > self.confs["budget"]:
+			self.helpers.logger.warning(self.program + " " + key + " used " + str(current.ops) +
+										" MongoDB round trips, budget " + str(self.confs["budget"]) + ".")
+		if repeats > self.confs["repeats"]:
+			self.helpers.logger.warning(self.program + " " + key + " repeated " + operation +
+										" " + str(repeats) + " times, likely N+1.")
+
+		return current
+
+	def debug(self, headers):
+		""" Checks if a request asks for its ledger in the response. """
+
+		return self.confs["enabled"] and self.confs["debugHeader"] in headers
+
+	def header(self, current):
+		""" Formats a ledger for the debug response header. """
+
+		operation, repeats = current.repeated()
+
+		return "ops=%d; docs=%d; bytes=%d; ms=%.1f; repeated=%d" % (
+			current.ops, current.docs, current.bytes, current.micros / 1000.0, repeats)
+
+	def getCounters(self):
+		""" Gets the totals of each route. """
+
+		with self.lock:
+			routes = {key: dict(totals) for key, totals in self.routes.items()}
+
+		for totals in routes.values():
+			totals["avgOps"] = round(totals["ops"] / totals["requests"], 2)
+
+		return routes
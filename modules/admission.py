@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+""" HIASCDI Admission Module.
+
+This module provides per-client rate limiting and adaptive load
+shedding for HIASCDI requests.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import base64
+import contextvars
+import ipaddress
+import threading
+import time
+
+from pymongo import monitoring
+
+# Whether the current context is serving an admitted request
+serving = contextvars.ContextVar("serving", default=False)
+
+
+class bucket():
+	""" HIASCDI Token Bucket.
+
+	A token bucket refilled at a fixed rate up to a burst size.
+	"""
+
+	def __init__(self, rate, burst):
+		""" Initializes the class. """
+
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+
+	def take(self):
+		""" Takes a token, returns the seconds to wait if none are left. """
+
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+		if self.tokens >= 1:
+			self.tokens -= 1
+			return 0
+
+		return (1 - self.tokens) / self.rate
+
+
+class latency(monitoring.CommandListener):
+	""" HIASCDI MongoDB Latency Listener.
+
+	Feeds MongoDB command durations to the admission module. Only the
+	commands that serve entity, type and subscription requests are
+	timed, catalogue scans, stats and explains would skew the average.
+	Commands run by background threads, such as the change stream
+	getMores that wait for new events, are not timed either.
+	"""
+
+	# Commands that are timed
+	commands = ["find", "aggregate", "count", "distinct", "update", "delete",
+				"findAndModify", "insert"]
+
+	def __init__(self, admission):
+		""" Initializes the class. """
+
+		self.admission = admission
+
+	def started(self, event):
+		pass
+
+	def succeeded(self, event):
+		if event.command_name in self.commands and serving.get():
+			self.admission.observe(event.duration_micros / 1000.0)
+
+	def failed(self, event):
+		if event.command_name in self.commands and serving.get():
+			self.admission.observe(event.duration_micros / 1000.0)
+
+
+class admission():
+	""" HIASCDI Admission Module.
+
+	This module provides per-client rate limiting and adaptive load
+	shedding for HIASCDI requests.
+
+	Each client has separate token buckets for reads and writes. Reads
+	are shed first when too many requests are in flight or MongoDB
+	latency rises, writes keep a reserve of in-flight slots so that
+	device updates are not starved by heavy dashboard queries.
+	"""
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Admission Module"
+
+		self.confs = self.helpers.confs["admission"]
+
+		self.proxies = [ipaddress.ip_network(proxy, strict=False) for proxy in self.confs["proxies"]]
+
+		self.buckets = {}
+		self.inflight = 0
+		self.latency = 0.0
+		self.observed = time.monotonic()
+		self.pruned = time.monotonic()
+		self.lock = threading.Lock()
+
+		self.counters = {
+			"admitted": 0,
+			"limitedReads": 0,
+			"limitedWrites": 0,
+			"shedReads": 0,
+			"shedWrites": 0
+		}
+
+		# Must be registered before the MongoDB client is created
+		monitoring.register(latency(self))
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def trusted(self, address):
+		""" Checks if an address is one of the configured proxies. """
+
+		try:
+			address = ipaddress.ip_address(address.strip())
+		except (AttributeError, ValueError):
+			return False
+
+		return any(address in proxy for proxy in self.proxies)
+
+	def client(self, request):
+		""" Identifies the client of a request.
+
+		Client headers are only believed from the configured proxies:
+		the HIAS server authenticates the user before proxying, so the
+		user it passes on, or the Basic user it verified, identifies the
+		client. Otherwise the nearest untrusted X-Forwarded-For hop is
+		used. Requests from anywhere else are identified by address.
+		"""
+
+		if not self.trusted(request.remote_addr):
+			return request.remote_addr
+
+		user = request.headers.get(self.confs["userHeader"], "").strip()
+		if user:
+			return user
+
+		auth = request.headers.get("Authorization", "")
+		if auth.startswith("Basic "):
+			try:
+				return base64.b64decode(auth[6:]).decode("utf-8").split(":")[0]
+			except (ValueError, UnicodeDecodeError):
+				pass
+
+		forwarded = request.headers.get("X-Forwarded-For", "")
+		for hop in reversed(forwarded.split(",")):
+			if hop.strip() and not self.trusted(hop):
+				return hop.strip()
+
+		return request.remote_addr
+
+	def budget(self, client, kind):
+		""" Gets the rate and burst of a client for reads or writes. """
+
+		confs = self.confs["clients"].get(client, {}).get(kind, self.confs[kind])
+
+		return confs["rate"], confs["burst"]
+
+	def observe(self, duration):
+		""" Records a MongoDB command duration in milliseconds. """
+
+		alpha = self.confs["latencyAlpha"]
+		with self.lock:
+			self.latency = alpha * duration + (1 - alpha) * self.currentLatency(time.monotonic())
+			self.observed = time.monotonic()
+
+	def currentLatency(self, now):
+		""" Gets the recent MongoDB latency, decayed while idle.
+
+		Shed reads do not reach MongoDB, so without decay a latency
+		spike would keep reads shed until the next write.
+		"""
+
+		return self.latency * 0.5 ** ((now - self.observed) / self.confs["latencyHalfLife"])
+
+	def prune(self, now):
+		""" Drops the buckets of clients that have been idle. """
+
+		if now - self.pruned < self.confs["idle"]:
+			return
+
+		self.pruned = now
+		for key in [key for key, b in self.buckets.items()
+						if now - b.updated > self.confs["idle"]]:
+			del self.buckets[key]
+
+	def admit(self, request):
+		""" Decides whether a request is admitted.
+
+		Returns None if the request is admitted, otherwise the status
+		code and the number of seconds the client should wait.
+		"""
+
+		if not self.confs["enabled"]:
+			return None
+
+		kind = "read" if request.method in ["GET", "HEAD"] else "write"
+		client = self.client(request)
+
+		with self.lock:
+			now = time.monotonic()
+
+			limit = self.confs["maxInFlight"]
+			if kind == "write":
+				limit += self.confs["writeReserve"]
+
+			if self.inflight >= limit or (kind == "read" and
+					self.currentLatency(now) > self.confs["maxLatency"]):
+				self.counters["shedReads" if kind == "read" else "shedWrites"] += 1
+				return 503, self.confs["retryAfter"]
+
+			self.prune(now)
+
+			key = (client, kind)
+			if key not in self.buckets:
+				self.buckets[key] = bucket(*self.budget(client, kind))
+
+			wait = self.buckets[key].take()
+			if wait:
+				self.counters["limitedReads" if kind == "read" else "limitedWrites"] += 1
+				return 429, max(1, int(wait + 0.999))
+
+			self.inflight += 1
+			self.counters["admitted"] += 1
+
+		serving.set(True)
+
+		return None
+
+	def release(self):
+		""" Releases the in-flight slot of an admitted request. """
+
+		serving.set(False)
+
+		with self.lock:
+			self.inflight = max(self.inflight - 1, 0)
+
+	def getCounters(self):
+		""" Gets the admission counters. """
+
+		with self.lock:
+			counters = dict(self.counters)
+			counters["inFlight"] = self.inflight
+			counters["clients"] = len(self.buckets)
+			counters["mongoLatency"] = round(self.currentLatency(time.monotonic()), 3)
+
+		return counters
@@ -32,26 +32,41 @@ Contributors:
 """
 
 import json
-import requests
-
-import pandas as pd
 
 from bson import json_util, ObjectId
 from flask import Response
 
+from components.hiascdi.modules.catalogue import catalogue
+from components.hiascdi.modules.counts import counts
+from components.hiascdi.modules.federation import federation
+from components.hiascdi.modules.forwarding import forwarding
+from components.hiascdi.modules.invalidation import invalidation
+from components.hiascdi.modules.notifications import notifications
+from components.hiascdi.modules.results import results
+from components.hiascdi.modules.routing import routing
+from components.hiascdi.modules.schemas import schemas
+from components.hiascdi.modules.storage import storage
+from components.hiascdi.modules.streams import streams
+from components.hiascdi.modules.versions import versions
+
 class broker():
 	""" HIASCDI Context Broker Module.
 
 	This module provides core helper functions for HIASCDI.
 	"""
 
-	def __init__(self, helpers, mongodb):
+	def __init__(self, helpers, mongodb, tracing, mqtt=None):
 		""" Initializes the class. """
 
 		self.helpers = helpers
 		self.program = "HIASCDI Helper Module"
 
 		self.mongodb = mongodb
+		self.tracing = tracing
+		self.mqtt = mqtt
+
+		# The tenants router stands in for the MongoDB connection
+		self.tenants = mongodb
 
 		self.headers = {
 			"content-type": self.helpers.confs["contentType"]
@@ -60,6 +75,19 @@ class broker():
 		self.auth = (self.helpers.credentials["identifier"],
 					self.helpers.credentials["auth"])
 
+		self.routing = routing(self.helpers)
+		self.storage = storage(self.helpers, self.mongodb)
+		self.catalogue = catalogue(self.helpers, self.mongodb, self.storage)
+		self.counts = counts(self.helpers, self.mongodb, self.storage)
+		self.versions = versions(self.helpers)
+		self.results = results(self.helpers)
+		self.schemas = schemas(self.helpers, self.mongodb)
+		self.notifications = notifications(self.helpers, self.mongodb, self.tracing, self.mqtt)
+		self.streams = streams(self.helpers, self.mongodb, self.notifications)
+		self.forwarding = forwarding(self.helpers, self.mongodb)
+		self.federation = federation(self.helpers, self.mongodb, self.auth)
+		self.invalidation = invalidation(self.helpers, self.mongodb, self.mqtt, self)
+
 		self.helpers.logger.info("HIASCDI initialization complete.")
 
 	def checkAcceptsType(self, headers):
@@ -89,6 +117,16 @@ class broker():
 			return False
 		return content_type
 
+	def getConditions(self, headers):
+		""" Gets the conditional request headers. """
+
+		conditions = {}
+		for condition in ["If-Match", "If-None-Match", "If-Modified-Since", "Cache-Control"]:
+			if condition in headers:
+				conditions[condition] = headers[condition]
+
+		return conditions
+
 	def checkBody(self, payload, text=False):
 		""" Checks the request body is valid. """
 
@@ -159,6 +197,12 @@ class broker():
 				override = False, accepted = []):
 		""" Builds the request repsonse """
 
+		with self.tracing.span("respond", code=responseCode):
+			return self.serialize(responseCode, response, headers, override, accepted)
+
+	def serialize(self, responseCode, response, headers, override, accepted):
+		""" Serializes a response in the accepted format. """
+
 		return_as = "json"
 		if override != False:
 			if override == "application/json":
@@ -189,3 +233,39 @@ class broker():
 
 		return response
 
+	def stream(self, responseCode, lines, headers={}):
+		""" Builds a newline delimited JSON response from a generator. """
+
+		response = Response(response=lines, status=responseCode,
+						mimetype="application/x-ndjson")
+		for header in headers:
+			response.headers[header] = headers[header]
+
+		return response
+
+	def events(self, lines):
+		""" Builds a Server-Sent Events response from a generator. """
+
+		response = Response(response=lines, status=200, mimetype="text/event-stream")
+		response.headers["Cache-Control"] = "no-cache"
+		response.headers["X-Accel-Buffering"] = "no"
+
+		return response
+
+	def replay(self, entry):
+		""" Builds a response from the body and headers of a cached one. """
+
+		response = Response(response=entry["body"], status=entry["status"],
+						mimetype=entry["mimetype"])
+		response.headers = dict(entry["headers"])
+
+		return response
+
+	def notModified(self, headers={}):
+		""" Builds a 304 response without serializing a body. """
+
+		response = Response(status=304)
+		for header in headers:
+			response.headers[header] = headers[header]
+
+		return response
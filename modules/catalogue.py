@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+""" HIASCDI Type Catalogue Module.
+
+This module maintains a materialized catalogue of the entity types,
+attributes and attribute types found in the HIASCDI entities.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import itertools
+
+from pymongo import ASCENDING
+
+
+class catalogue():
+	""" HIASCDI Type Catalogue Module.
+
+	This module maintains a materialized catalogue of the entity types,
+	attributes and attribute types found in the HIASCDI entities.
+
+	Each catalogue document holds the number of entities of a type and,
+	for every attribute, the number of entities using each attribute
+	type. The entity write path updates the counters incrementally so
+	that listing types never scans the Entities collection. Types
+	created through the types endpoints are marked as declared, so
+	they are listed before any entity of the type exists.
+	"""
+
+	def __init__(self, helpers, mongodb, storage):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Type Catalogue Module"
+
+		self.mongodb = mongodb
+		self.storage = storage
+
+		self.builtin = ["_id", "id", "type", "servicePath", "dateCreated",
+						"dateModified", "dateExpired"]
+
+		# Types listed by the catalogue
+		self.listed = {"$or": [{"count": {"$gt": 0}}, {"declared": True}]}
+
+		self.mongodb.register(self.indexes)
+
+		# Seeded before the broker is ready, so no write interleaves with the scan
+		if self.collection.estimated_document_count() == 0:
+			self.rebuild()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	@property
+	def collection(self):
+		""" Gets the type catalogue of the current tenant. """
+
+		return self.mongodb.mongoConn.TypeCatalogue
+
+	def indexes(self):
+		""" Creates the type catalogue index. """
+
+		self.collection.create_index([("type", ASCENDING)], unique=True)
+
+	def attributeType(self, value):
+		""" Gets the NGSI type of an attribute value. """
+
+		if isinstance(value, dict) and "type" in value:
+			return value["type"]
+		if isinstance(value, bool):
+			return "Boolean"
+		if isinstance(value, (int, float)):
+			return "Number"
+		if isinstance(value, str):
+			return "Text"
+		if value is None:
+			return "None"
+		return "StructuredValue"
+
+	def attributeTypes(self, entity):
+		""" Maps the attributes of an entity to their NGSI types. """
+
+		return {attr: self.attributeType(entity[attr])
+					for attr in entity if attr not in self.builtin}
+
+	def apply(self, typeof, increments):
+		""" Applies counter increments to a catalogue entry. """
+
+		increments = {k: v for k, v in increments.items() if v != 0}
+		if not increments:
+			return
+
+		self.collection.update_one({"type": typeof},
+			{"$inc": increments}, upsert=True)
+
+	def entityCreated(self, entity):
+		""" Adds a new entity to the catalogue. """
+
+		increments = {"count": 1}
+		for attr, atype in self.attributeTypes(entity).items():
+			increments["attrs." + attr + "." + atype] = 1
+
+		self.apply(entity["type"], increments)
+
+	def entitiesCreated(self, entities):
+		""" Adds a batch of new entities with one update per type. """
+
+		increments = {}
+		for entity in entities:
+			typed = increments.setdefault(entity["type"], {"count": 0})
+			typed["count"] += 1
+			for attr, atype in self.attributeTypes(entity).items():
+				key = "attrs." + attr + "." + atype
+				typed[key] = typed.get(key, 0) + 1
+
+		for typeof, typed in increments.items():
+			self.apply(typeof, typed)
+
+	def entityDeleted(self, entity):
+		""" Removes a deleted entity from the catalogue. """
+
+		increments = {"count": -1}
+		for attr, atype in self.attributeTypes(entity).items():
+			increments["attrs." + attr + "." + atype] = -1
+
+		self.apply(entity["type"], increments)
+
+	def entityUpdated(self, before, after):
+		""" Moves the attribute counters of an updated entity. """
+
+		previous = self.attributeTypes(before)
+		current = self.attributeTypes(after)
+
+		increments = {}
+		for attr in set(previous) | set(current):
+			if previous.get(attr) == current.get(attr):
+				continue
+			if attr in previous:
+				key = "attrs." + attr + "." + previous[attr]
+				increments[key] = increments.get(key, 0) - 1
+			if attr in current:
+				key = "attrs." + attr + "." + current[attr]
+				increments[key] = increments.get(key, 0) + 1
+
+		self.apply(before["type"], increments)
+
+	def declared(self, typeof, attrs=None):
+		""" Marks a type created through the types endpoints, with the
+		attribute types it declares. """
+
+		update = {"declared": True}
+		if isinstance(attrs, dict):
+			update["declaredAttrs"] = {attr: sorted(detail.get("types", []))
+				if isinstance(detail, dict) and isinstance(detail.get("types"), list) else []
+					for attr, detail in attrs.items()}
+
+		self.collection.update_one({"type": typeof}, {"$set": update}, upsert=True)
+
+	def render(self, entry, attrDetail=True):
+		""" Converts a catalogue document to its NGSI representation. """
+
+		attrs = {}
+		for attr, atypes in entry.get("attrs", {}).items():
+			used = sorted([atype for atype, total in atypes.items() if total > 0])
+			if not used:
+				continue
+			attrs[attr] = {"types": used} if attrDetail else {}
+
+		for attr, atypes in entry.get("declaredAttrs", {}).items():
+			used = sorted(set(atypes) | set(attrs.get(attr, {}).get("types", [])))
+			attrs[attr] = {"types": used} if attrDetail else {}
+
+		return {
+			"type": entry["type"],
+			"attrs": attrs,
+			"count": entry.get("count", 0)
+		}
+
+	def getTypes(self, offset=0, limit=0, read=None):
+		""" Lists the catalogue ordered by type, on the read preference
+		if one is given. """
+
+		collection = self.collection if read is None else \
+			self.collection.with_options(read_preference=read)
+
+		entries = collection.find(self.listed, {"_id": False}).sort(
+			"type", ASCENDING).skip(offset).limit(limit)
+
+		return list(entries)
+
+	def getType(self, typeof):
+		""" Gets the catalogue entry of a type. """
+
+		entry = self.collection.find_one({"$and": [{"type": typeof}, self.listed]},
+										{"_id": False})
+
+		return entry
+
+	def rebuild(self):
+		""" Rebuilds the catalogue from the entity collections.
+
+		Only used to seed an empty catalogue, the entity write path
+		keeps it current afterwards. It runs while the broker starts,
+		before requests are served, because the absolute counts it sets
+		would lose increments written during the scan.
+		"""
+
+		self.helpers.logger.info(self.program + " rebuilding type catalogue.")
+
+		entries = {}
+		for entity in itertools.chain(*[collection.find({})
+				for collection in self.storage.collections()]):
+			if "type" not in entity:
+				continue
+			entry = entries.setdefault(entity["type"], {"count": 0, "attrs": {}})
+			entry["count"] += 1
+			for attr, atype in self.attributeTypes(entity).items():
+				atypes = entry["attrs"].setdefault(attr, {})
+				atypes[atype] = atypes.get(atype, 0) + 1
+
+		for typeof, entry in entries.items():
+			self.collection.update_one({"type": typeof},
+				{"$set": {"count": entry["count"], "attrs": entry["attrs"]}}, upsert=True)
+
+		# Types created before the catalogue existed
+		for declared in self.mongodb.mongoConn.Types.find({}, {"_id": False}):
+			if "type" in declared:
+				self.declared(declared["type"], declared.get("attrs"))
+
+		self.helpers.logger.info(self.program + " type catalogue rebuilt, " +
+									str(len(entries)) + " types.")
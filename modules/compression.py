@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+""" HIASCDI Compression Module.
+
+This module provides negotiated gzip and brotli compression for
+HIASCDI responses.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import zlib
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+class compression():
+	""" HIASCDI Compression Module.
+
+	This module provides negotiated gzip and brotli compression for
+	HIASCDI responses.
+
+	Buffered responses are compressed when they exceed the configured
+	threshold, streamed responses are compressed chunk by chunk so that
+	chunked transfers keep working.
+	"""
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Compression Module"
+
+		self.confs = self.helpers.confs["compression"]
+
+		self.encodings = ["gzip"]
+		if brotli is not None:
+			self.encodings.insert(0, "br")
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def negotiate(self, header):
+		""" Selects an encoding from an Accept-Encoding header. """
+
+		if not header:
+			return None
+
+		weights = {}
+		for part in header.split(","):
+			pieces = part.strip().split(";")
+			coding = pieces[0].strip().lower()
+			weight = 1.0
+			for param in pieces[1:]:
+				param = param.strip()
+				if param.startswith("q="):
+					try:
+						weight = float(param[2:])
+					except ValueError:
+						weight = 0.0
+			weights[coding] = weight
+
+		for encoding in self.encodings:
+			weight = weights.get(encoding, weights.get("*", 0.0))
+			if weight > 0:
+				return encoding
+
+		return None
+
+	def compressor(self, encoding):
+		""" Creates a streaming compressor for an encoding.
+
+		Returns a pair of functions, one compressing a chunk and one
+		flushing the remaining output.
+		"""
+
+		if encoding == "br":
+			compressor = brotli.Compressor(quality=self.confs["brotliQuality"])
+			return compressor.process, compressor.finish
+
+		compressor = zlib.compressobj(self.confs["gzipLevel"], zlib.DEFLATED, 31)
+		return compressor.compress, compressor.flush
+
+	def compressible(self, response):
+		""" Checks if a response should be compressed. """
+
+		if not self.confs["enabled"]:
+			return False
+		if response.status_code < 200 or response.status_code in (204, 304):
+			return False
+		if response.direct_passthrough:
+			return False
+		if "Content-Encoding" in response.headers:
+			return False
+
+		mimetype = response.headers.get("Content-Type", response.mimetype) or ""
+		return mimetype.split(";")[0].strip() in self.confs["types"]
+
+	def stream(self, iterable, encoding):
+		""" Compresses a streamed response chunk by chunk. """
+
+		compress, flush = self.compressor(encoding)
+		for chunk in iterable:
+			if isinstance(chunk, str):
+				chunk = chunk.encode("utf-8")
+			data = compress(chunk)
+			if data:
+				yield data
+		yield flush()
+
+	def compress(self, response, header):
+		""" Compresses a response according to Accept-Encoding. """
+
+		if not self.compressible(response):
+			return response
+
+		response.headers["Vary"] = "Accept-Encoding"
+
+		encoding = self.negotiate(header)
+		if encoding is None:
+			return response
+
+		if response.is_streamed:
+			response.response = self.stream(response.response, encoding)
+			if "Content-Length" in response.headers:
+				del response.headers["Content-Length"]
+		else:
+			data = response.get_data()
+			if len(data) < self.confs["threshold"]:
+				return response
+			compress, flush = self.compressor(encoding)
+			response.set_data(compress(data) + flush())
+			response.headers["Content-Length"] = str(len(response.get_data()))
+
+		response.headers["Content-Encoding"] = encoding
+
+		return response
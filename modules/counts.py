@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+""" HIASCDI Counts Module.
+
+This module provides cheap, cached document counts for the
+options=count parameter of the HIASCDI list endpoints.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from bson import json_util
+
+from components.hiascdi.modules.tenants import current
+
+
+class counts():
+	""" HIASCDI Counts Module.
+
+	This module provides cheap, cached document counts for the
+	options=count parameter of the HIASCDI list endpoints.
+
+	Cached counts are kept per tenant.
+	"""
+
+	def __init__(self, helpers, mongodb, storage):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Counts Module"
+
+		self.mongodb = mongodb
+		self.storage = storage
+
+		self.ttl = self.helpers.confs["counts"]["ttl"]
+		self.cacheSize = self.helpers.confs["counts"]["cacheSize"]
+		self.typeRefresh = self.helpers.confs["counts"]["typeRefresh"]
+
+		self.cache = OrderedDict()
+		self.typeCounts = {}
+		self.lock = threading.Lock()
+
+		# Indexes that filtered counts may hint at
+		self.hints = {}
+		self.mongodb.register(self.indexes)
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def indexes(self):
+		""" Creates the indexes that filtered counts may hint at. """
+
+		for name in self.storage.names():
+			for field in self.helpers.confs["counts"]["hints"]:
+				self.hints[field] = self.mongodb.mongoConn[name].create_index(field)
+
+	def normalize(self, collection, query):
+		""" Builds the cache key for a count query. """
+
+		return current() + ":" + collection + ":" + json_util.dumps(query, sort_keys=True)
+
+	def countable(self, query):
+		""" Rewrites a query so that count_documents accepts it.
+
+		count_documents does not support $near, so near queries are
+		counted as $geoWithin/$centerSphere on the same radius.
+		"""
+
+		if "location.value" not in query or "$near" not in query["location.value"]:
+			return query
+
+		near = query["location.value"]["$near"]
+		query = dict(query)
+
+		if "$maxDistance" in near:
+			# Earth radius in meters, $centerSphere expects radians
+			query["location.value"] = {"$geoWithin": {"$centerSphere": [
+				near["$geometry"]["coordinates"], near["$maxDistance"] / 6378100.0]}}
+		else:
+			query["location.value"] = {"$exists": True}
+
+		return query
+
+	def hint(self, query):
+		""" Returns the index hint for a filtered entity count. """
+
+		for field in query:
+			if field in self.hints:
+				return self.hints[field]
+		return None
+
+	def singleType(self, query):
+		""" Returns the type if the query only filters on one type. """
+
+		if len(query) != 1 or "type" not in query:
+			return None
+
+		typeof = query["type"]
+		if isinstance(typeof, str):
+			return typeof
+		if isinstance(typeof, dict) and list(typeof) == ["$in"] and len(typeof["$in"]) == 1:
+			return typeof["$in"][0]
+		return None
+
+	def count(self, collection, query, read=None):
+		""" Counts the documents in a collection that match a query.
+
+		Unfiltered counts use the collection metadata, single type
+		entity counts use the per-type counters and everything else
+		is counted with count_documents, on the read preference if one
+		is given, and cached for a short TTL.
+		"""
+
+		if not query:
+			return self.mongodb.mongoConn[collection].estimated_document_count()
+
+		entities = collection in self.storage.names()
+
+		if entities:
+			typeof = self.singleType(query)
+			if typeof is not None:
+				return self.getTypeCount(typeof)
+
+		key = self.normalize(collection, query)
+		now = time.time()
+
+		with self.lock:
+			if key in self.cache and now - self.cache[key][0] < self.ttl:
+				self.cache.move_to_end(key)
+				return self.cache[key][1]
+
+		query = self.countable(query)
+		kwargs = {}
+		if self.storage.maxTime:
+			kwargs["maxTimeMS"] = self.storage.maxTime
+		if entities:
+			hint = self.hint(query)
+			if hint is not None:
+				kwargs["hint"] = hint
+
+		total = self.mongodb.mongoConn.get_collection(collection, read_preference=read) \
+			.count_documents(query, **kwargs)
+
+		with self.lock:
+			self.cache[key] = (now, total)
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.cacheSize:
+				self.cache.popitem(last=False)
+
+		return total
+
+	def getTypeCount(self, typeof):
+		""" Gets the number of entities of a type in O(1).
+
+		Counters are seeded from the type catalogue the first time a
+		type is requested and periodically resynchronised so that writes
+		made by other workers are eventually reflected.
+		"""
+
+		now = time.time()
+		key = (current(), typeof)
+
+		with self.lock:
+			if key in self.typeCounts and now - self.typeCounts[key][0] < self.typeRefresh:
+				return self.typeCounts[key][1]
+
+		entry = self.mongodb.mongoConn.TypeCatalogue.find_one(
+			{"type": typeof}, {"_id": False, "count": True})
+		total = entry.get("count", 0) if entry is not None else 0
+
+		with self.lock:
+			self.typeCounts[key] = (now, total)
+
+		return total
+
+	def adjustType(self, typeof, amount):
+		""" Adjusts the counter for a type after an entity write. """
+
+		key = (current(), typeof)
+
+		with self.lock:
+			if key in self.typeCounts:
+				seeded, total = self.typeCounts[key]
+				self.typeCounts[key] = (seeded, max(total + amount, 0))
+
+		self.clear(self.storage.name(typeof))
+
+	def entityCreated(self, typeof):
+		""" Records a new entity of a type. """
+
+		self.adjustType(typeof, 1)
+
+	def entityDeleted(self, typeof):
+		""" Records a removed entity of a type. """
+
+		self.adjustType(typeof, -1)
+
+	def clear(self, collection):
+		""" Drops the cached counts of a collection. """
+
+		prefix = current() + ":" + collection + ":"
+		with self.lock:
+			for key in [key for key in self.cache if key.startswith(prefix)]:
+				del self.cache[key]
+
+	def forget(self, typeof):
+		""" Drops the counter and cached counts of a type so that they
+		are reloaded, used for writes made by other workers. """
+
+		with self.lock:
+			self.typeCounts.pop((current(), typeof), None)
+
+		self.clear(self.storage.name(typeof))
+
+	def flush(self):
+		""" Drops every cached count and type counter. """
+
+		with self.lock:
+			self.cache.clear()
+			self.typeCounts.clear()
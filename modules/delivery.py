@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+""" HIASCDI Notification Delivery Module.
+
+This module delivers subscription notifications through a bounded
+queue with retries, per-subscriber concurrency caps and a dead-letter
+store.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import heapq
+import itertools
+import json
+import queue
+import random
+import requests
+import threading
+import time
+
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from requests.adapters import HTTPAdapter
+
+from components.hiascdi.modules.tenants import current
+
+
+class delivery():
+	""" HIASCDI Notification Delivery Module.
+
+	This module delivers subscription notifications through a bounded
+	queue with retries, per-subscriber concurrency caps and a dead-letter
+	store.
+
+	Subscriptions with an mqtt notification target are published over
+	the iotJumpWay MQTT connection instead, batched per topic and
+	subscription for a short window.
+
+	Failed deliveries are retried with exponential backoff and moved to
+	the DeadLetters collection once the retries are exhausted or the
+	queues are full. Delivery state is accumulated in memory and written
+	back to the Subscriptions collection in periodic bulk updates.
+
+	Jobs, batches and delivery state carry the tenant of their
+	subscription so that they are written back to its database.
+	"""
+
+	def __init__(self, helpers, mongodb, tracing, mqtt=None):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Notification Delivery Module"
+
+		self.mongodb = mongodb
+		self.tracing = tracing
+		self.mqtt = mqtt
+
+		self.confs = self.helpers.confs["notifications"]["delivery"]
+
+		self.jobs = queue.Queue(maxsize=self.confs["queue"])
+		self.local = threading.local()
+
+		self.retrying = []
+		self.sequence = itertools.count()
+		self.schedule = threading.Condition()
+
+		self.slots = {}
+		self.slotsLock = threading.Lock()
+
+		self.state = {}
+		self.stateLock = threading.Lock()
+
+		self.batches = {}
+		self.batchLock = threading.Lock()
+
+		self.counters = {
+			"sent": 0,
+			"succeeded": 0,
+			"failed": 0,
+			"retried": 0,
+			"deadLettered": 0,
+			"published": 0
+		}
+		self.countersLock = threading.Lock()
+
+		self.mongodb.register(self.indexes)
+
+		for i in range(self.confs["workers"]):
+			threading.Thread(target=self.work, daemon=True).start()
+		threading.Thread(target=self.scheduler, daemon=True).start()
+		threading.Thread(target=self.flusher, daemon=True).start()
+		threading.Thread(target=self.batcher, daemon=True).start()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def indexes(self):
+		""" Creates the dead letter expiry index. """
+
+		self.mongodb.mongoConn.DeadLetters.create_index([("date", ASCENDING)],
+							expireAfterSeconds=self.confs["deadLetterTTL"])
+
+	def now(self):
+		""" Gets the current time as an NGSI DateTime value. """
+
+		return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+	def target(self, subscription):
+		""" Gets the notification URL and headers of a subscription. """
+
+		notification = subscription.get("notification", {})
+		headers = {"Content-Type": "application/json"}
+
+		if "httpCustom" in notification:
+			headers.update(notification["httpCustom"].get("headers", {}))
+			return notification["httpCustom"].get("url"), headers
+		if "http" in notification:
+			return notification["http"].get("url"), headers
+
+		return None, None
+
+	def allowed(self, target):
+		""" Checks that an MQTT target publishes under an allowed topic prefix.
+
+		Notifications are published with the broker's own iotJumpWay
+		credentials, so subscriptions may only use concrete topics below
+		the configured prefixes and a valid QoS.
+		"""
+
+		if not isinstance(target, dict):
+			return False
+
+		topic = target.get("topic")
+		if not isinstance(topic, str) or not topic or "#" in topic or "+" in topic:
+			return False
+		if not any(topic.startswith(prefix) for prefix in self.confs["mqtt"]["prefixes"]):
+			return False
+
+		qos = target.get("qos", 0)
+
+		return not isinstance(qos, bool) and qos in (0, 1, 2)
+
+	def envelope(self, subscription, data):
+		""" Wraps serialized entities in a notification payload. """
+
+		return b'{"subscriptionId": ' + json.dumps(subscription).encode("utf-8") + \
+				b', "data": [' + b', '.join(data) + b']}'
+
+	def enqueue(self, subscription, data):
+		""" Queues a notification for delivery.
+
+		data is the serialized entity, shared by all the subscriptions
+		using the same rendering format.
+		"""
+
+		notification = subscription.get("notification", {})
+		if "mqtt" in notification:
+			self.batch(subscription, notification["mqtt"], data)
+			return
+
+		url, headers = self.target(subscription)
+		if url is None:
+			return
+
+		job = {
+			"tenant": current(),
+			"subscription": subscription["id"],
+			"url": url,
+			"headers": headers,
+			"payload": self.envelope(subscription["id"], [data]),
+			"attempts": 0,
+			"trace": self.tracing.carry()
+		}
+
+		self.put(job)
+
+	def batch(self, subscription, target, data):
+		""" Adds a notification to the MQTT batch of its topic. """
+
+		key = (current(), target.get("topic"), int(target.get("qos", 0)), subscription["id"])
+
+		with self.batchLock:
+			batch = self.batches.setdefault(key, [])
+			batch.append(data)
+			if len(batch) < self.confs["mqtt"]["batch"]:
+				return
+			del self.batches[key]
+
+		self.publish(key[1:], batch)
+
+	def batcher(self):
+		""" Publishes the MQTT batches at the end of each window. """
+
+		while True:
+			time.sleep(self.confs["mqtt"]["window"])
+
+			with self.batchLock:
+				batches = self.batches
+				self.batches = {}
+
+			for key, batch in batches.items():
+				try:
+					with self.mongodb.using(key[0]):
+						self.publish(key[1:], batch)
+				except Exception as e:
+					self.helpers.logger.error(self.program + " MQTT publish error: " + str(e))
+
+	def publish(self, key, batch):
+		""" Publishes a batch of notifications over MQTT. """
+
+		topic, qos, subscription = key
+		payload = self.envelope(subscription, batch)
+
+		self.record(subscription, {"notification.lastNotification": self.now()}, True)
+
+		if self.mqtt is None or not self.allowed({"topic": topic, "qos": qos}):
+			reason = "MQTT unavailable" if self.mqtt is None else "MQTT topic not allowed"
+			self.record(subscription, {
+				"notification.lastFailure": self.now(),
+				"notification.lastFailureReason": reason
+			})
+			self.deadLetter({"tenant": current(), "subscription": subscription, "url": "mqtt:" + str(topic),
+							"payload": payload, "attempts": 0}, reason)
+			return
+
+		with self.tracing.span("mqtt.publish", topic=topic):
+			info = self.mqtt.mqttClient.publish(topic, payload, qos=qos)
+		self.count("published")
+
+		if info.rc == 0:
+			self.record(subscription, {"notification.lastSuccess": self.now()})
+		else:
+			self.record(subscription, {
+				"notification.lastFailure": self.now(),
+				"notification.lastFailureReason": "MQTT error " + str(info.rc)
+			})
+
+	def put(self, job):
+		""" Puts a job on the delivery queue without blocking. """
+
+		try:
+			self.jobs.put_nowait(job)
+		except queue.Full:
+			self.deadLetter(job, "Delivery queue full")
+
+	def slot(self, url):
+		""" Gets the concurrency slots of a subscriber. """
+
+		with self.slotsLock:
+			if url not in self.slots:
+				self.slots[url] = threading.BoundedSemaphore(self.confs["concurrency"])
+			return self.slots[url]
+
+	def work(self):
+		""" Delivers queued notifications. """
+
+		while True:
+			job = self.jobs.get()
+
+			slot = self.slot(job["url"])
+			if not slot.acquire(blocking=False):
+				# Subscriber is at its concurrency cap
+				self.later(job, self.confs["busyDelay"])
+				continue
+
+			try:
+				with self.mongodb.using(job["tenant"]):
+					self.send(job)
+			except Exception as e:
+				self.helpers.logger.error(self.program + " delivery error: " + str(e))
+			finally:
+				slot.release()
+
+	def session(self):
+		""" Gets the keep-alive HTTP session of the current worker. """
+
+		if not hasattr(self.local, "session"):
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=self.confs["pool"]["hosts"],
+								pool_maxsize=self.confs["pool"]["connections"])
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+			self.local.session = session
+
+		return self.local.session
+
+	def post(self, job):
+		""" Posts a notification, returns success and the reason. """
+
+		try:
+			r = self.session().post(job["url"], data=job["payload"],
+							headers=self.tracing.headers(job["headers"]), timeout=self.confs["timeout"])
+		except requests.RequestException as e:
+			return False, str(e)
+
+		return 200 <= r.status_code < 300, r.status_code
+
+	def send(self, job):
+		""" Sends a notification and records the outcome. """
+
+		self.record(job["subscription"], {"notification.lastNotification": self.now()}, True)
+		self.count("sent")
+
+		with self.tracing.resume(job.get("trace"), "deliver", url=job["url"],
+								attempt=job["attempts"] + 1) as current:
+			succeeded, reason = self.post(job)
+			if current is not None:
+				current.attributes["result"] = str(reason)
+
+		if succeeded:
+			self.count("succeeded")
+			self.record(job["subscription"], {
+				"notification.lastSuccess": self.now(),
+				"notification.lastSuccessCode": reason
+			})
+			return
+
+		self.count("failed")
+		self.record(job["subscription"], {
+			"notification.lastFailure": self.now(),
+			"notification.lastFailureReason": str(reason)
+		})
+
+		job["attempts"] += 1
+		if job["attempts"] > self.confs["retries"]:
+			self.deadLetter(job, str(reason))
+		else:
+			self.count("retried")
+			self.later(job, self.backoff(job["attempts"]))
+
+	def backoff(self, attempts):
+		""" Gets the jittered exponential backoff for a retry. """
+
+		delay = min(self.confs["maxBackoff"], self.confs["backoff"] * 2 ** (attempts - 1))
+
+		return delay * (0.5 + random.random() / 2)
+
+	def later(self, job, delay):
+		""" Schedules a job to be queued again after a delay. """
+
+		with self.schedule:
+			if len(self.retrying) < self.confs["retrying"]:
+				heapq.heappush(self.retrying, (time.monotonic() + delay, next(self.sequence), job))
+				self.schedule.notify()
+				return
+
+		self.deadLetter(job, "Retry queue full")
+
+	def scheduler(self):
+		""" Moves due retries back to the delivery queue. """
+
+		while True:
+			with self.schedule:
+				while not self.retrying:
+					self.schedule.wait()
+				due = self.retrying[0][0] - time.monotonic()
+				if due > 0:
+					self.schedule.wait(due)
+					continue
+				job = heapq.heappop(self.retrying)[2]
+
+			self.put(job)
+
+	def deadLetter(self, job, reason):
+		""" Stores a notification that could not be delivered. """
+
+		self.count("deadLettered")
+
+		try:
+			with self.mongodb.using(job["tenant"]):
+				self.mongodb.mongoConn.DeadLetters.insert_one({
+					"subscriptionId": job["subscription"],
+					"url": job["url"],
+					"payload": job["payload"].decode("utf-8") \
+						if isinstance(job["payload"], bytes) else job["payload"],
+					"attempts": job["attempts"],
+					"reason": reason,
+					"date": datetime.now(timezone.utc)
+				})
+		except Exception as e:
+			self.helpers.logger.error(self.program + " dead letter failed: " + str(e))
+
+		self.helpers.logger.warning(self.program + " notification for subscription " +
+									job["subscription"] + " dead lettered: " + reason)
+
+	def record(self, subscription, fields, sent=False):
+		""" Accumulates delivery state for the next batched write. """
+
+		with self.stateLock:
+			update = self.state.setdefault((current(), subscription), {"$set": {}, "$inc": {}})
+			update["$set"].update(fields)
+			if sent:
+				update["$inc"]["notification.timesSent"] = \
+					update["$inc"].get("notification.timesSent", 0) + 1
+
+	def count(self, counter):
+		""" Increments a delivery counter. """
+
+		with self.countersLock:
+			self.counters[counter] += 1
+
+	def restore(self, state):
+		""" Merges unwritten delivery state back for the next flush.
+
+		State recorded since the flush began is newer, so its fields
+		win, while sent counts are added together.
+		"""
+
+		with self.stateLock:
+			for key, unwritten in state.items():
+				update = self.state.setdefault(key, {"$set": {}, "$inc": {}})
+				fields = dict(unwritten["$set"])
+				fields.update(update["$set"])
+				update["$set"] = fields
+				for field, value in unwritten["$inc"].items():
+					update["$inc"][field] = update["$inc"].get(field, 0) + value
+
+	def flush(self):
+		""" Writes the accumulated delivery state to the Subscriptions.
+
+		State that could not be written is merged back and retried on
+		the next flush.
+		"""
+
+		with self.stateLock:
+			state = self.state
+			self.state = {}
+
+		if not state:
+			return
+
+		tenants = {}
+		for key, update in state.items():
+			tenants.setdefault(key[0], []).append(key)
+
+		failed = None
+		for tenant, keys in tenants.items():
+			updates = [UpdateOne({"id": key[1]}, {operator: fields
+						for operator, fields in state[key].items() if fields}) for key in keys]
+			try:
+				with self.mongodb.using(tenant):
+					self.mongodb.mongoConn.Subscriptions.bulk_write(updates, ordered=False)
+			except BulkWriteError as e:
+				failed = e
+				self.restore({keys[error["index"]]: state[keys[error["index"]]]
+								for error in e.details.get("writeErrors", [])})
+			except Exception as e:
+				failed = e
+				self.restore({key: state[key] for key in keys})
+
+		if failed is not None:
+			raise failed
+
+	def flusher(self):
+		""" Periodically flushes the delivery state. """
+
+		while True:
+			time.sleep(self.confs["flush"])
+			try:
+				self.flush()
+			except Exception as e:
+				self.helpers.logger.error(self.program + " state flush failed: " + str(e))
+
+	def getCounters(self):
+		""" Gets the delivery counters. """
+
+		with self.countersLock:
+			counters = dict(self.counters)
+		counters["queued"] = self.jobs.qsize()
+		counters["retrying"] = len(self.retrying)
+
+		return counters
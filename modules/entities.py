@@ -33,13 +33,11 @@ Contributors:
 """
 
 import json
-import jsonpickle
 import os
 import sys
 
-from mgoquery import Parser
-
-from subscriptions import subscriptions
+from bson import json_util
+from pymongo.errors import BulkWriteError, ExecutionTimeout, PyMongoError
 
 class entities():
 	""" HIASCDI Entities Module.
@@ -59,42 +57,17 @@ class entities():
 
 		self.helpers.logger.info(self.program + " initialization complete.")
 
-	def getEntities(self, arguments, accepted=[]):
-		""" Gets entity data from the MongoDB.
-
-		You can access this endpoint by naviating your browser to https://YourServer/hiascdi/v1/entities
-		If you are not logged in to the HIAS network you will be shown an authentication pop up
-		where you should provide your HIAS network user and password.
-
-		References:
-			FIWARE-NGSI v2 Specification
-			https://fiware.github.io/specifications/ngsiv2/stable/
+	def buildQuery(self, arguments):
+		""" Builds the MongoDB query of a list entities request.
 
-			Reference
-				- Entities
-					- List entities
+		Returns the requested types, query, projection, ordering, offset
+		and limit, or the error code and message key when the request is
+		invalid.
 		"""
 
 		params = []
-		cparams = []
 		sort = []
 		query = {}
-		headers = {}
-
-		keyValues_opt = False
-		count_opt = False
-		values_opt = False
-		unique_opt = False
-
-		# Processes the options parameter
-		options = arguments.get('options') if arguments.get('options') is not None else None
-		if options is not None:
-			options = options.split(",")
-			for option in options:
-				keyValues_opt = True if option == "keyValues" else keyValues_opt
-				values_opt = True if option == "values" else values_opt
-				unique_opt = True if option == "unique" else unique_opt
-				count_opt = True if option == "count" else count_opt
 
 		# Removes the MongoDB ID
 		fields = {
@@ -277,16 +250,13 @@ class entities():
 			if geotype == 'near':
 				# Near geospatial query
 				if geometry != "Point":
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				if georelslen < 2:
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				if coordslen > 1:
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				data = {"location.value": {
 					"$near": {
@@ -305,12 +275,10 @@ class entities():
 			elif geotype == 'intersects':
 				# Intersects geospatial query
 				if geometry != "Polygone":
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				if coordslen > 4:
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				polygone = []
 				for poly in coords:
@@ -327,12 +295,10 @@ class entities():
 			elif geotype == 'coveredBy':
 				# coveredBy geospatial query
 				if geometry != "Polygone":
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				if coordslen > 4:
-					return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-										{}, False, accepted)
+					return None, (400, "400b")
 
 				polygone = []
 				for poly in coords:
@@ -357,12 +323,10 @@ class entities():
 				params.append({"$or": eor})
 			elif geotype == 'disjoint':
 				# Disjoint geospatial query
-				return self.broker.respond(501, self.helpers.confs["errorMessages"][str(501)],
-									{}, False, accepted)
+				return None, (501, "501")
 			else:
 				# Non-supported geospatial query
-				return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-									{}, False, accepted)
+				return None, (400, "400b")
 
 		# TO REMOVE
 		if arguments.get('values') is not None:
@@ -398,33 +362,139 @@ class entities():
 		else:
 			limit = int(arguments.get('limit'))
 
+		return {
+			"types": arguments.get('type').split(",") if arguments.get('type') is not None else None,
+			"query": self.broker.tenants.scoped(query),
+			"fields": self.broker.tenants.project(fields),
+			"sort": sort,
+			"offset": offset,
+			"limit": limit
+		}, None
+
+	def getEntities(self, arguments, accepted=[], conditions=None, federate=False):
+		""" Gets entity data from the MongoDB.
+
+		You can access this endpoint by naviating your browser to https://YourServer/hiascdi/v1/entities
+		If you are not logged in to the HIAS network you will be shown an authentication pop up
+		where you should provide your HIAS network user and password.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Entities
+					- List entities
+		"""
+
+		headers = {}
+
+		keyValues_opt = False
+		count_opt = False
+		values_opt = False
+		unique_opt = False
+
+		# Processes the options parameter
+		options = arguments.get('options') if arguments.get('options') is not None else None
+		if options is not None:
+			options = options.split(",")
+			for option in options:
+				keyValues_opt = True if option == "keyValues" else keyValues_opt
+				values_opt = True if option == "values" else values_opt
+				unique_opt = True if option == "unique" else unique_opt
+				count_opt = True if option == "count" else count_opt
+
+		with self.broker.tracing.span("buildQuery"):
+			built, error = self.buildQuery(arguments)
+		if error is not None:
+			return self.broker.respond(error[0], self.helpers.confs["errorMessages"][error[1]],
+								{}, False, accepted)
+
+		query = built["query"]
+		fields = built["fields"]
+		sort = built["sort"]
+		offset = built["offset"]
+		limit = built["limit"]
+
+		# Keeps dateModified available for the list version
+		fields, strip_modified = self.broker.versions.project(fields)
+
+		selectors, attrs, expression = self.broker.forwarding.request(arguments)
+		plans = self.broker.forwarding.plan(selectors, attrs)
+
+		# Lists without provider or peer entities are served from the results cache
+		key = self.broker.results.key(arguments, accepted) \
+			if not federate and not len(plans) else None
+		if key is not None:
+			generation = self.broker.results.generation(built["types"])
+			cached = self.broker.results.get(key) \
+				if not self.broker.results.revalidate(conditions) else None
+			if cached is not None:
+				if self.broker.versions.notModified(conditions, cached["headers"].get("ETag"),
+													cached["modified"]):
+					return self.broker.notModified(cached["headers"])
+				return self.broker.replay(cached)
+
+		# Federated and forwarded pages are cut after the peers or providers are merged
+		window = (offset or 0) + limit if limit else 0
+		fetch = (0, window) if federate or len(plans) else (offset, limit)
+
 		try:
-			# Creates the full query
-			if len(sort) and offset:
-				entities = self.mongodb.mongoConn.Entities.find(
-					query, fields).skip(offset).sort(sort).limit(limit)
-			elif offset:
-				entities = self.mongodb.mongoConn.Entities.find(
-					query, fields).skip(offset).limit(limit)
-			elif len(sort):
-				entities = self.mongodb.mongoConn.Entities.find(
-					query, fields).sort(sort).limit(limit)
-			else:
-				entities= self.mongodb.mongoConn.Entities.find(query, fields).limit(limit)
+			# Creates the full query, lists are read from the list read preference
+			entities = self.broker.storage.find(built["types"], query, fields,
+									sort, *fetch, read=self.broker.routing.list())
 
 			if count_opt:
 				# Sets count header
-				headers["Count"] = entities.count()
+				headers["Count"] = sum(self.broker.counts.count(name, query,
+											self.broker.routing.list())
+									for name in self.broker.storage.names(built["types"]))
 
 			entities = list(entities)
 
+			# Adds the entities of the registered context providers
+			remote = self.broker.forwarding.query(plans, expression)
+			if len(remote):
+				entities = self.broker.forwarding.merge(entities, remote)
+				if len(sort):
+					entities.sort(key=lambda entity: self.broker.storage.key(entity, sort))
+			if federate:
+				if window:
+					entities = entities[:window]
+			elif len(plans):
+				entities = entities[offset or 0:window or None]
+
+			# Adds the entities of the federation peers
+			peers = []
+			if federate:
+				peers, total, failed = self.broker.federation.query("/entities",
+					self.broker.federation.arguments(arguments, window,
+										["count"] if count_opt else []))
+				headers.update(self.broker.federation.headers(failed))
+				if count_opt:
+					headers["Count"] += total
+				entities = self.broker.federation.merge([entities] + peers,
+					(lambda entity: self.broker.storage.key(entity, sort)) if len(sort) else None,
+					offset, limit)
+
 			if not len(entities):
 				self.helpers.logger.info(
 					self.program + " 404: " + self.helpers.confs["errorMessages"][str(404)]["Description"])
 
 				return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
-									{}, False, accepted)
+									headers if federate else {}, False, accepted)
 			else:
+				# Provider and peer entities are not versioned locally
+				etag, modified = self.broker.versions.listTag(entities) \
+					if not len(remote) and not len(peers) else (None, None)
+				headers.update(self.broker.versions.headers(etag, modified))
+
+				if self.broker.versions.notModified(conditions, etag, modified):
+					return self.broker.notModified(headers)
+
+				if strip_modified:
+					for entity in entities:
+						entity.pop("dateModified", None)
 
 				# Converts data to key -> value
 				if keyValues_opt:
@@ -474,7 +544,17 @@ class entities():
 				self.helpers.logger.info(
 					self.program + " 200: " + self.helpers.confs["successMessage"][str(200)]["Description"])
 
-				return self.broker.respond(200, entities, headers, False, accepted)
+				response = self.broker.respond(200, entities, headers, False, accepted)
+				if key is not None:
+					self.broker.results.put(key, built["types"], generation, response, modified)
+
+				return response
+		except ExecutionTimeout:
+			self.helpers.logger.info(
+				self.program + " 503: " + self.helpers.confs["errorMessages"]["503q"]["Description"])
+
+			return self.broker.respond(503, self.helpers.confs["errorMessages"]["503q"],
+								{}, False, accepted)
 		except Exception as e:
 			self.helpers.logger.info(
 				self.program + " 404: " + self.helpers.confs["errorMessages"][str(404)]["Description"])
@@ -495,18 +575,217 @@ class entities():
 					- Create Entity
 		"""
 
+		remaining = self.broker.tenants.remaining(self.broker.storage.total)
+		if remaining is not None and remaining < 1:
+			return self.broker.respond(403, self.helpers.confs["errorMessages"]["403"],
+								{}, False, accepted)
+
 		if data["type"] not in self.mongodb.collextions:
 			data["type"] = "Thing"
 
-		_id = self.mongodb.mongoConn.Entities.insert(data)
+		error = self.broker.schemas.validate(data["type"], data)
+		if error is not None:
+			return self.invalid(error, accepted)
+
+		data["servicePath"] = self.broker.tenants.path()
+
+		stamp = self.broker.versions.stamp()
+		if "dateCreated" not in data:
+			data["dateCreated"] = stamp
+		data["dateModified"] = stamp
+
+		_id = self.broker.storage.collection(data["type"]).insert(data)
 		if str(_id) is not False:
+			self.created(data, stamp)
 			return self.broker.respond(201, {}, {"Location": "v1/entities/" + data["id"] + "?type=" + data["type"]}, False, accepted)
 		else:
 			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
 								{}, False, accepted)
 
+	def importEntities(self, stream, accepted=[]):
+		""" Imports entities from a newline delimited JSON stream.
+
+		Lines are parsed as they arrive and inserted in unordered
+		batches, so an invalid or rejected line does not stop the
+		import. Responds with the number of inserted entities and
+		the lines that failed.
+		"""
+
+		confs = self.helpers.confs["bulk"]
+		report = {"inserted": 0, "failed": 0, "errors": []}
+		remaining = self.broker.tenants.remaining(self.broker.storage.total)
+
+		batch = []
+		lines = []
+		for line, raw in enumerate(self.readLines(stream, confs["maxLine"]), 1):
+			if raw is None:
+				self.rejected(report, line, "Line too long")
+				continue
+
+			raw = raw.strip()
+			if not raw:
+				continue
+
+			entity, error = self.parseLine(raw)
+			if error is not None:
+				self.rejected(report, line, error)
+				continue
+
+			if remaining is not None:
+				if remaining < 1:
+					self.rejected(report, line, "Tenant entity quota exceeded")
+					continue
+				remaining -= 1
+
+			batch.append(entity)
+			lines.append(line)
+			if len(batch) >= confs["batch"]:
+				self.insertBatch(batch, lines, report)
+				batch = []
+				lines = []
+
+		if len(batch):
+			self.insertBatch(batch, lines, report)
+
+		self.helpers.logger.info(self.program + " imported " + str(report["inserted"]) +
+								" entities, " + str(report["failed"]) + " failed.")
+
+		return self.broker.respond(200, report, {}, False, accepted)
+
+	def readLines(self, stream, limit):
+		""" Yields the lines of a stream, or None for lines over the limit. """
+
+		while True:
+			line = stream.readline(limit + 1)
+			if not line:
+				return
+			if len(line) > limit and not line.endswith(b"\n"):
+				# Skips the rest of the line
+				while True:
+					rest = stream.readline(limit)
+					if not rest or rest.endswith(b"\n"):
+						break
+				yield None
+			else:
+				yield line
+
+	def parseLine(self, raw):
+		""" Parses and validates one imported entity. """
+
+		try:
+			entity = json.loads(raw)
+		except ValueError:
+			return None, "Invalid JSON"
+
+		if not isinstance(entity, dict):
+			return None, "Entity must be a JSON object"
+		if not isinstance(entity.get("id"), str) or not entity["id"]:
+			return None, "Entity id missing"
+		if not isinstance(entity.get("type"), str) or not entity["type"]:
+			return None, "Entity type missing"
+
+		entity.pop("_id", None)
+		if entity["type"] not in self.mongodb.collextions:
+			entity["type"] = "Thing"
+
+		error = self.broker.schemas.validate(entity["type"], entity)
+		if error is not None:
+			return None, error
+
+		return entity, None
+
+	def insertBatch(self, batch, lines, report):
+		""" Inserts a batch of imported entities. """
+
+		stamp = self.broker.versions.stamp()
+		path = self.broker.tenants.path()
+		for entity in batch:
+			entity["servicePath"] = path
+			if "dateCreated" not in entity:
+				entity["dateCreated"] = stamp
+			entity["dateModified"] = stamp
+
+		# Groups the batch by the partition of each entity type
+		partitions = {}
+		for i, entity in enumerate(batch):
+			partitions.setdefault(self.broker.storage.name(entity["type"]), []).append(i)
+
+		failed = {}
+		for positions in partitions.values():
+			collection = self.broker.storage.collection(batch[positions[0]]["type"])
+			try:
+				collection.insert_many([batch[i] for i in positions], ordered=False)
+			except BulkWriteError as e:
+				for error in e.details.get("writeErrors", []):
+					failed[positions[error["index"]]] = error.get("errmsg", "Write error")
+			except PyMongoError as e:
+				failed.update({i: str(e) for i in positions})
+
+		inserted = []
+		for i, entity in enumerate(batch):
+			if i in failed:
+				self.rejected(report, lines[i], failed[i])
+			else:
+				inserted.append(entity)
+
+		report["inserted"] += len(inserted)
+		self.createdMany(inserted, stamp)
+
+	def rejected(self, report, line, error):
+		""" Records a failed import line, keeping a bounded error list. """
+
+		report["failed"] += 1
+		if len(report["errors"]) < self.helpers.confs["bulk"]["maxErrors"]:
+			report["errors"].append({"line": line, "error": error})
+
+	def exportEntities(self, arguments, accepted=[]):
+		""" Exports entities as newline delimited JSON.
+
+		Accepts the same filters as the list entities endpoint. The
+		cursor is streamed to the client in batches instead of being
+		loaded into memory.
+		"""
+
+		with self.broker.tracing.span("buildQuery"):
+			built, error = self.buildQuery(arguments)
+		if error is not None:
+			return self.broker.respond(error[0], self.helpers.confs["errorMessages"][error[1]],
+								{}, False, accepted)
+
+		entities = self.broker.storage.find(built["types"], built["query"], built["fields"],
+								built["sort"], built["offset"], built["limit"],
+								self.helpers.confs["bulk"]["exportBatch"], self.broker.routing.list())
+
+		return self.broker.stream(200, self.exportLines(entities))
+
+	def exportLines(self, entities):
+		""" Serializes an entity cursor one line at a time. """
+
+		try:
+			for entity in entities:
+				yield json_util.dumps(entity) + "\n"
+		except PyMongoError as e:
+			self.helpers.logger.error(self.program + " export failed: " + str(e))
+		finally:
+			entities.close()
+
+	def streamEntities(self, arguments, accepted=[]):
+		""" Streams live changes of the entities matching a request.
+
+		Accepts id, type, idPattern, typePattern, q, attrs and options.
+		Every change of a matching entity is sent to the client as a
+		Server-Sent Event until the client disconnects.
+		"""
+
+		stream, error = self.broker.streams.open(arguments)
+		if error is not None:
+			return self.broker.respond(error[0], self.helpers.confs["errorMessages"][error[1]],
+								{}, False, accepted)
+
+		return self.broker.events(self.broker.streams.events(stream))
+
 	def getEntity(self, typeof, _id, attrs, options, metadata,
-					attributes=False, accepted=[]):
+					attributes=False, accepted=[], conditions=None):
 		""" Gets a specific HIASCDI Entity.
 
 		References:
@@ -532,6 +811,19 @@ class entities():
 				values_opt = True if option == "values" else values_opt
 				unique_opt = True if option == "unique" else unique_opt
 
+		# Entities served by context providers are not versioned locally
+		selector = {"id": _id} if typeof is None else {"id": _id, "type": typeof}
+		providers = self.broker.forwarding.plan([selector],
+						[attr for attr in (attrs or "*").split(",") if attr != "*"])
+
+		# Answers conditional requests from the known entity versions
+		representation = [attrs, options, metadata, attributes]
+		known = self.broker.versions.lookup(_id, typeof) if not len(providers) else None
+		if known is not None:
+			etag = self.broker.versions.entityTag(_id, known, representation)
+			if self.broker.versions.notModified(conditions, etag, known):
+				return self.broker.notModified(self.broker.versions.headers(etag, known))
+
 		query = {'id': _id}
 
 		# Removes the MongoDB ID
@@ -574,7 +866,15 @@ class entities():
 		if typeof is not None:
 			query.update({"type": typeof})
 
-		entity = list(self.mongodb.mongoConn.Entities.find(query, fields))
+		# Keeps dateModified available for the entity version
+		fields, strip_modified = self.broker.versions.project(fields)
+		fields = self.broker.tenants.project(fields)
+
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped(query), typeof, fields,
+									self.broker.routing.entity(_id))
+
+		if len(providers):
+			entity = self.broker.forwarding.merge(entity, self.broker.forwarding.query(providers))
 
 		if not entity:
 			self.helpers.logger.info(
@@ -591,6 +891,20 @@ class entities():
 		else:
 			data = entity[0]
 
+			if len(providers):
+				etag, modified = None, None
+			else:
+				modified = self.broker.versions.modified(data)
+				etag = self.broker.versions.entityTag(_id, modified, representation)
+				self.broker.versions.remember(_id, typeof, modified)
+			headers = self.broker.versions.headers(etag, modified)
+
+			if self.broker.versions.notModified(conditions, etag, modified):
+				return self.broker.notModified(headers)
+
+			if strip_modified:
+				data.pop("dateModified", None)
+
 			if keyValues_opt:
 				newData = {}
 				# Converts data to key -> value
@@ -646,9 +960,9 @@ class entities():
 			self.helpers.logger.info(
 				self.program + " 200: " + self.helpers.confs["successMessage"][str(200)]["Description"])
 
-			return self.broker.respond(200, data, {}, False, accepted)
+			return self.broker.respond(200, data, headers, False, accepted)
 
-	def updateEntityPost(self, _id, typeof, data, options, accepted=[]):
+	def updateEntityPost(self, _id, typeof, data, options, accepted=[], conditions=None):
 		""" Updates an HIASCDI Entity.
 
 		References:
@@ -678,20 +992,44 @@ class entities():
 				_append = True if option == "append" else _append
 				_keyValues = True if option == "keyValues" else _keyValues
 
-		entity = list(self.mongodb.mongoConn.Entities.find({'id': _id}))
-		if _append:
-			for update in data:
-				if update in entity[0]:
-					error = True
-				else:
-					self.mongodb.mongoConn.Entities.update_one({"id" : _id},
-						{"$set": {update: data[update]}}, upsert=True)
-					updated = True
-		else:
-			for update in data:
-				self.mongodb.mongoConn.Entities.update_one({"id" : _id},
-							{"$set": {update: data[update]}}, upsert=True)
-				updated = True
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped({"id": _id}), typeof)
+		if not entity:
+			self.helpers.logger.info(self.program + " 404: " + \
+							self.helpers.confs["errorMessages"][str(404)]["Description"])
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
+
+		collection = self.stored(entity, typeof)
+
+		if self.preconditionFailed(_id, entity[0], conditions):
+			return self.broker.respond(412, self.helpers.confs["errorMessages"]["412"],
+								{}, False, accepted)
+
+		error = self.broker.schemas.validate(entity[0]["type"], data, True, _keyValues)
+		if error is not None:
+			return self.invalid(error, accepted)
+
+		stamp = self.broker.versions.stamp()
+		after = dict(entity[0])
+		sets = {}
+		for update in data:
+			if _append and update in entity[0]:
+				error = True
+			else:
+				sets[update] = data[update]
+
+		if sets:
+			pinned = self.broker.versions.pinned(conditions)
+			sets["dateModified"] = stamp
+			result = collection.update_one(self.versioned(_id, entity[0], conditions),
+							{"$set": sets}, upsert=not pinned)
+			if pinned and result.matched_count == 0:
+				return self.conflicted(accepted)
+			after.update(sets)
+			updated = True
+
+		if updated:
+			self.updated(_id, entity[0], after, list(data), stamp)
 
 		if updated and error is False:
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
@@ -700,7 +1038,7 @@ class entities():
 			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
 								{}, False, accepted)
 
-	def updateEntityPatch(self, _id, typeof, data, options, accepted=[]):
+	def updateEntityPatch(self, _id, typeof, data, options, accepted=[], conditions=None):
 		""" Updates an HIASCDI Entity.
 
 		References:
@@ -729,14 +1067,43 @@ class entities():
 			for option in options:
 				_keyValues = True if option == "keyValues" else keyValues
 
-		entity = list(self.mongodb.mongoConn.Entities.find({'id': _id}))
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped({"id": _id}), typeof)
+		if not entity:
+			self.helpers.logger.info(self.program + " 404: " + \
+							self.helpers.confs["errorMessages"][str(404)]["Description"])
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
+
+		collection = self.stored(entity, typeof)
+
+		if self.preconditionFailed(_id, entity[0], conditions):
+			return self.broker.respond(412, self.helpers.confs["errorMessages"]["412"],
+								{}, False, accepted)
+
+		error = self.broker.schemas.validate(entity[0]["type"], data, True, _keyValues)
+		if error is not None:
+			return self.invalid(error, accepted)
+
+		stamp = self.broker.versions.stamp()
+		after = dict(entity[0])
+		sets = {}
 		for update in data:
 			if update not in entity[0]:
 				error = True
 			else:
-				self.mongodb.mongoConn.Entities.update_one({"id" : _id},
-					{"$set": {update: data[update]}})
-				updated = True
+				sets[update] = data[update]
+
+		if sets:
+			sets["dateModified"] = stamp
+			result = collection.update_one(self.versioned(_id, entity[0], conditions),
+							{"$set": sets})
+			if self.broker.versions.pinned(conditions) and result.matched_count == 0:
+				return self.conflicted(accepted)
+			after.update(sets)
+			updated = True
+
+		if updated:
+			self.updated(_id, entity[0], after, list(data), stamp)
 
 		if updated and error is False:
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
@@ -745,7 +1112,7 @@ class entities():
 			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
 								{}, False, accepted)
 
-	def updateEntityPut(self, _id, typeof, data, options, accepted=[]):
+	def updateEntityPut(self, _id, typeof, data, options, accepted=[], conditions=None):
 		""" Updates an HIASCDI Entity.
 
 		References:
@@ -764,14 +1131,7 @@ class entities():
 		if "type" in data:
 			del data['type']
 
-		fields = {
-			'_id': False,
-			'id': False,
-			'type': False,
-			'dateCreated': False,
-			'dateModified': False,
-			'dateExpired': False
-		}
+		builtin = ['_id', 'id', 'type', 'servicePath', 'dateCreated', 'dateModified', 'dateExpired']
 
 		updated = False
 		_keyValues = False
@@ -781,16 +1141,42 @@ class entities():
 			for option in options:
 				_keyValues = True if option == "keyValues" else _keyValues
 
-		entity = list(self.mongodb.mongoConn.Entities.find({"id": _id}, fields))
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped({"id": _id}), typeof)
+		collection = self.stored(entity, typeof)
 
-		for e in entity:
-			self.mongodb.mongoConn.Entities.update({"id": _id}, {'$unset': {e: ""}})
+		if entity and self.preconditionFailed(_id, entity[0], conditions):
+			return self.broker.respond(412, self.helpers.confs["errorMessages"]["412"],
+								{}, False, accepted)
 
-		for update in data:
-			self.mongodb.mongoConn.Entities.update_one({"id" : _id},
-				{"$set": {update: data[update]}}, upsert=True)
+		# The new attributes replace all the current ones
+		error = self.broker.schemas.validate(entity[0]["type"] if entity else typeof or "Thing",
+									data, False, _keyValues)
+		if error is not None:
+			return self.invalid(error, accepted)
+
+		stamp = self.broker.versions.stamp()
+		if len(data):
+			# The current attributes not in the new ones are removed in the same write
+			replace = {"$set": dict(data, dateModified=stamp)}
+			unset = {attr: "" for attr in (entity[0] if entity else [])
+						if attr not in builtin and attr not in data}
+			if unset:
+				replace["$unset"] = unset
+
+			pinned = bool(entity) and self.broker.versions.pinned(conditions)
+			result = collection.update_one(self.versioned(_id, entity[0] if entity else None,
+									conditions), replace, upsert=not pinned)
+			if pinned and result.matched_count == 0:
+				return self.conflicted(accepted)
 			updated = True
 
+		if updated:
+			before = entity[0] if entity else None
+			after = {attr: before[attr] for attr in before if attr in builtin} \
+				if before is not None else {"id": _id}
+			after.update(data)
+			self.updated(_id, before, after, None, stamp)
+
 		if updated:
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
 								{}, False, accepted)
@@ -811,16 +1197,15 @@ class entities():
 						- Remove entity
 		"""
 
-		if typeof in self.mongodb.collextions:
-			collection = self.mongodb.collextions[typeof]
-		else:
-			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
-								{}, False, accepted)
-
-		deleted = False
-		result = collection.delete_one({"id": _id})
+		result = self.broker.storage.delete(self.broker.tenants.scoped({"id": _id}), typeof)
 
-		if result.deleted_count == 1:
+		if result is not None:
+			self.broker.versions.forget(_id, result["type"])
+			self.broker.routing.written(_id)
+			self.broker.counts.entityDeleted(result["type"])
+			self.broker.catalogue.entityDeleted(result)
+			self.broker.results.written(result["type"])
+			self.broker.invalidation.entity(_id, result["type"])
 			self.helpers.logger.info("Mongo data delete OK")
 			return self.broker.respond(204, {}, {}, False, accepted)
 		else:
@@ -828,7 +1213,8 @@ class entities():
 			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
 								{}, False, accepted)
 
-	def getEntityAttribute(self, typeof, _id, _attr, metadata, is_value=False, accepted=[]):
+	def getEntityAttribute(self, typeof, _id, _attr, metadata, is_value=False, accepted=[],
+							conditions=None):
 		""" Gets a specific HIASCDI Entity Attribute.
 
 		References:
@@ -841,6 +1227,18 @@ class entities():
 						- Get Attribute Data
 		"""
 
+		# Entities served by context providers are not versioned locally
+		selector = {"id": _id} if typeof is None else {"id": _id, "type": typeof}
+		providers = self.broker.forwarding.plan([selector], [_attr])
+
+		# Answers conditional requests from the known entity versions
+		representation = [_attr, metadata, is_value]
+		known = self.broker.versions.lookup(_id, typeof) if not len(providers) else None
+		if known is not None:
+			etag = self.broker.versions.entityTag(_id, known, representation)
+			if self.broker.versions.notModified(conditions, etag, known):
+				return self.broker.notModified(self.broker.versions.headers(etag, known))
+
 		query = {'id': _id}
 
 		# Removes the MongoDB ID
@@ -858,7 +1256,15 @@ class entities():
 		if typeof is not None:
 			query.update({"type": typeof})
 
-		entity = list(self.mongodb.mongoConn.Entities.find(query, fields))
+		# Keeps dateModified available for the entity version
+		fields, strip_modified = self.broker.versions.project(fields)
+		fields = self.broker.tenants.project(fields)
+
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped(query), typeof, fields,
+									self.broker.routing.entity(_id))
+
+		if len(providers):
+			entity = self.broker.forwarding.merge(entity, self.broker.forwarding.query(providers))
 
 		if not entity:
 			self.helpers.logger.info(self.program + " 404: " + \
@@ -873,6 +1279,17 @@ class entities():
 		else:
 			data = entity[0]
 
+			if len(providers):
+				etag, modified = None, None
+			else:
+				modified = self.broker.versions.modified(data)
+				etag = self.broker.versions.entityTag(_id, modified, representation)
+				self.broker.versions.remember(_id, typeof, modified)
+			headers = self.broker.versions.headers(etag, modified)
+
+			if self.broker.versions.notModified(conditions, etag, modified):
+				return self.broker.notModified(headers)
+
 			if _attr not in data:
 				self.helpers.logger.info(self.program + " 400: " + \
 									self.helpers.confs["errorMessages"]["400b"]["Description"])
@@ -894,9 +1311,10 @@ class entities():
 			self.helpers.logger.info(
 				self.program + " 200: " + self.helpers.confs["successMessage"][str(200)]["Description"])
 
-			return self.broker.respond(200, data, None, {}, override, accepted)
+			return self.broker.respond(200, data, headers, override, accepted)
 
-	def updateEntityAttrPut(self, _id, _attr, typeof, data, is_value, accepted = None, content_type = None):
+	def updateEntityAttrPut(self, _id, _attr, typeof, data, is_value, accepted = None, content_type = None,
+							conditions = None):
 		""" Updates an HIASCDI Entity Attribute.
 
 		References:
@@ -914,7 +1332,8 @@ class entities():
 		if typeof is not None:
 			query.update({"type": typeof})
 
-		entity = list(self.mongodb.mongoConn.Entities.find(query))
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped(query), typeof)
+		collection = self.stored(entity, typeof)
 
 		if not entity:
 			self.helpers.logger.info(self.program + " 404: " + \
@@ -931,6 +1350,9 @@ class entities():
 				self.helpers.confs["errorMessages"][str(404)]["Description"])
 			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
 								{}, False, accepted)
+		elif self.preconditionFailed(_id, entity[0], conditions):
+			return self.broker.respond(412, self.helpers.confs["errorMessages"]["412"],
+								{}, False, accepted)
 		else:
 			if is_value:
 				data = data.decode()
@@ -962,8 +1384,25 @@ class entities():
 			else:
 				path = _attr
 
-			self.mongodb.mongoConn.Entities.update_one({"id": _id},
-				{"$set": {path: data}}, upsert=True)
+			error = self.broker.schemas.validateAttribute(entity[0]["type"], _attr, data, is_value)
+			if error is not None:
+				return self.invalid(error, accepted)
+
+			stamp = self.broker.versions.stamp()
+			pinned = self.broker.versions.pinned(conditions)
+			result = collection.update_one(self.versioned(_id, entity[0], conditions),
+				{"$set": {path: data, "dateModified": stamp}}, upsert=not pinned)
+			if pinned and result.matched_count == 0:
+				return self.conflicted(accepted)
+
+			after = dict(entity[0])
+			if is_value:
+				after[_attr] = dict(after[_attr]) if isinstance(after[_attr], dict) else {}
+				after[_attr]["value"] = data
+			else:
+				after[_attr] = data
+			self.updated(_id, entity[0], after, [_attr], stamp)
+
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
 								{}, False, accepted)
 
@@ -985,7 +1424,8 @@ class entities():
 		if typeof is not None:
 			query.update({"type": typeof})
 
-		entity = list(self.mongodb.mongoConn.Entities.find(query))
+		entity = self.broker.storage.lookup(self.broker.tenants.scoped(query), typeof)
+		collection = self.stored(entity, typeof)
 
 		if not entity:
 			self.helpers.logger.info(self.program + " 404: " +
@@ -1003,7 +1443,103 @@ class entities():
 			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
 								{}, False, accepted)
 		else:
-			self.mongodb.mongoConn.Entities.update({"id": _id},
-						{'$unset': {_attr: ""}})
+			error = self.broker.schemas.removable(entity[0]["type"], _attr)
+			if error is not None:
+				return self.invalid(error, accepted)
+
+			stamp = self.broker.versions.stamp()
+			collection.update(self.broker.tenants.scoped({"id": _id}),
+						{'$unset': {_attr: ""}, '$set': {"dateModified": stamp}})
+
+			after = dict(entity[0])
+			del after[_attr]
+			self.updated(_id, entity[0], after, [_attr], stamp)
+
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
 								{}, False, accepted)
+
+	def invalid(self, error, accepted):
+		""" Rejects an entity write that does not match its type schema. """
+
+		message = dict(self.helpers.confs["errorMessages"]["400v"])
+		message["Description"] += ": " + error
+
+		self.helpers.logger.info(self.program + " 400: " + message["Description"])
+
+		return self.broker.respond(400, message, {}, False, accepted)
+
+	def stored(self, entity, typeof):
+		""" Gets the collection a looked up entity is, or will be, stored in. """
+
+		return self.broker.storage.collection(entity[0]["type"] if entity else typeof)
+
+	def created(self, entity, stamp):
+		""" Propagates a new entity to the versions, counters, type
+		catalogue, subscriptions and other workers. """
+
+		self.broker.versions.written(entity["id"], entity["type"], stamp)
+		self.broker.routing.written(entity["id"])
+		self.broker.counts.entityCreated(entity["type"])
+		self.broker.catalogue.entityCreated(entity)
+		self.broker.notifications.changed(entity)
+		self.broker.results.written(entity["type"])
+		self.broker.invalidation.entity(entity["id"], entity["type"])
+
+	def createdMany(self, entities, stamp):
+		""" Propagates a batch of new entities, merging the type
+		catalogue updates per type. """
+
+		for entity in entities:
+			self.broker.versions.written(entity["id"], entity["type"], stamp)
+			self.broker.routing.written(entity["id"])
+			self.broker.counts.entityCreated(entity["type"])
+			self.broker.notifications.changed(entity)
+			self.broker.invalidation.entity(entity["id"], entity["type"])
+		for typeof in set(entity["type"] for entity in entities):
+			self.broker.results.written(typeof)
+		self.broker.catalogue.entitiesCreated(entities)
+
+	def updated(self, _id, before, after, attrs, stamp):
+		""" Propagates an entity update to the versions, type catalogue,
+		subscriptions and other workers.
+
+		attrs is the list of changed attributes, or None if all the
+		attributes were replaced.
+		"""
+
+		after["dateModified"] = stamp
+
+		self.broker.versions.written(_id, after.get("type"), stamp)
+		self.broker.routing.written(_id)
+		if before is not None:
+			self.broker.catalogue.entityUpdated(before, after)
+		self.broker.notifications.changed(after, attrs)
+		self.broker.results.written(after.get("type"))
+		self.broker.invalidation.entity(_id, after.get("type"))
+
+	def preconditionFailed(self, _id, entity, conditions):
+		""" Checks an If-Match precondition against an entity. """
+
+		etag = self.broker.versions.entityTag(_id, self.broker.versions.modified(entity))
+
+		return self.broker.versions.preconditionFailed(conditions, etag)
+
+	def versioned(self, _id, entity, conditions):
+		""" Builds the filter of a write to an entity.
+
+		Writes that passed an If-Match precondition only apply to the
+		version it was checked against, so that clients holding the
+		same ETag cannot overwrite each other. They must not upsert.
+		"""
+
+		query = {"id": _id}
+		if entity is not None and self.broker.versions.pinned(conditions):
+			query["dateModified"] = entity.get("dateModified")
+
+		return self.broker.tenants.scoped(query)
+
+	def conflicted(self, accepted):
+		""" Responds to a write that lost the entity version to another. """
+
+		return self.broker.respond(412, self.helpers.confs["errorMessages"]["412"],
+							{}, False, accepted)
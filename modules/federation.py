@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+""" HIASCDI Federation Module.
+
+This module fans HIASCDI queries out to the peer brokers of a
+federation and merges their answers with the local ones.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+class federation():
+	""" HIASCDI Federation Module.
+
+	This module fans HIASCDI queries out to the peer brokers of a
+	federation and merges their answers with the local ones.
+
+	Peers are queried in parallel and each peer has its own deadline.
+	A peer that fails or misses its deadline is left out of the results
+	and named in the failures header instead of failing the query.
+	Requests sent to peers are marked so that peers answer from their
+	own data only and queries never loop through the federation.
+	"""
+
+	def __init__(self, helpers, mongodb, auth):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Federation Module"
+
+		self.mongodb = mongodb
+		self.auth = auth
+
+		self.confs = self.helpers.confs["federation"]
+		self.peers = self.confs["peers"]
+
+		self.pool = ThreadPoolExecutor(max_workers=self.confs["workers"])
+		self.local = threading.local()
+
+		self.queries = 0
+		self.failures = {peer["name"]: 0 for peer in self.peers}
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def fanout(self, headers):
+		""" Checks if a request should be fanned out to the peers.
+
+		Requests coming from a peer are answered locally.
+		"""
+
+		return len(self.peers) > 0 and self.confs["header"] not in headers
+
+	def arguments(self, arguments, window, options=[]):
+		""" Builds the query arguments sent to the peers.
+
+		The peers return the first window results, unshaped, so that the
+		page can be cut and shaped after the merge.
+		"""
+
+		params = {key: value for key, value in arguments.items()
+					if key not in ["offset", "limit", "options"]}
+		if window:
+			params["limit"] = str(window)
+		if len(options):
+			params["options"] = ",".join(options)
+
+		return params
+
+	def session(self):
+		""" Gets the keep-alive HTTP session of the current worker. """
+
+		if not hasattr(self.local, "session"):
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=self.confs["pool"]["hosts"],
+								pool_maxsize=self.confs["pool"]["connections"])
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+			self.local.session = session
+
+		return self.local.session
+
+	def get(self, peer, path, params, headers):
+		""" Queries a peer, returns its results and Count header.
+
+		A 404 means the peer has no matching data.
+		"""
+
+		auth = (peer["user"], peer["password"]) if peer.get("user") else self.auth
+
+		r = self.session().get(peer["url"].rstrip("/") + path, params=params, headers=headers,
+						auth=auth, timeout=peer.get("timeout", self.confs["timeout"]))
+
+		if r.status_code == 404:
+			return [], 0
+		if r.status_code != 200:
+			raise ValueError("status " + str(r.status_code))
+
+		results = r.json()
+		if not isinstance(results, list):
+			raise ValueError("unexpected answer")
+
+		return results, int(r.headers.get("Count", 0))
+
+	def query(self, path, params):
+		""" Sends a query to every peer in parallel.
+
+		Returns the results of each peer that answered within its
+		deadline, the sum of their Count headers and the names of the
+		peers that failed.
+		"""
+
+		headers = {"Content-Type": "application/json", "Accept": "application/json",
+					self.confs["header"]: "1"}
+		headers.update(self.mongodb.headers())
+
+		start = time.monotonic()
+		futures = [(peer, self.pool.submit(self.get, peer, path, params, headers))
+						for peer in self.peers]
+
+		results = []
+		count = 0
+		failed = []
+		for peer, future in futures:
+			deadline = start + peer.get("timeout", self.confs["timeout"])
+			try:
+				answer, total = future.result(timeout=max(deadline - time.monotonic(), 0))
+			except Exception as e:
+				self.helpers.logger.warning(self.program + " peer " + peer["name"] +
+											" failed: " + (str(e) or "deadline exceeded"))
+				self.failures[peer["name"]] += 1
+				failed.append(peer["name"])
+				continue
+			results.append(answer)
+			count += total
+
+		self.queries += 1
+
+		return results, count, failed
+
+	def headers(self, failed):
+		""" Builds the header naming the peers that failed. """
+
+		if not len(failed):
+			return {}
+
+		return {self.confs["failuresHeader"]: ",".join(failed)}
+
+	def merge(self, results, key=None, offset=0, limit=0):
+		""" Merges sorted result lists and cuts the requested page. """
+
+		if key is not None:
+			merged = heapq.merge(*results, key=key)
+		else:
+			merged = itertools.chain(*results)
+
+		offset = offset or 0
+
+		return list(itertools.islice(merged, offset, offset + limit if limit else None))
+
+	def mergeTypes(self, results):
+		""" Merges type catalogues, adding up the entity counts and
+		joining the attribute types of each type. """
+
+		merged = {}
+		for types in results:
+			for entry in types:
+				typeof = merged.setdefault(entry["type"], {
+					"type": entry["type"],
+					"attrs": {},
+					"count": 0
+				})
+				typeof["count"] += entry.get("count", 0)
+				for attr, detail in entry.get("attrs", {}).items():
+					atypes = typeof["attrs"].setdefault(attr, {"types": []})
+					for atype in detail.get("types", []):
+						if atype not in atypes["types"]:
+							atypes["types"].append(atype)
+
+		for entry in merged.values():
+			for detail in entry["attrs"].values():
+				detail["types"].sort()
+
+		return [merged[typeof] for typeof in sorted(merged)]
+
+	def getCounters(self):
+		""" Gets the federation counters. """
+
+		return {
+			"peers": [peer["name"] for peer in self.peers],
+			"queries": self.queries,
+			"failures": dict(self.failures)
+		}
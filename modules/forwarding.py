@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+""" HIASCDI Forwarding Module.
+
+This module forwards entity queries to the context providers
+registered in the HIASCDI registrations.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import json
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from components.hiascdi.modules.tenants import current, tenant
+
+
+class forwarding():
+	""" HIASCDI Forwarding Module.
+
+	This module forwards entity queries to the context providers
+	registered in the HIASCDI registrations.
+
+	A query is matched against the entities and attributes each
+	registration provides, the matching providers are queried in
+	parallel, each within its own timeout, and the entities they
+	return are merged with the local ones. Provider answers are cached
+	for a few seconds so that repeated queries do not wait on slow
+	providers again.
+	"""
+
+	def __init__(self, helpers, mongodb):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Forwarding Module"
+
+		self.mongodb = mongodb
+
+		self.confs = self.helpers.confs["registrations"]
+
+		self.pool = ThreadPoolExecutor(max_workers=self.confs["workers"])
+		self.local = threading.local()
+
+		self.registrations = {}
+		self.patterns = {}
+		self.cache = OrderedDict()
+		self.lock = threading.Lock()
+
+		self.forwarded = 0
+		self.failed = 0
+		self.timeouts = 0
+		self.hits = 0
+		self.misses = 0
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def reload(self):
+		""" Reloads the registrations of the current tenant on next use. """
+
+		with self.lock:
+			self.registrations.pop(current(), None)
+
+	def flush(self):
+		""" Drops the registrations and provider answers of every tenant. """
+
+		with self.lock:
+			self.registrations.clear()
+			self.cache.clear()
+
+	def active(self):
+		""" Gets the active registrations of the current tenant. """
+
+		service = current()
+		loaded = self.registrations.get(service)
+
+		if loaded is None or time.monotonic() - loaded[0] > self.confs["refresh"]:
+			registrations = [(registration, self.expires(registration)) for registration in
+								self.mongodb.mongoConn.Registrations.find(
+									{"status": {"$ne": "inactive"}}, {"_id": False})]
+			loaded = (time.monotonic(), registrations)
+			with self.lock:
+				self.registrations[service] = loaded
+
+		now = datetime.now(timezone.utc)
+
+		return [registration for registration, expires in loaded[1]
+					if expires is None or expires > now]
+
+	def expires(self, registration):
+		""" Gets the expiry date of a registration. """
+
+		expires = registration.get("expires")
+		if expires is None:
+			return None
+
+		if isinstance(expires, str):
+			try:
+				expires = datetime.fromisoformat(expires.replace("Z", "+00:00"))
+			except ValueError:
+				return None
+
+		if expires.tzinfo is None:
+			expires = expires.replace(tzinfo=timezone.utc)
+
+		return expires
+
+	def pattern(self, expression):
+		""" Gets a compiled id or type pattern. """
+
+		if expression not in self.patterns:
+			self.patterns[expression] = re.compile(expression)
+		return self.patterns[expression]
+
+	def request(self, arguments):
+		""" Gets the entity selectors, attributes and filter expression of
+		a list entities request. """
+
+		if arguments.get("id") is not None:
+			ids = [{"id": _id} for _id in arguments.get("id").split(",")]
+		elif arguments.get("idPattern") is not None:
+			ids = [{"idPattern": arguments.get("idPattern")}]
+		else:
+			ids = [{}]
+
+		if arguments.get("type") is not None:
+			types = [{"type": typeof} for typeof in arguments.get("type").split(",")]
+		elif arguments.get("typePattern") is not None:
+			types = [{"typePattern": arguments.get("typePattern")}]
+		else:
+			types = [{}]
+
+		attrs = []
+		if arguments.get("attrs") is not None:
+			attrs = [attr for attr in arguments.get("attrs").split(",") if attr != "*"]
+			if "*" in arguments.get("attrs").split(","):
+				attrs = []
+
+		expression = {name: arguments.get(name) for name in
+						["q", "mq", "georel", "geometry", "coords"]
+						if arguments.get(name) is not None}
+
+		return [dict(_id, **typeof) for _id in ids for typeof in types], attrs, expression
+
+	def narrow(self, registered, requested, name):
+		""" Intersects the id or type of a registered and a requested
+		selector.
+
+		Returns the part of the selector to forward, {} if either side
+		accepts any value, or None if the selectors cannot overlap.
+		"""
+
+		pattern = name + "Pattern"
+
+		for exact, other in ((requested, registered), (registered, requested)):
+			if name in exact:
+				if name in other and other[name] != exact[name]:
+					return None
+				if pattern in other and not self.pattern(other[pattern]).fullmatch(str(exact[name])):
+					return None
+				return {name: exact[name]}
+
+		if pattern in requested:
+			return {pattern: requested[pattern]}
+		if pattern in registered:
+			return {pattern: registered[pattern]}
+
+		return {}
+
+	def attributes(self, registered, requested):
+		""" Intersects the registered and requested attributes, an empty
+		list means all, None means no attribute is provided. """
+
+		if not registered:
+			return requested
+		if not requested:
+			return registered
+
+		return [attr for attr in requested if attr in registered] or None
+
+	def inScope(self, registration):
+		""" Checks if a registration serves the service paths of the
+		current request. """
+
+		registered = registration.get("servicePath") or "/"
+		base = registered[:-2] or "/" if registered.endswith("/#") else registered
+
+		for path in tenant.get()[1]:
+			requested = path[:-2] or "/" if path.endswith("/#") else path
+			if self.mongodb.inPath(path, {"servicePath": base}) or \
+					self.mongodb.inPath(registered, {"servicePath": requested}):
+				return True
+
+		return False
+
+	def plan(self, selectors, attrs=[]):
+		""" Gets the providers a query has to be forwarded to.
+
+		Registrations of the same provider and attributes are grouped
+		so that each provider is queried once.
+		"""
+
+		plans = OrderedDict()
+
+		for registration in self.active():
+			url = registration.get("provider", {}).get("http", {}).get("url")
+			provided = registration.get("dataProvided", {})
+			if not url or not self.inScope(registration):
+				continue
+			if registration["provider"].get("supportedForwardingMode", "all") not in ["all", "query"]:
+				continue
+
+			forwarded = self.attributes(provided.get("attrs", []), attrs)
+			if forwarded is None:
+				continue
+
+			entities = []
+			for registered in provided.get("entities", []):
+				for requested in selectors:
+					_id = self.narrow(registered, requested, "id")
+					typeof = self.narrow(registered, requested, "type")
+					if _id is None or typeof is None:
+						continue
+					selector = dict(_id or {"idPattern": ".*"}, **typeof)
+					if selector not in entities:
+						entities.append(selector)
+
+			if not entities:
+				continue
+
+			key = (url, tuple(forwarded))
+			if key not in plans:
+				plans[key] = {
+					"url": url,
+					"attrs": forwarded,
+					"entities": [],
+					"registrations": [],
+					"timeout": registration["provider"].get("timeout", self.confs["timeout"])
+				}
+			plan = plans[key]
+			plan["registrations"].append(registration["id"])
+			plan["timeout"] = min(plan["timeout"],
+							registration["provider"].get("timeout", self.confs["timeout"]))
+			for selector in entities:
+				if selector not in plan["entities"]:
+					plan["entities"].append(selector)
+
+		return list(plans.values())
+
+	def query(self, plans, expression={}):
+		""" Forwards a query to the planned providers and gets the entities
+		they return.
+
+		Providers are queried in parallel, a provider that fails or does
+		not answer within its timeout is left out of the results.
+		"""
+
+		if not plans:
+			return []
+
+		service, paths = tenant.get()
+		headers = {"Content-Type": "application/json", "Accept": "application/json"}
+		headers.update(self.mongodb.headers())
+
+		# Resolved here, the workers do not share the request's tenant
+		collection = self.mongodb.mongoConn.Registrations
+
+		entities = []
+		futures = {}
+		for plan in plans:
+			body = {"entities": plan["entities"]}
+			if plan["attrs"]:
+				body["attrs"] = plan["attrs"]
+			if expression:
+				body["expression"] = expression
+
+			key = (service, ",".join(paths), plan["url"], json.dumps(body, sort_keys=True))
+			cached = self.cached(key)
+			if cached is not None:
+				entities.extend(cached)
+				continue
+
+			futures[self.pool.submit(self.forward, plan, body, headers, collection)] = key
+
+		if futures:
+			done, pending = wait(futures, timeout=max(plan["timeout"] for plan in plans))
+			for future in done:
+				answer = future.result()
+				if answer is not None:
+					self.store(futures[future], answer)
+					entities.extend(json.loads(answer))
+			self.timeouts += len(pending)
+
+		return [entity for entity in entities if isinstance(entity, dict) and "id" in entity]
+
+	def session(self):
+		""" Gets the keep-alive HTTP session of the current worker. """
+
+		if not hasattr(self.local, "session"):
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=self.confs["pool"]["hosts"],
+								pool_maxsize=self.confs["pool"]["connections"])
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+			self.local.session = session
+
+		return self.local.session
+
+	def forward(self, plan, body, headers, collection):
+		""" Posts a query to a provider, returns its JSON answer or None. """
+
+		answer = None
+
+		try:
+			r = self.session().post(plan["url"].rstrip("/") + "/op/query", json=body,
+							headers=headers, timeout=plan["timeout"])
+			if r.status_code == 200 and isinstance(r.json(), list):
+				answer = r.text
+			else:
+				self.helpers.logger.warning(self.program + " provider " + plan["url"] +
+											" answered " + str(r.status_code) + ".")
+		except (requests.RequestException, ValueError) as e:
+			self.helpers.logger.warning(self.program + " provider " + plan["url"] +
+										" failed: " + str(e))
+
+		self.forwarded += 1
+		if answer is None:
+			self.failed += 1
+
+		self.record(collection, plan["registrations"], answer is not None)
+
+		return answer
+
+	def record(self, collection, registrations, success):
+		""" Updates the forwardingInformation of registrations. """
+
+		now = datetime.now(timezone.utc).isoformat()
+
+		try:
+			collection.update_many({"id": {"$in": registrations}}, {
+				"$inc": {"forwardingInformation.timesSent": 1},
+				"$set": {
+					"forwardingInformation.lastForwarding": now,
+					"forwardingInformation." + ("lastSuccess" if success else "lastFailure"): now
+				}
+			})
+		except Exception as e:
+			self.helpers.logger.error(self.program + " forwarding record error: " + str(e))
+
+	def cached(self, key):
+		""" Gets a cached provider answer, parsed afresh for each use. """
+
+		with self.lock:
+			entry = self.cache.get(key)
+			if entry is not None and entry[0] < time.monotonic():
+				del self.cache[key]
+				entry = None
+			if entry is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+
+		return json.loads(entry[1])
+
+	def store(self, key, answer):
+		""" Caches a provider answer. """
+
+		with self.lock:
+			self.cache[key] = (time.monotonic() + self.confs["cacheTTL"], answer)
+			self.cache.move_to_end(key)
+			while len(self.cache) > self.confs["cacheSize"]:
+				self.cache.popitem(last=False)
+
+	def merge(self, local, remote):
+		""" Merges provider entities into the local ones.
+
+		Attributes a provider returns for a local entity are added to
+		it, attributes stored locally take precedence.
+		"""
+
+		index = {(entity.get("id"), entity.get("type")): entity for entity in local}
+
+		for entity in remote:
+			key = (entity.get("id"), entity.get("type"))
+			if key in index:
+				for attr, value in entity.items():
+					index[key].setdefault(attr, value)
+			else:
+				index[key] = entity
+				local.append(entity)
+
+		return local
+
+	def getCounters(self):
+		""" Gets the forwarding counters. """
+
+		return {
+			"forwarded": self.forwarded,
+			"failed": self.failed,
+			"timeouts": self.timeouts,
+			"cacheHits": self.hits,
+			"cacheMisses": self.misses,
+			"cached": len(self.cache)
+		}
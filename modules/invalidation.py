@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+""" HIASCDI Invalidation Module.
+
+This module keeps the caches of HIASCDI workers consistent by
+broadcasting the keys each write invalidates.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+
+from components.hiascdi.modules.tenants import current
+
+
+class invalidation():
+	""" HIASCDI Invalidation Module.
+
+	This module keeps the caches of HIASCDI workers consistent by
+	broadcasting the keys each write invalidates.
+
+	Every write queues an event naming the tenant and the entity,
+	type, subscriptions or registrations it changed. Events are sent
+	in small batches over the iotJumpWay MQTT connection, or over a
+	MongoDB change stream when the database is a replica set, and the
+	other workers drop the matching cache entries as they arrive.
+
+	Each worker numbers its batches and sends a heartbeat with its last
+	number when idle. A worker that sees a gap in a peer's numbers, or
+	stops hearing from a peer, may have missed writes and flushes all
+	of its caches.
+	"""
+
+	def __init__(self, helpers, mongodb, mqtt, broker):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Invalidation Module"
+
+		self.mongodb = mongodb
+		self.mqtt = mqtt
+		self.broker = broker
+
+		self.confs = self.helpers.confs["invalidation"]
+
+		self.node = uuid.uuid4().hex
+		self.sequence = 0
+
+		self.events = queue.Queue(maxsize=self.confs["queue"])
+		self.received = queue.Queue()
+		self.peers = {}
+		self.lock = threading.Lock()
+
+		self.counters = {
+			"published": 0,
+			"received": 0,
+			"applied": 0,
+			"dropped": 0,
+			"gaps": 0,
+			"flushes": 0
+		}
+
+		self.transport = self.connect(self.confs["transport"])
+
+		if self.transport != "none":
+			threading.Thread(target=self.publisher, daemon=True).start()
+			threading.Thread(target=self.applier, daemon=True).start()
+
+		self.helpers.logger.info(self.program + " initialization complete, transport " +
+									self.transport + ".")
+
+	def connect(self, transport):
+		""" Subscribes to the invalidation bus, returns the transport used. """
+
+		if transport == "auto":
+			transport = "changeStream" if self.replicaSet() else "mqtt"
+
+		if transport == "mqtt":
+			if self.mqtt is None:
+				self.helpers.logger.warning(self.program + " MQTT unavailable, caches are not shared.")
+				return "none"
+			self.mqtt.mqttClient.message_callback_add(self.confs["topic"], self.message)
+			self.mqtt.mqttClient.subscribe(self.confs["topic"], qos=self.confs["qos"])
+		elif transport == "changeStream":
+			self.collection().create_index("created", expireAfterSeconds=self.confs["retention"])
+			threading.Thread(target=self.watch, daemon=True).start()
+
+		return transport
+
+	def replicaSet(self):
+		""" Checks if MongoDB is a replica set and supports change streams. """
+
+		try:
+			return "setName" in self.mongodb.database("").client.admin.command("hello")
+		except Exception as e:
+			self.helpers.logger.warning(self.program + " replica set check failed: " + str(e))
+			return False
+
+	def collection(self):
+		""" Gets the collection batches are exchanged through over change streams. """
+
+		return self.mongodb.database("").Invalidations
+
+	def publish(self, kind, key=None, typeof=None):
+		""" Queues the invalidation of a cache key for the other workers.
+
+		kind is entity, type, subscriptions or registrations. Events are
+		dropped when the queue is full, the next batch then skips a
+		sequence number so that the other workers flush.
+		"""
+
+		if self.transport == "none":
+			return
+
+		try:
+			self.events.put_nowait((current(), kind, key, typeof))
+		except queue.Full:
+			with self.lock:
+				self.counters["dropped"] += 1
+				self.sequence += 1
+
+	def entity(self, _id, typeof=None):
+		""" Invalidates an entity written by this worker. """
+
+		self.publish("entity", _id, typeof)
+
+	def type(self, typeof):
+		""" Invalidates an entity type written by this worker. """
+
+		self.publish("type", typeof)
+
+	def subscriptions(self, _id=None):
+		""" Invalidates a subscription of the current tenant, or all of them. """
+
+		self.publish("subscriptions", _id)
+
+	def registrations(self):
+		""" Invalidates the registrations of the current tenant. """
+
+		self.publish("registrations")
+
+	def publisher(self):
+		""" Sends the queued events in batches and heartbeats when idle. """
+
+		while True:
+			try:
+				first = self.events.get(timeout=self.confs["heartbeat"])
+			except queue.Empty:
+				self.send([])
+				continue
+
+			batch = {first: None}
+			deadline = time.monotonic() + self.confs["window"]
+			while len(batch) < self.confs["batch"]:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				try:
+					batch[self.events.get(timeout=remaining)] = None
+				except queue.Empty:
+					break
+
+			self.send(list(batch))
+
+	def send(self, events):
+		""" Publishes a batch of events, an empty batch is a heartbeat. """
+
+		with self.lock:
+			if len(events):
+				self.sequence += 1
+			message = {
+				"node": self.node,
+				"seq": self.sequence,
+				"events": [list(event) for event in events]
+			}
+
+		try:
+			if self.transport == "mqtt":
+				self.mqtt.mqttClient.publish(self.confs["topic"], json.dumps(message),
+											qos=self.confs["qos"])
+			else:
+				message["created"] = datetime.now(timezone.utc)
+				self.collection().insert_one(message)
+			self.counters["published"] += len(events)
+		except Exception as e:
+			self.helpers.logger.error(self.program + " publish error: " + str(e))
+
+	def message(self, client, userdata, message):
+		""" Receives a batch over MQTT. """
+
+		try:
+			self.received.put(json.loads(message.payload))
+		except ValueError as e:
+			self.helpers.logger.error(self.program + " invalid message: " + str(e))
+
+	def watch(self):
+		""" Receives batches over a MongoDB change stream.
+
+		The stream is reopened after errors, writes made while it was
+		down may have been missed so the caches are flushed.
+		"""
+
+		pipeline = [{"$match": {"operationType": "insert"}}]
+
+		while True:
+			try:
+				with self.collection().watch(pipeline) as stream:
+					for change in stream:
+						self.received.put(change["fullDocument"])
+			except Exception as e:
+				self.helpers.logger.error(self.program + " change stream error: " + str(e))
+				self.received.put(None)
+				time.sleep(self.confs["heartbeat"])
+
+	def applier(self):
+		""" Applies the batches received from the other workers. """
+
+		while True:
+			try:
+				message = self.received.get(timeout=self.confs["heartbeat"])
+			except queue.Empty:
+				message = False
+
+			try:
+				if message is None:
+					self.flush("bus interrupted")
+				elif message:
+					self.receive(message)
+				self.silent()
+			except Exception as e:
+				self.helpers.logger.error(self.program + " apply error: " + str(e))
+
+	def receive(self, message):
+		""" Checks the sequence of a batch and applies its events. """
+
+		node = message["node"]
+		if node == self.node:
+			return
+
+		seq = message["seq"]
+		last = self.peers.get(node)
+		self.peers[node] = (max(seq, last[0]) if last else seq, time.monotonic())
+
+		if last is not None and seq <= last[0]:
+			return
+
+		if last is not None and seq > last[0] + (1 if len(message["events"]) else 0):
+			self.counters["gaps"] += 1
+			self.flush("sequence gap from " + node)
+			return
+
+		self.counters["received"] += len(message["events"])
+		self.apply(message["events"])
+
+	def silent(self):
+		""" Flushes when a known worker has not been heard from, either it
+		stopped or this worker stopped receiving its batches. """
+
+		now = time.monotonic()
+		timeout = self.confs["heartbeat"] * self.confs["missed"]
+
+		lost = [node for node, (seq, seen) in self.peers.items() if now - seen > timeout]
+		for node in lost:
+			del self.peers[node]
+
+		if len(lost):
+			self.flush(str(len(lost)) + " workers silent")
+			if self.transport == "mqtt":
+				self.mqtt.mqttClient.subscribe(self.confs["topic"], qos=self.confs["qos"])
+
+	def apply(self, events):
+		""" Drops the cache entries named by a batch of events.
+
+		Subscriptions are only marked, the notifications dispatcher
+		reloads them.
+		"""
+
+		for service, kind, key, typeof in events:
+			with self.mongodb.using(service):
+				if kind == "entity":
+					self.broker.versions.forget(key, typeof)
+					self.broker.routing.written(key)
+					self.broker.results.written(typeof)
+					if typeof is not None:
+						self.broker.counts.forget(typeof)
+					else:
+						for name in self.broker.storage.names():
+							self.broker.counts.clear(name)
+				elif kind == "type":
+					self.broker.schemas.invalidate(key)
+					self.broker.counts.clear("Types")
+					self.broker.counts.clear("TypeCatalogue")
+				elif kind == "registrations":
+					self.broker.forwarding.reload()
+					self.broker.counts.clear("Registrations")
+				elif kind == "subscriptions":
+					self.broker.counts.clear("Subscriptions")
+					self.broker.notifications.refresh(key)
+			self.counters["applied"] += 1
+
+	def flush(self, reason):
+		""" Drops every cache, used when invalidations may have been missed. """
+
+		self.broker.versions.flush()
+		self.broker.routing.flush()
+		self.broker.counts.flush()
+		self.broker.results.flush()
+		self.broker.schemas.flush()
+		self.broker.forwarding.flush()
+		self.broker.notifications.flush()
+
+		self.counters["flushes"] += 1
+
+		self.helpers.logger.warning(self.program + " caches flushed, " + reason + ".")
+
+	def getCounters(self):
+		""" Gets the invalidation counters. """
+
+		counters = dict(self.counters)
+		counters["transport"] = self.transport
+		counters["node"] = self.node
+		counters["sequence"] = self.sequence
+		counters["queued"] = self.events.qsize()
+		counters["peers"] = len(self.peers)
+
+		return counters
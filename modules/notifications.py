@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+""" HIASCDI Notifications Module.
+
+This module matches entity changes against the HIASCDI subscriptions
+and renders the notifications sent to subscribers.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import queue
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from bson import json_util
+
+from components.hiascdi.modules.delivery import delivery
+from components.hiascdi.modules.tenants import current
+from components.hiascdi.modules.timers import wheel
+
+
+class notifications():
+	""" HIASCDI Notifications Module.
+
+	This module matches entity changes against the HIASCDI subscriptions
+	and renders the notifications sent to subscribers.
+
+	Entity writes only queue the change, matching, rendering and
+	delivery happen on background threads so that slow subscribers
+	never block the write path.
+
+	Only active, unexpired subscriptions are kept in the match set.
+	Expiry dates are tracked in a timer wheel that removes subscriptions
+	as they expire, and throttling is enforced per subscription and
+	entity.
+
+	Subscriptions are loaded from every tenant database and an entity
+	change only matches the subscriptions of its own tenant and
+	service path. Subscription writes only mark the subscription for
+	reloading, the dispatcher reloads it before the next change.
+	Listeners such as the live entity streams are called with every
+	change from the same dispatcher.
+	"""
+
+	def __init__(self, helpers, mongodb, tracing, mqtt=None):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Notifications Module"
+
+		self.mongodb = mongodb
+		self.tracing = tracing
+
+		self.confs = self.helpers.confs["notifications"]
+
+		self.changes = queue.Queue(maxsize=self.confs["changes"])
+		self.dropped = 0
+		self.rendered = 0
+		self.notified = 0
+		self.throttled = 0
+		self.expired = 0
+
+		self.subscriptions = {}
+		self.loaded = 0
+		self.dirty = {}
+		self.patterns = {}
+		self.throttles = OrderedDict()
+		self.listeners = []
+		self.lock = threading.Lock()
+
+		self.delivery = delivery(self.helpers, self.mongodb, self.tracing, mqtt)
+
+		self.expiry = wheel(self.confs["expiry"]["slots"], self.confs["expiry"]["resolution"])
+
+		self.reload()
+		self.expiry.start(self.expire)
+		threading.Thread(target=self.dispatch, daemon=True).start()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def reload(self):
+		""" Reloads the active subscriptions used for matching. """
+
+		with self.lock:
+			self.dirty = {}
+
+		loaded = {service: self.fetch(service) for service in self.mongodb.services()}
+
+		now = datetime.now(timezone.utc)
+		active = {}
+		expired = []
+
+		with self.lock:
+			self.expiry.clear()
+			for service, subscriptions in loaded.items():
+				active[service] = self.activate(service, subscriptions, {}, now, expired)
+
+			self.subscriptions = active
+			self.loaded = time.time()
+
+		if expired:
+			self.expire(expired)
+
+	def update(self):
+		""" Reloads the subscriptions marked by refresh. """
+
+		with self.lock:
+			dirty, self.dirty = self.dirty, {}
+
+		for service, ids in dirty.items():
+			try:
+				subscriptions = self.fetch(service, ids)
+			except Exception:
+				# The marks are lost, everything is reloaded instead
+				self.loaded = 0
+				raise
+
+			now = datetime.now(timezone.utc)
+			expired = []
+
+			with self.lock:
+				active = dict(self.subscriptions)
+				tenant = dict(active.get(service, {})) if ids is not None else {}
+				for _id in list(ids if ids is not None else active.get(service, {})):
+					tenant.pop(_id, None)
+					self.expiry.remove((service, _id))
+				active[service] = self.activate(service, subscriptions, tenant, now, expired)
+				self.subscriptions = active
+
+			if expired:
+				self.expire(expired)
+
+	def fetch(self, service, ids=None):
+		""" Gets the active subscriptions of a tenant, or only those with
+		the given ids. """
+
+		query = {"status": {"$nin": ["inactive", "expired"]}}
+		if ids is not None:
+			query["id"] = {"$in": list(ids)}
+
+		with self.mongodb.using(service):
+			return list(self.mongodb.mongoConn.Subscriptions.find(query, {"_id": False}))
+
+	def activate(self, service, subscriptions, active, now, expired):
+		""" Adds subscriptions to the match set of a tenant and schedules
+		their expiry, the lock must be held.
+
+		Subscriptions that already expired are added to expired instead.
+		"""
+
+		for subscription in subscriptions:
+			key = (service, subscription["id"])
+			expires = self.expires(subscription)
+			if expires is not None:
+				remaining = (expires - now).total_seconds()
+				if remaining <= 0:
+					expired.append(key)
+					continue
+				self.expiry.add(key, remaining, key)
+			active[subscription["id"]] = subscription
+
+		return active
+
+	def refresh(self, _id=None):
+		""" Marks a subscription of the current tenant, or all of them,
+		for reloading by the dispatcher. """
+
+		service = current()
+
+		with self.lock:
+			if _id is None or (service in self.dirty and self.dirty[service] is None):
+				self.dirty[service] = None
+			else:
+				self.dirty.setdefault(service, set()).add(_id)
+
+		self.wake()
+
+	def flush(self):
+		""" Marks every subscription for reloading by the dispatcher. """
+
+		self.loaded = 0
+		self.wake()
+
+	def wake(self):
+		""" Wakes the dispatcher so that marked subscriptions are reloaded
+		without waiting for an entity change. """
+
+		try:
+			self.changes.put_nowait(None)
+		except queue.Full:
+			# The dispatcher is busy and reloads before the next change
+			pass
+
+	def expires(self, subscription):
+		""" Gets the expiry date of a subscription. """
+
+		expires = subscription.get("expires")
+		if expires is None:
+			return None
+
+		if isinstance(expires, str):
+			try:
+				expires = datetime.fromisoformat(expires.replace("Z", "+00:00"))
+			except ValueError:
+				return None
+
+		if expires.tzinfo is None:
+			expires = expires.replace(tzinfo=timezone.utc)
+
+		return expires
+
+	def expire(self, expired):
+		""" Removes expired subscriptions from the match set.
+
+		expired holds the (tenant, subscription id) keys of the
+		subscriptions that expired.
+		"""
+
+		with self.lock:
+			active = dict(self.subscriptions)
+			for service, subscription in expired:
+				if subscription in active.get(service, {}):
+					active[service] = dict(active[service])
+					del active[service][subscription]
+			self.subscriptions = active
+
+		for service, subscription in expired:
+			self.expired += 1
+			with self.mongodb.using(service):
+				self.delivery.record(subscription, {"status": "expired"})
+
+		self.helpers.logger.info(self.program + " " + str(len(expired)) +
+								" subscriptions expired.")
+
+	def throttle(self, subscription, entity):
+		""" Checks the throttling of a subscription for an entity. """
+
+		throttling = subscription.get("throttling")
+		if not throttling:
+			return False
+
+		# Subscription ids are only unique within a tenant
+		key = (current(), subscription["id"], entity.get("id"))
+		now = time.monotonic()
+
+		last = self.throttles.get(key)
+		if last is not None and now - last < throttling:
+			self.throttled += 1
+			return True
+
+		self.throttles[key] = now
+		self.throttles.move_to_end(key)
+		while len(self.throttles) > self.confs["throttles"]:
+			self.throttles.popitem(last=False)
+
+		return False
+
+	def listen(self, listener):
+		""" Registers a function called with every entity change, in the
+		tenant of the change, after the subscriptions are notified. """
+
+		self.listeners.append(listener)
+
+	def changed(self, entity, attrs=None):
+		""" Queues an entity change for notification.
+
+		attrs is the list of attributes that changed, or None if the
+		whole entity changed.
+		"""
+
+		try:
+			self.changes.put_nowait((current(), entity, attrs, self.tracing.carry()))
+		except queue.Full:
+			self.dropped += 1
+			if self.dropped % 1000 == 1:
+				self.helpers.logger.warning(self.program + " change queue full, " +
+											str(self.dropped) + " changes dropped.")
+
+	def dispatch(self):
+		""" Processes queued entity changes. """
+
+		while True:
+			change = self.changes.get()
+
+			try:
+				if time.time() - self.loaded > self.confs["refresh"]:
+					self.reload()
+				elif self.dirty:
+					self.update()
+				if change is None:
+					continue
+				service, entity, attrs, carried = change
+				with self.mongodb.using(service), \
+						self.tracing.resume(carried, "notify", entity=entity.get("id")):
+					self.process(entity, attrs)
+					for listener in self.listeners:
+						listener(entity, attrs)
+			except Exception as e:
+				self.helpers.logger.error(self.program + " dispatch error: " + str(e))
+
+	def process(self, entity, attrs):
+		""" Notifies the subscriptions matching an entity change.
+
+		Matching subscriptions are grouped by rendering format so that
+		each distinct representation of the entity is serialized once
+		and shared by all the notifications of the group.
+		"""
+
+		groups = {}
+		for subscription in self.matching(entity, attrs):
+			if self.throttle(subscription, entity):
+				continue
+			key = self.renderKey(subscription.get("notification", {}))
+			groups.setdefault(key, []).append(subscription)
+
+		for key, subscriptions in groups.items():
+			data = self.render(subscriptions[0], entity)
+			self.rendered += 1
+			for subscription in subscriptions:
+				self.delivery.enqueue(subscription, data)
+				self.notified += 1
+
+	def matching(self, entity, attrs):
+		""" Gets the subscriptions matching an entity change. """
+
+		return [subscription for subscription in self.subscriptions.get(current(), {}).values()
+					if self.matches(subscription, entity, attrs)]
+
+	def pattern(self, expression):
+		""" Gets a compiled id or type pattern. """
+
+		if expression not in self.patterns:
+			self.patterns[expression] = re.compile(expression)
+		return self.patterns[expression]
+
+	def matchesEntity(self, selector, entity):
+		""" Checks an entity against a subscription entity selector. """
+
+		if "id" in selector and selector["id"] != entity.get("id"):
+			return False
+		if "idPattern" in selector and not self.pattern(
+				selector["idPattern"]).fullmatch(str(entity.get("id"))):
+			return False
+		if "type" in selector and selector["type"] != entity.get("type"):
+			return False
+		if "typePattern" in selector and not self.pattern(
+				selector["typePattern"]).fullmatch(str(entity.get("type"))):
+			return False
+
+		return True
+
+	def matches(self, subscription, entity, attrs):
+		""" Checks an entity change against a subscription. """
+
+		subject = subscription.get("subject", {})
+
+		if not self.mongodb.inPath(subscription.get("servicePath", "/#"), entity):
+			return False
+
+		if not any(self.matchesEntity(selector, entity)
+					for selector in subject.get("entities", [])):
+			return False
+
+		condition = subject.get("condition", {})
+
+		conditionAttrs = condition.get("attrs", [])
+		if conditionAttrs and attrs is not None and not set(conditionAttrs) & set(attrs):
+			return False
+
+		q = condition.get("expression", {}).get("q")
+		if q and not self.query(q, entity):
+			return False
+
+		return True
+
+	def cast(self, value):
+		""" Casts a query value as float where possible. """
+
+		try:
+			return float(value)
+		except ValueError:
+			return value.strip("'")
+
+	def value(self, entity, path):
+		""" Gets the value of an attribute path of an entity. """
+
+		parts = path.split(".")
+		value = entity.get(parts[0])
+		if isinstance(value, dict) and "value" in value and len(parts) == 1:
+			return value["value"]
+
+		for part in parts[1:]:
+			if not isinstance(value, dict):
+				return None
+			value = value.get(part)
+
+		return value
+
+	def compare(self, value, operator, expected):
+		""" Compares an attribute value to a query value. """
+
+		if value is None:
+			return operator == "!="
+
+		if isinstance(expected, float) and not isinstance(value, bool):
+			try:
+				value = float(value)
+			except (TypeError, ValueError):
+				return operator == "!="
+
+		try:
+			if operator in ["==", ":"]:
+				return value == expected
+			if operator == "!=":
+				return value != expected
+			if operator == ">=":
+				return value >= expected
+			if operator == "<=":
+				return value <= expected
+			if operator == ">":
+				return value > expected
+			if operator == "<":
+				return value < expected
+		except TypeError:
+			return False
+
+		return False
+
+	def query(self, q, entity):
+		""" Evaluates a Simple Query Language expression on an entity. """
+
+		for statement in q.split(";"):
+			statement = statement.strip()
+			for operator in ["==", "!=", ">=", "<=", ">", "<", ":"]:
+				if operator in statement:
+					path, expected = statement.split(operator, 1)
+					if not self.compare(self.value(entity, path), operator, self.cast(expected)):
+						return False
+					break
+			else:
+				if statement.startswith("!"):
+					if statement[1:] in entity:
+						return False
+				elif statement not in entity:
+					return False
+
+		return True
+
+	def format(self, notification, entity):
+		""" Renders an entity in the format of a subscription. """
+
+		attrs = notification.get("attrs", [])
+		exceptAttrs = notification.get("exceptAttrs", [])
+		attrsFormat = notification.get("attrsFormat", "normalized")
+
+		data = {}
+		for attr in entity:
+			if attr in ["_id", "servicePath"] or attr in exceptAttrs:
+				continue
+			if attrs and attr not in attrs and attr not in ["id", "type"]:
+				continue
+			data[attr] = entity[attr]
+
+		if attrsFormat == "keyValues":
+			data = {attr: value["value"] if isinstance(value, dict) and "value" in value
+						else value for attr, value in data.items()}
+		elif attrsFormat == "values":
+			data = [value["value"] if isinstance(value, dict) and "value" in value
+						else value for attr, value in data.items() if attr not in ["id", "type"]]
+
+		return data
+
+	def renderKey(self, notification):
+		""" Gets the key of the rendering format of a notification. """
+
+		return (notification.get("attrsFormat", "normalized"),
+				tuple(sorted(notification.get("attrs", []))),
+				tuple(sorted(notification.get("exceptAttrs", []))))
+
+	def render(self, subscription, entity):
+		""" Serializes an entity in the format of a subscription. """
+
+		return json_util.dumps(self.format(
+			subscription.get("notification", {}), entity)).encode("utf-8")
+
+	def getCounters(self):
+		""" Gets the notification counters. """
+
+		counters = self.delivery.getCounters()
+		counters["changesQueued"] = self.changes.qsize()
+		counters["changesDropped"] = self.dropped
+		counters["rendered"] = self.rendered
+		counters["notified"] = self.notified
+		counters["throttled"] = self.throttled
+		counters["expired"] = self.expired
+		counters["subscriptions"] = sum(len(active) for active in self.subscriptions.values())
+		counters["expiring"] = len(self.expiry)
+
+		return counters
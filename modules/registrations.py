@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+""" HIASCDI Registrations Module.
+
+This module provides the functionality to retrieve, create, update
+and delete HIASCDI registrations of external context providers.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import sys
+import uuid
+
+
+class registrations():
+	""" HIASCDI Registrations Module.
+
+	This module provides the functionality to retrieve, create, update
+	and delete HIASCDI registrations of external context providers.
+	"""
+
+	def __init__(self, helpers, mongodb, broker):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Registrations Module"
+
+		self.mongodb = mongodb
+		self.broker = broker
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def valid(self, data):
+		""" Checks a registration names a provider URL and the entities
+		it provides. """
+
+		provider = data.get("provider")
+		provided = data.get("dataProvided")
+
+		if not isinstance(provider, dict) or not isinstance(provider.get("http"), dict) \
+				or not provider["http"].get("url"):
+			return False
+		if not isinstance(provided, dict) or not isinstance(provided.get("entities"), list) \
+				or not len(provided["entities"]):
+			return False
+
+		return all(isinstance(selector, dict) and ("id" in selector or "idPattern" in selector)
+					for selector in provided["entities"])
+
+	def getRegistrations(self, arguments, accepted=[]):
+		""" Gets registration data from the MongoDB.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Registrations
+					- Registration list
+						- List Registrations
+		"""
+
+		count_opt = False
+
+		query = {}
+		headers = {}
+
+		# Removes the MongoDB ID
+		fields = {
+			'_id': False
+		}
+
+		# Processes the options parameter
+		options = arguments.get('options') if arguments.get(
+			'options') is not None else None
+		if options is not None:
+			options = options.split(",")
+			for option in options:
+				count_opt = True if option == "count" else count_opt
+
+		# Prepares the offset
+		if arguments.get('offset') is None:
+			offset = 0
+		else:
+			offset = int(arguments.get('offset'))
+
+		# Prepares the query limit
+		if arguments.get('limit') is None:
+			limit = 0
+		else:
+			limit = int(arguments.get('limit'))
+
+		registrations = self.mongodb.mongoConn.Registrations.find(
+			query, fields).skip(offset).limit(limit)
+
+		if count_opt:
+			# Sets count header
+			headers["Count"] = self.broker.counts.count("Registrations", query)
+
+		return self.broker.respond(200, registrations, headers, False, accepted)
+
+	def createRegistration(self, data, accepted=[]):
+		""" Creates a new HIASCDI Registration.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Registrations
+					- Registration list
+						- Create Registration
+		"""
+
+		if not self.valid(data):
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"], {},
+								False, accepted)
+
+		newData = {"id": str(uuid.uuid4())}
+		newData.update(data)
+		data = newData
+
+		data.setdefault("status", "active")
+		data["forwardingInformation"] = {"timesSent": 0}
+
+		# Only queries under the registration's service path are forwarded
+		data["servicePath"] = self.broker.tenants.queryPath()
+
+		try:
+			self.mongodb.mongoConn.Registrations.insert(data)
+			self.broker.counts.clear("Registrations")
+			self.broker.forwarding.reload()
+			self.broker.invalidation.registrations()
+			return self.broker.respond(201, {}, {"Location": "v1/registrations/" + data["id"]},
+								False, accepted)
+		except:
+			e = sys.exc_info()
+			self.helpers.logger.info("Mongo data inserted FAILED!")
+			self.helpers.logger.info(str(e))
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"], {},
+								False, accepted)
+
+	def getRegistration(self, registration, accepted=[]):
+		""" Gets registration data from the MongoDB.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Registrations
+					- Registration By ID
+						- Retrieve Registration
+		"""
+
+		# Removes the MongoDB ID
+		fields = {
+			'_id': False
+		}
+
+		reg = self.mongodb.mongoConn.Registrations.find_one({'id': registration}, fields)
+
+		if reg is None:
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
+
+		return self.broker.respond(200, reg, {}, False, accepted)
+
+	def updateRegistration(self, registration, data, accepted=[]):
+		""" Updates registration data in MongoDB.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Registrations
+					- Registration By ID
+						- Update Registration
+		"""
+
+		update = {key: value for key, value in data.items()
+					if key not in ["id", "servicePath", "forwardingInformation"]}
+
+		if not len(update):
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
+								{}, False, accepted)
+
+		current = self.mongodb.mongoConn.Registrations.find_one({"id": registration},
+															{"_id": False})
+		if current is None:
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
+
+		updated = dict(current)
+		updated.update(update)
+		if not self.valid(updated):
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"],
+								{}, False, accepted)
+
+		self.mongodb.mongoConn.Registrations.update_one({"id": registration},
+					{"$set": update})
+		self.broker.forwarding.reload()
+		self.broker.invalidation.registrations()
+
+		return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
+							{}, False, accepted)
+
+	def deleteRegistration(self, registration, accepted=[]):
+		""" Deletes registration data from MongoDB.
+
+		References:
+			FIWARE-NGSI v2 Specification
+			https://fiware.github.io/specifications/ngsiv2/stable/
+
+			Reference
+				- Registrations
+					- Registration By ID
+						- Delete Registration
+		"""
+
+		result = self.mongodb.mongoConn.Registrations.delete_one({"id": registration})
+
+		if result.deleted_count == 1:
+			self.broker.counts.clear("Registrations")
+			self.broker.forwarding.reload()
+			self.broker.invalidation.registrations()
+			self.helpers.logger.info("Mongo data delete OK")
+			return self.broker.respond(204, {}, {}, False, accepted)
+		else:
+			self.helpers.logger.info("Mongo data delete FAILED")
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
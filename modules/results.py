@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+""" HIASCDI Results Module.
+
+This module caches the responses of HIASCDI entity list queries.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from components.hiascdi.modules.tenants import tenant
+
+
+class results():
+	""" HIASCDI Results Module.
+
+	This module caches the responses of HIASCDI entity list queries.
+
+	Responses are cached as the bytes sent to the client, keyed by a
+	normalized form of the query, so that the same filters in another
+	order share an entry. Entries are indexed by the types they may
+	include, a write to a type evicts the queries on that type and the
+	queries on any type. Entries expire after the TTL and the least
+	recently used are evicted to keep the cache within its size.
+
+	Every write bumps a generation of its type, a query only stores its
+	response if no write to its types happened while it ran, so that
+	reads racing a write never cache the old entities.
+	"""
+
+	# Parameters whose comma or semicolon separated items are unordered
+	unordered = {"type": ",", "id": ",", "category": ",", "attrs": ",",
+					"metadata": ",", "options": ",", "q": ";", "mq": ";"}
+
+	# Parameters of the entity list query
+	parameters = ["type", "typePattern", "id", "idPattern", "category", "attrs",
+					"metadata", "q", "mq", "georel", "geometry", "coords", "values",
+					"orderBy", "offset", "limit", "options"]
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Results Module"
+
+		self.confs = self.helpers.confs["results"]
+
+		self.entries = OrderedDict()
+		self.scopes = {}
+		self.generations = {}
+		self.size = 0
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.evicted = 0
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def key(self, arguments, accepted):
+		""" Builds the cache key of a list query.
+
+		Returns None if the query is not cached.
+		"""
+
+		if not self.confs["enabled"]:
+			return None
+
+		parts = []
+		for name in self.parameters:
+			value = arguments.get(name)
+			if value is None:
+				continue
+			separator = self.unordered.get(name)
+			if separator is not None:
+				value = separator.join(sorted(item.strip() for item in value.split(separator)))
+			parts.append((name, value.strip()))
+
+		service, paths = tenant.get()
+		form = "json" if "application/json" in accepted else \
+			"text" if "text/plain" in accepted else "json"
+
+		return (service, tuple(sorted(paths)), form, tuple(parts))
+
+	def scope(self, types):
+		""" Gets the scopes of a query, None stands for any type. """
+
+		return [None] if types is None else list(dict.fromkeys(types))
+
+	def generation(self, types):
+		""" Gets the write generations of the scopes of a query. """
+
+		service = tenant.get()[0]
+
+		with self.lock:
+			if types is None:
+				return self.generations.get((service, None), 0)
+			return tuple(self.generations.get((service, typeof), 0) for typeof in types)
+
+	def get(self, key):
+		""" Gets a cached response if still fresh. """
+
+		now = time.monotonic()
+
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and now - entry["stored"] < self.confs["ttl"]:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+			if entry is not None:
+				self.remove(key)
+			self.misses += 1
+
+		return None
+
+	def revalidate(self, conditions):
+		""" Checks if a request asks to bypass the cached responses. """
+
+		return "no-cache" in (conditions or {}).get("Cache-Control", "")
+
+	def put(self, key, types, generation, response, modified):
+		""" Caches a response if no write to its types happened meanwhile. """
+
+		body = response.get_data()
+		if len(body) > self.confs["maxEntry"]:
+			return
+
+		service = key[0]
+		if self.generation(types) != generation:
+			return
+
+		with self.lock:
+			if key in self.entries:
+				self.remove(key)
+			self.entries[key] = {
+				"stored": time.monotonic(),
+				"status": response.status_code,
+				"body": body,
+				"headers": dict(response.headers),
+				"mimetype": response.mimetype,
+				"modified": modified,
+				"scopes": self.scope(types)
+			}
+			for scope in self.scope(types):
+				self.scopes.setdefault((service, scope), set()).add(key)
+			self.size += len(body)
+
+			while self.size > self.confs["maxBytes"] and len(self.entries):
+				self.remove(next(iter(self.entries)))
+				self.evicted += 1
+
+	def remove(self, key):
+		""" Removes an entry, the lock must be held. """
+
+		entry = self.entries.pop(key)
+		self.size -= len(entry["body"])
+		for scope in entry["scopes"]:
+			keys = self.scopes.get((key[0], scope))
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self.scopes[(key[0], scope)]
+
+	def written(self, typeof=None):
+		""" Evicts the queries that may include a written type.
+
+		None evicts every query of the current tenant.
+		"""
+
+		service = tenant.get()[0]
+
+		with self.lock:
+			self.generations[(service, None)] = self.generations.get((service, None), 0) + 1
+			if typeof is None:
+				for key in [key for key in self.entries if key[0] == service]:
+					self.remove(key)
+				for scope in [scope for scope in self.generations if scope[0] == service]:
+					self.generations[scope] += 1
+				return
+
+			self.generations[(service, typeof)] = self.generations.get((service, typeof), 0) + 1
+			for scope in [typeof, None]:
+				for key in list(self.scopes.get((service, scope), ())):
+					self.remove(key)
+
+	def flush(self):
+		""" Evicts every query. """
+
+		with self.lock:
+			self.entries.clear()
+			self.scopes.clear()
+			self.size = 0
+			for scope in self.generations:
+				self.generations[scope] += 1
+
+	def getCounters(self):
+		""" Gets the cache counters. """
+
+		with self.lock:
+			return {
+				"entries": len(self.entries),
+				"bytes": self.size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evicted": self.evicted
+			}
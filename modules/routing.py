@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" HIASCDI Routing Module.
+
+This module chooses the replica set members HIASCDI reads from.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
+
+from components.hiascdi.modules.tenants import current
+
+
+class routing():
+	""" HIASCDI Routing Module.
+
+	This module chooses the replica set members HIASCDI reads from.
+
+	List and aggregation reads go to the configured read preference,
+	usually the secondaries, so that dashboards do not compete with
+	device writes on the primary. Single entity reads may go to the
+	secondaries too, except for entities this worker wrote within the
+	maximum staleness, which are read from the primary so that clients
+	always read their own writes.
+	"""
+
+	modes = {
+		"primaryPreferred": PrimaryPreferred,
+		"secondary": Secondary,
+		"secondaryPreferred": SecondaryPreferred,
+		"nearest": Nearest
+	}
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Routing Module"
+
+		self.confs = self.helpers.confs["routing"]
+
+		self.lists = self.preference(self.confs["lists"])
+		self.entities = self.preference(self.confs["entities"])
+
+		self.writes = OrderedDict()
+		self.horizon = 0
+		self.lock = threading.Lock()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def preference(self, mode):
+		""" Builds a read preference, None reads from the primary. """
+
+		if mode == "primary":
+			return None
+
+		return self.modes[mode](max_staleness=self.confs["maxStaleness"])
+
+	def list(self):
+		""" Gets the read preference of list and aggregation reads. """
+
+		return self.lists
+
+	def entity(self, _id):
+		""" Gets the read preference of a single entity read. """
+
+		if self.entities is None:
+			return None
+
+		now = time.monotonic()
+		if now < self.horizon:
+			return None
+
+		written = self.writes.get((current(), _id))
+		if written is not None and now - written < self.confs["maxStaleness"]:
+			return None
+
+		return self.entities
+
+	def written(self, _id):
+		""" Records a write to an entity so it is read from the primary.
+
+		When the record is full the oldest writes are dropped, if they
+		are still within the staleness window every entity is read from
+		the primary until it closes.
+		"""
+
+		if self.entities is None:
+			return
+
+		now = time.monotonic()
+		key = (current(), _id)
+
+		with self.lock:
+			self.writes[key] = now
+			self.writes.move_to_end(key)
+			while len(self.writes) > self.confs["writes"]:
+				_, oldest = self.writes.popitem(last=False)
+				if now - oldest < self.confs["maxStaleness"]:
+					self.horizon = max(self.horizon, oldest + self.confs["maxStaleness"])
+
+	def flush(self):
+		""" Reads every entity from the primary for the staleness window,
+		used when writes made by other workers may have been missed. """
+
+		if self.entities is None:
+			return
+
+		with self.lock:
+			self.writes.clear()
+			self.horizon = max(self.horizon, time.monotonic() + self.confs["maxStaleness"])
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+""" HIASCDI Schemas Module.
+
+This module validates entities against the attribute schemas of
+their types.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import re
+import threading
+import time
+
+from datetime import datetime
+
+from components.hiascdi.modules.tenants import current
+
+
+class schemas():
+	""" HIASCDI Schemas Module.
+
+	This module validates entities against the attribute schemas of
+	their types.
+
+	A type in the Types collection may carry a schema describing its
+	attributes. Schemas are compiled once into validator functions
+	made of plain type checks and comparisons, so validating a write
+	costs a few function calls per attribute. Validators are cached
+	per tenant and type, invalidated when the type is updated and
+	reloaded after the refresh interval so that schema changes made
+	through other workers are picked up.
+	"""
+
+	# Attributes managed by the broker, never validated
+	builtin = ["_id", "id", "type", "servicePath", "dateCreated", "dateModified", "dateExpired"]
+
+	def __init__(self, helpers, mongodb):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Schemas Module"
+
+		self.mongodb = mongodb
+
+		self.confs = self.helpers.confs["schemas"]
+
+		self.validators = {}
+		self.lock = threading.Lock()
+
+		self.validated = 0
+		self.rejected = 0
+
+		self.kinds = {
+			"Number": self.number,
+			"Integer": self.integer,
+			"Text": self.text,
+			"String": self.text,
+			"Boolean": self.boolean,
+			"DateTime": self.dateTime,
+			"geo:json": self.geojson,
+			"StructuredValue": self.structured,
+			"Array": self.array
+		}
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def number(self, value):
+		""" Checks a Number value. """
+
+		return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+	def integer(self, value):
+		""" Checks an Integer value. """
+
+		return isinstance(value, int) and not isinstance(value, bool)
+
+	def text(self, value):
+		""" Checks a Text value. """
+
+		return isinstance(value, str)
+
+	def boolean(self, value):
+		""" Checks a Boolean value. """
+
+		return isinstance(value, bool)
+
+	def dateTime(self, value):
+		""" Checks an ISO8601 DateTime value. """
+
+		if not isinstance(value, str):
+			return False
+		try:
+			datetime.fromisoformat(value.replace("Z", "+00:00"))
+		except ValueError:
+			return False
+		return True
+
+	def geojson(self, value):
+		""" Checks a GeoJSON geometry value. """
+
+		return isinstance(value, dict) and isinstance(value.get("type"), str) and \
+			("coordinates" in value or "geometries" in value)
+
+	def structured(self, value):
+		""" Checks a StructuredValue value. """
+
+		return isinstance(value, (dict, list))
+
+	def array(self, value):
+		""" Checks an Array value. """
+
+		return isinstance(value, list)
+
+	def valueCheck(self, attr, spec):
+		""" Compiles the value checks of an attribute schema. """
+
+		checks = []
+
+		typeof = spec.get("type")
+		if typeof in self.kinds:
+			kind = self.kinds[typeof]
+			checks.append((kind, attr + " must be a " + typeof + " value"))
+
+		if "enum" in spec:
+			allowed = list(spec["enum"])
+			checks.append((lambda value: value in allowed,
+						attr + " must be one of " + ", ".join(str(value) for value in allowed)))
+		if "minimum" in spec:
+			minimum = float(spec["minimum"])
+			checks.append((lambda value: self.number(value) and value >= minimum,
+						attr + " must be at least " + str(spec["minimum"])))
+		if "maximum" in spec:
+			maximum = float(spec["maximum"])
+			checks.append((lambda value: self.number(value) and value <= maximum,
+						attr + " must be at most " + str(spec["maximum"])))
+		if "minLength" in spec:
+			shortest = int(spec["minLength"])
+			checks.append((lambda value: isinstance(value, (str, list)) and len(value) >= shortest,
+						attr + " must have a length of at least " + str(shortest)))
+		if "maxLength" in spec:
+			longest = int(spec["maxLength"])
+			checks.append((lambda value: isinstance(value, (str, list)) and len(value) <= longest,
+						attr + " must have a length of at most " + str(longest)))
+		if "pattern" in spec:
+			pattern = re.compile(spec["pattern"])
+			checks.append((lambda value: isinstance(value, str) and pattern.search(value) is not None,
+						attr + " must match " + spec["pattern"]))
+
+		nullable = spec.get("nullable", False)
+
+		def check(value):
+			if value is None:
+				return None if nullable else attr + " must not be null"
+			for passes, error in checks:
+				if not passes(value):
+					return error
+			return None
+
+		return check
+
+	def attributeCheck(self, attr, spec, checkValue):
+		""" Compiles the check of a normalized attribute. """
+
+		typeof = spec.get("type")
+
+		def check(data):
+			if not isinstance(data, dict) or "value" not in data:
+				return attr + " must be an object with a value"
+			if typeof is not None and "type" in data and data["type"] != typeof:
+				return attr + " must be of type " + typeof
+			return checkValue(data["value"])
+
+		return check
+
+	def compile(self, schema):
+		""" Compiles a type schema into a validator function.
+
+		The validator takes the attributes of an entity and returns an
+		error message or None. Partial validation skips the required
+		attributes, keyValues validation checks bare values.
+		"""
+
+		if not isinstance(schema, dict) or not isinstance(schema.get("attrs", {}), dict):
+			raise ValueError("schema must be an object with an attrs object")
+
+		values = {}
+		attributes = {}
+		required = []
+		for attr, spec in schema.get("attrs", {}).items():
+			if not isinstance(spec, dict):
+				raise ValueError("schema of " + attr + " must be an object")
+			values[attr] = self.valueCheck(attr, spec)
+			attributes[attr] = self.attributeCheck(attr, spec, values[attr])
+			if spec.get("required", False):
+				required.append(attr)
+
+		additional = schema.get("additionalAttrs", True)
+		builtin = set(self.builtin)
+
+		def validate(entity, partial=False, keyValues=False):
+			if not partial:
+				for attr in required:
+					if attr not in entity:
+						return attr + " is required"
+
+			checks = values if keyValues else attributes
+			for attr, data in entity.items():
+				check = checks.get(attr)
+				if check is not None:
+					error = check(data)
+					if error is not None:
+						return error
+				elif not additional and attr not in builtin:
+					return attr + " is not an attribute of this type"
+
+			return None
+
+		validate.values = values
+		validate.attributes = attributes
+		validate.required = required
+
+		return validate
+
+	def check(self, schema):
+		""" Checks a schema compiles, returns the error or None. """
+
+		try:
+			self.compile(schema)
+		except (ValueError, TypeError, re.error) as e:
+			return str(e)
+
+		return None
+
+	def validator(self, typeof):
+		""" Gets the compiled validator of a type, None if it has no schema. """
+
+		key = (current(), typeof)
+		cached = self.validators.get(key)
+		if cached is not None and time.monotonic() - cached[0] < self.confs["refresh"]:
+			return cached[1]
+
+		entry = self.mongodb.mongoConn.Types.find_one({"type": typeof}, {"_id": False, "schema": True})
+		schema = entry.get("schema") if entry is not None else None
+
+		validate = None
+		if schema is not None:
+			try:
+				validate = self.compile(schema)
+			except (ValueError, TypeError, re.error) as e:
+				self.helpers.logger.error(self.program + " schema of " + typeof +
+											" not compiled: " + str(e))
+
+		with self.lock:
+			self.validators[key] = (time.monotonic(), validate)
+			while len(self.validators) > self.confs["cacheSize"]:
+				del self.validators[next(iter(self.validators))]
+
+		return validate
+
+	def invalidate(self, typeof):
+		""" Drops the cached validator of a type. """
+
+		with self.lock:
+			self.validators.pop((current(), typeof), None)
+
+	def flush(self):
+		""" Drops every cached validator. """
+
+		with self.lock:
+			self.validators.clear()
+
+	def counted(self, error):
+		""" Counts a validation result. """
+
+		self.validated += 1
+		if error is not None:
+			self.rejected += 1
+
+		return error
+
+	def validate(self, typeof, entity, partial=False, keyValues=False):
+		""" Validates entity attributes against the schema of their type.
+
+		Returns the first error found or None.
+		"""
+
+		validate = self.validator(typeof)
+		if validate is None:
+			return None
+
+		return self.counted(validate(entity, partial, keyValues))
+
+	def validateAttribute(self, typeof, attr, data, is_value=False):
+		""" Validates an attribute or attribute value update. """
+
+		validate = self.validator(typeof)
+		if validate is None:
+			return None
+
+		checks = validate.values if is_value else validate.attributes
+		if attr not in checks:
+			return self.counted(validate({attr: data}, True, is_value))
+
+		return self.counted(checks[attr](data))
+
+	def removable(self, typeof, attr):
+		""" Checks an attribute may be deleted, returns the error or None. """
+
+		validate = self.validator(typeof)
+		if validate is None or attr not in validate.required:
+			return None
+
+		return self.counted(attr + " is required")
+
+	def getCounters(self):
+		""" Gets the validation counters. """
+
+		return {
+			"validated": self.validated,
+			"rejected": self.rejected,
+			"cached": len(self.validators)
+		}
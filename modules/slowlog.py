@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+""" HIASCDI Slow Query Log Module.
+
+This module records the MongoDB operations of HIASCDI that take
+longer than a threshold, with their query plans.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import queue
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timezone
+
+from pymongo import monitoring
+
+
+class recorder(monitoring.CommandListener):
+	""" HIASCDI MongoDB Slow Query Listener.
+
+	Feeds MongoDB command events to the slow query log.
+	"""
+
+	def __init__(self, slowlog):
+		""" Initializes the class. """
+
+		self.slowlog = slowlog
+
+	def started(self, event):
+		self.slowlog.started(event)
+
+	def succeeded(self, event):
+		self.slowlog.finished(event, event.reply)
+
+	def failed(self, event):
+		self.slowlog.finished(event, None, event.failure)
+
+
+class slowlog():
+	""" HIASCDI Slow Query Log Module.
+
+	This module records the MongoDB operations of HIASCDI that take
+	longer than a threshold, with their query plans.
+
+	Commands are timed by a MongoDB command listener. Slow ones are
+	recorded with the shape of their filter, projection and sort, with
+	values replaced by ?, and the number of documents returned. Reads
+	are explained on a background thread to add the winning plan and
+	the documents and keys examined, each query shape at most once per
+	explain interval. Records are kept in a ring buffer and, if set,
+	in a capped collection shared by every worker.
+	"""
+
+	# Commands that are timed
+	commands = ["find", "aggregate", "count", "distinct", "update", "delete",
+				"findAndModify", "insert"]
+
+	# Commands that can be explained without side effects
+	explainable = ["find", "aggregate", "count", "distinct"]
+
+	# Command fields that are recorded
+	fields = ["filter", "query", "projection", "sort", "skip", "limit", "pipeline"]
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Slow Query Log Module"
+
+		self.confs = self.helpers.confs["slowQueries"]
+
+		self.mongodb = None
+		self.pending = {}
+		self.records = deque(maxlen=self.confs["buffer"])
+		self.slow = queue.Queue(maxsize=self.confs["queue"])
+		self.plans = {}
+		self.dropped = 0
+
+		if self.confs["enabled"]:
+			# Must be registered before the MongoDB client is created
+			monitoring.register(recorder(self))
+			threading.Thread(target=self.work, daemon=True).start()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def attach(self, mongodb):
+		""" Sets the MongoDB connection used to explain and store slow queries. """
+
+		self.mongodb = mongodb
+
+		if self.confs["enabled"] and self.confs["collectionSize"]:
+			database = self.mongodb.database("")
+			try:
+				if "SlowQueries" not in database.list_collection_names():
+					database.create_collection("SlowQueries", capped=True,
+												size=self.confs["collectionSize"])
+			except Exception as e:
+				self.helpers.logger.warning(self.program + " SlowQueries not created: " + str(e))
+
+	def started(self, event):
+		""" Keeps the command of a timed operation until it finishes. """
+
+		if event.command_name not in self.commands:
+			return
+		if event.command.get(event.command_name) == "SlowQueries":
+			return
+
+		self.pending[(event.connection_id, event.request_id)] = event.command
+
+	def finished(self, event, reply, failure=None):
+		""" Queues a finished operation for recording if it was slow. """
+
+		command = self.pending.pop((event.connection_id, event.request_id), None)
+		if command is None:
+			return
+
+		duration = event.duration_micros / 1000.0
+		if duration < self.confs["threshold"]:
+			return
+
+		try:
+			self.slow.put_nowait((event.database_name, event.command_name, command,
+									duration, reply, failure))
+		except queue.Full:
+			self.dropped += 1
+			if self.dropped % 1000 == 1:
+				self.helpers.logger.warning(self.program + " queue full, " +
+											str(self.dropped) + " slow operations dropped.")
+
+	def shape(self, value):
+		""" Replaces the values of a filter with ?, keeping its operators. """
+
+		if isinstance(value, dict):
+			return {key: self.shape(item) for key, item in value.items()}
+		if isinstance(value, (list, tuple)):
+			shapes = []
+			for item in value:
+				item = self.shape(item)
+				if item not in shapes:
+					shapes.append(item)
+			return shapes
+
+		return "?"
+
+	def returned(self, name, reply):
+		""" Gets the number of documents an operation returned or changed. """
+
+		if reply is None:
+			return None
+		if "cursor" in reply:
+			return len(reply["cursor"].get("firstBatch", []))
+		if "values" in reply:
+			return len(reply["values"])
+
+		return reply.get("n")
+
+	def record(self, database, name, command, duration, reply, failure):
+		""" Builds the record of a slow operation. """
+
+		record = {
+			"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+			"database": database,
+			"collection": command.get(name),
+			"operation": name,
+			"duration": round(duration, 3),
+			"returned": self.returned(name, reply)
+		}
+
+		for field in self.fields:
+			if field not in command:
+				continue
+			if field in ["filter", "query", "pipeline"]:
+				record[field] = self.shape(command[field])
+			elif field in ["skip", "limit"]:
+				record[field] = command[field]
+			else:
+				record[field] = dict(command[field])
+
+		for statement in ["updates", "deletes"]:
+			if statement in command and len(command[statement]):
+				record["filter"] = self.shape(command[statement][0].get("q", {}))
+				record["statements"] = len(command[statement])
+
+		if failure is not None:
+			record["error"] = failure.get("errmsg", str(failure))
+
+		return record
+
+	def explain(self, database, name, command, record):
+		""" Adds the winning plan and examined documents of a read.
+
+		The plan of a query shape is reused for the explain interval.
+		"""
+
+		key = str((database, record["collection"], name, record.get("filter"),
+					record.get("pipeline"), record.get("sort")))
+		now = time.monotonic()
+
+		cached = self.plans.get(key)
+		if cached is None or now - cached[0] > self.confs["explainInterval"]:
+			explained = {key: value for key, value in command.items()
+							if not key.startswith("$") and key not in ["lsid", "txnNumber", "maxTimeMS"]}
+			result = self.mongodb.database("").client[database].command(
+				{"explain": explained, "verbosity": "executionStats"})
+			cached = (now, self.summary(result))
+			self.plans[key] = cached
+			while len(self.plans) > self.confs["plans"]:
+				del self.plans[next(iter(self.plans))]
+
+		record.update(cached[1])
+
+	def planner(self, result):
+		""" Finds the planner and execution stats of an explain result. """
+
+		if "queryPlanner" in result:
+			return result
+		for stage in result.get("stages", []):
+			if "$cursor" in stage:
+				return stage["$cursor"]
+
+		return {}
+
+	def stages(self, plan):
+		""" Describes a plan as its stages, e.g. FETCH > IXSCAN type_1. """
+
+		stages = []
+		while plan:
+			stage = plan.get("stage", "?")
+			if "indexName" in plan:
+				stage += " " + plan["indexName"]
+			stages.append(stage)
+			inputs = plan.get("inputStages") or [plan.get("inputStage")]
+			if len(inputs) > 1:
+				stages.append("(" + ", ".join(" > ".join(self.stages(item)) for item in inputs) + ")")
+				break
+			plan = inputs[0]
+
+		return stages
+
+	def summary(self, result):
+		""" Summarizes an explain result. """
+
+		planner = self.planner(result)
+		winning = planner.get("queryPlanner", {}).get("winningPlan", {})
+		stats = planner.get("executionStats", {})
+
+		return {
+			"plan": " > ".join(self.stages(winning.get("queryPlan", winning))),
+			"docsExamined": stats.get("totalDocsExamined"),
+			"keysExamined": stats.get("totalKeysExamined"),
+			"planReturned": stats.get("nReturned")
+		}
+
+	def work(self):
+		""" Records the queued slow operations. """
+
+		while True:
+			database, name, command, duration, reply, failure = self.slow.get()
+
+			record = self.record(database, name, command, duration, reply, failure)
+
+			if self.mongodb is not None and self.confs["explain"] and name in self.explainable:
+				try:
+					self.explain(database, name, command, record)
+				except Exception as e:
+					self.helpers.logger.error(self.program + " explain error: " + str(e))
+
+			self.records.append(record)
+			self.helpers.logger.warning(self.program + " " + name + " on " +
+										str(record["collection"]) + " took " +
+										str(record["duration"]) + "ms.")
+
+			if self.mongodb is not None and self.confs["collectionSize"]:
+				try:
+					self.mongodb.database("").SlowQueries.insert_one(dict(record))
+				except Exception as e:
+					self.helpers.logger.error(self.program + " store error: " + str(e))
+
+	def getQueries(self, limit, collection=None):
+		""" Gets the most recent slow operations, newest first.
+
+		Reads the capped collection if there is one, so that the slow
+		operations of every worker are included.
+		"""
+
+		if self.mongodb is not None and self.confs["collectionSize"]:
+			query = {} if collection is None else {"collection": collection}
+			return list(self.mongodb.database("").SlowQueries.find(query, {"_id": False})
+							.sort("$natural", -1).limit(limit))
+
+		records = [record for record in reversed(self.records)
+					if collection is None or record["collection"] == collection]
+
+		return records[:limit]
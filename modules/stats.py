@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+""" HIASCDI Statistics Module.
+
+This module samples host and process statistics in the background
+for the HIASCDI entry point and life notifications.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import os
+import psutil
+import requests
+import threading
+import time
+
+from collections import deque
+
+
+class stats():
+	""" HIASCDI Statistics Module.
+
+	This module samples host and process statistics in the background
+	for the HIASCDI entry point and life notifications.
+
+	Samples are kept in a fixed-size ring buffer so that the latest
+	snapshot and a short history can be read without calling psutil
+	on the request path.
+	"""
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Statistics Module"
+
+		self.confs = self.helpers.confs["stats"]
+
+		self.samples = deque(maxlen=self.confs["history"])
+		self.location = None
+
+		self.process = psutil.Process(os.getpid())
+		self.stopped = threading.Event()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def start(self):
+		""" Starts the background sampler and locator.
+
+		The location is looked up on its own thread, ipinfo can take
+		seconds to answer and must not hold up startup or sampling.
+		"""
+
+		# Primes the CPU counters so the first sample is meaningful
+		psutil.cpu_percent()
+		self.process.cpu_percent()
+
+		self.sample()
+		threading.Thread(target=self.run, daemon=True).start()
+		threading.Thread(target=self.locator, daemon=True).start()
+
+	def stop(self):
+		""" Stops the background sampler. """
+
+		self.stopped.set()
+
+	def run(self):
+		""" Samples statistics until stopped. """
+
+		while not self.stopped.wait(self.confs["interval"]):
+			try:
+				self.sample()
+			except Exception as e:
+				self.helpers.logger.warning(self.program + " sampling failed: " + str(e))
+
+	def locator(self):
+		""" Refreshes the host location until stopped. """
+
+		while True:
+			self.locate()
+			if self.stopped.wait(self.confs["locationInterval"]):
+				return
+
+	def temperature(self):
+		""" Gets the CPU temperature if sensors are available. """
+
+		try:
+			sensors = psutil.sensors_temperatures()
+		except (AttributeError, OSError):
+			return None
+
+		for name in ["coretemp", "k10temp", "cpu_thermal", "cpu-thermal"]:
+			if sensors.get(name):
+				return sensors[name][0].current
+
+		return None
+
+	def locate(self):
+		""" Refreshes the host location from ipinfo. """
+
+		try:
+			r = requests.get('http://ipinfo.io/json?token=' +
+					self.helpers.credentials["iotJumpWay"]["ipinfo"],
+					timeout=self.confs["locationTimeout"])
+			location = r.json()["loc"].split(',')
+			self.location = (float(location[0]), float(location[1]))
+		except Exception as e:
+			self.helpers.logger.warning(self.program + " location unavailable: " + str(e))
+
+	def sample(self):
+		""" Takes a statistics sample. """
+
+		with self.process.oneshot():
+			memory = self.process.memory_info()
+			sample = {
+				"Time": time.time(),
+				"CPU": psutil.cpu_percent(),
+				"Memory": psutil.virtual_memory()[2],
+				"Diskspace": psutil.disk_usage('/').percent,
+				"Temperature": self.temperature(),
+				"ProcessCPU": self.process.cpu_percent(),
+				"ProcessMemory": memory.rss,
+				"ProcessThreads": self.process.num_threads(),
+				"Latitude": self.location[0] if self.location is not None else None,
+				"Longitude": self.location[1] if self.location is not None else None
+			}
+
+		self.samples.append(sample)
+
+	def snapshot(self):
+		""" Gets the latest sample. """
+
+		try:
+			return self.samples[-1]
+		except IndexError:
+			return {}
+
+	def history(self, last=None):
+		""" Gets the most recent samples, oldest first. """
+
+		samples = list(self.samples)
+		if last is not None:
+			samples = samples[-last:] if last > 0 else []
+
+		return samples
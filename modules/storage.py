@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+""" HIASCDI Storage Module.
+
+This module routes HIASCDI entities to the MongoDB collections
+they are stored in.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import contextvars
+import heapq
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+def bsonKey(value):
+	""" Maps a value to a key that sorts in the MongoDB BSON type order. """
+
+	if value is None:
+		return (1,)
+	if isinstance(value, bool):
+		return (8, value)
+	if isinstance(value, (int, float)):
+		return (2, value)
+	if isinstance(value, str):
+		return (3, value)
+	if isinstance(value, dict):
+		return (4, tuple((key, bsonKey(item)) for key, item in value.items()))
+	if isinstance(value, list):
+		return (5, tuple(bsonKey(item) for item in value))
+	if isinstance(value, datetime):
+		return (9, value)
+
+	return (10, str(value))
+
+
+class sortKey():
+	""" Compares entities on a MongoDB sort specification. """
+
+	__slots__ = ("keys",)
+
+	def __init__(self, keys):
+		""" Initializes the class. """
+
+		self.keys = keys
+
+	def __lt__(self, other):
+		for (mine, direction), (theirs, _) in zip(self.keys, other.keys):
+			if mine != theirs:
+				return mine < theirs if direction == 1 else theirs < mine
+
+		return False
+
+
+class storage():
+	""" HIASCDI Storage Module.
+
+	This module routes HIASCDI entities to the MongoDB collections
+	they are stored in.
+
+	Types listed in the storage partitions are kept in their own
+	collection, so hot types can be indexed and sized separately,
+	every other type is stored in Entities. Queries that may match
+	several partitions are sent to all of them in parallel and the
+	sorted results merged.
+	"""
+
+	def __init__(self, helpers, mongodb):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Storage Module"
+
+		self.mongodb = mongodb
+
+		self.confs = self.helpers.confs["storage"]
+		self.partitions = self.confs["partitions"]
+		self.default = "Entities"
+
+		# Server time limit of list queries, 0 for none
+		self.maxTime = self.confs["maxTimeMS"]
+
+		self.pool = ThreadPoolExecutor(max_workers=self.confs["workers"])
+
+		self.mongodb.register(self.indexes)
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def indexes(self):
+		""" Creates the indexes of the entity collections. """
+
+		for name in self.names():
+			specs = self.confs["indexes"] + self.confs["collectionIndexes"].get(name, [])
+			for spec in specs:
+				try:
+					self.mongodb.mongoConn[name].create_index([tuple(key) for key in spec])
+				except Exception as e:
+					self.helpers.logger.warning(self.program + " index " + str(spec) +
+												" on " + name + " not created: " + str(e))
+
+	def name(self, typeof):
+		""" Gets the name of the collection a type is stored in. """
+
+		return self.partitions.get(typeof, self.default)
+
+	def names(self, types=None):
+		""" Gets the collections that may hold the given types.
+
+		None means any type, so every entity collection is returned.
+		"""
+
+		if types is None:
+			candidates = [self.default] + list(self.partitions.values())
+		else:
+			candidates = [self.name(typeof) for typeof in types]
+
+		return list(dict.fromkeys(candidates))
+
+	def collection(self, typeof, read=None):
+		""" Gets the collection a type is stored in. """
+
+		return self.routed(self.mongodb.mongoConn, self.name(typeof), read)
+
+	def collections(self, types=None, read=None):
+		""" Gets the collections that may hold the given types. """
+
+		database = self.mongodb.mongoConn
+
+		return [self.routed(database, name, read) for name in self.names(types)]
+
+	def routed(self, database, name, read):
+		""" Gets a collection that reads from the given read preference,
+		None reads from the primary. """
+
+		if read is None:
+			return database[name]
+
+		return database.get_collection(name, read_preference=read)
+
+	def total(self):
+		""" Estimates the number of entities stored in every partition. """
+
+		return sum(collection.estimated_document_count() for collection in self.collections())
+
+	def lookup(self, query, typeof=None, fields=None, read=None):
+		""" Finds the entities matching a query in every candidate partition. """
+
+		collections = self.collections(None if typeof is None else [typeof], read)
+		cursors = [collection.find(query, fields) for collection in collections]
+
+		if len(cursors) == 1:
+			return list(cursors[0])
+
+		return list(itertools.chain(*self.parallel(list, cursors)))
+
+	def parallel(self, function, items):
+		""" Runs a function on each item in the pool, in a copy of the
+		caller's context so the work is accounted to its request. """
+
+		return self.pool.map(lambda task: task[0].run(function, task[1]),
+							[(contextvars.copy_context(), item) for item in items])
+
+	def delete(self, query, typeof=None):
+		""" Deletes an entity from the partition holding it. """
+
+		for collection in self.collections(None if typeof is None else [typeof]):
+			result = collection.find_one_and_delete(query)
+			if result is not None:
+				return result
+
+		return None
+
+	def find(self, types, query, fields, sort=[], offset=0, limit=0, batch=None, read=None):
+		""" Finds the entities matching a list query.
+
+		A query on a single partition returns the MongoDB cursor. Other
+		queries fetch the first batch of every partition in parallel and
+		merge the partitions in sort order, the offset and limit are
+		applied after the merge.
+
+		Queries are limited to the configured server time, except exports
+		which read in batches for as long as the client downloads.
+		"""
+
+		collections = self.collections(types, read)
+
+		if len(collections) == 1:
+			cursor = collections[0].find(query, fields)
+			if self.maxTime and not batch:
+				cursor = cursor.max_time_ms(self.maxTime)
+			if batch:
+				cursor = cursor.batch_size(batch)
+			if len(sort):
+				cursor = cursor.sort(sort)
+			if offset:
+				cursor = cursor.skip(offset)
+			if limit:
+				cursor = cursor.limit(limit)
+			return cursor
+
+		fields, added = self.sortable(fields, sort)
+
+		cursors = []
+		for collection in collections:
+			cursor = collection.find(query, fields)
+			if self.maxTime and not batch:
+				cursor = cursor.max_time_ms(self.maxTime)
+			if batch:
+				cursor = cursor.batch_size(batch)
+			if len(sort):
+				cursor = cursor.sort(sort)
+			if limit:
+				cursor = cursor.limit((offset or 0) + limit)
+			cursors.append(cursor)
+
+		return self.merge(cursors, sort, offset or 0, limit, added)
+
+	def sortable(self, fields, sort):
+		""" Adds the sort fields to an inclusive projection so that the
+		partitions can be merged, returns the fields to remove again. """
+
+		if fields is None or not any(value is True for key, value in fields.items() if key != "_id"):
+			return fields, []
+
+		fields = dict(fields)
+		added = []
+		for field, direction in sort:
+			if field not in fields:
+				fields[field] = True
+				added.append(field)
+
+		return fields, added
+
+	def first(self, cursor):
+		""" Fetches the first entity of a cursor. """
+
+		for entity in cursor:
+			return [entity]
+
+		return []
+
+	def value(self, entity, field):
+		""" Gets a dotted field of an entity. """
+
+		for part in field.split("."):
+			if not isinstance(entity, dict):
+				return None
+			entity = entity.get(part)
+
+		return entity
+
+	def key(self, entity, sort):
+		""" Builds the merge key of an entity. """
+
+		return sortKey([(bsonKey(self.value(entity, field)), direction)
+							for field, direction in sort])
+
+	def merge(self, cursors, sort, offset, limit, added):
+		""" Merges partition cursors, starting them in parallel. """
+
+		try:
+			heads = list(self.parallel(self.first, cursors))
+			streams = [itertools.chain(head, cursor) for head, cursor in zip(heads, cursors)]
+
+			if len(sort):
+				merged = heapq.merge(*streams, key=lambda entity: self.key(entity, sort))
+			else:
+				merged = itertools.chain(*streams)
+
+			for entity in itertools.islice(merged, offset, offset + limit if limit else None):
+				for field in added:
+					entity.pop(field, None)
+				yield entity
+		finally:
+			for cursor in cursors:
+				cursor.close()
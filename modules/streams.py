@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+""" HIASCDI Streams Module.
+
+This module streams live entity changes to HIASCDI clients as
+Server-Sent Events.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import itertools
+import re
+import threading
+
+from collections import OrderedDict
+
+from bson import json_util
+
+from components.hiascdi.modules.tenants import tenant
+
+
+class channel():
+	""" HIASCDI Stream Channel.
+
+	The buffer of changes waiting to be sent on one client connection.
+	Changes are keyed by entity, a newer change to an entity replaces
+	the one still buffered so slow clients only get the latest state.
+	"""
+
+	def __init__(self, _id, service, subscription, size):
+		""" Initializes the class. """
+
+		self.id = _id
+		self.service = service
+		self.subscription = subscription
+		self.size = size
+
+		self.buffer = OrderedDict()
+		self.condition = threading.Condition()
+		self.sequence = 0
+		self.sent = 0
+		self.coalesced = 0
+		self.dropped = 0
+
+	def put(self, key, data):
+		""" Buffers the change of an entity. """
+
+		with self.condition:
+			if key in self.buffer:
+				self.coalesced += 1
+			elif len(self.buffer) >= self.size:
+				self.buffer.popitem(last=False)
+				self.dropped += 1
+			self.sequence += 1
+			self.buffer[key] = (self.sequence, data)
+			self.buffer.move_to_end(key)
+			self.condition.notify()
+
+	def take(self, timeout):
+		""" Takes every buffered change, waiting up to timeout seconds. """
+
+		with self.condition:
+			if not self.buffer:
+				self.condition.wait(timeout)
+			changes = list(self.buffer.values())
+			self.buffer.clear()
+
+		self.sent += len(changes)
+
+		return changes
+
+
+class streams():
+	""" HIASCDI Streams Module.
+
+	This module streams live entity changes to HIASCDI clients as
+	Server-Sent Events.
+
+	A stream selects entities by id, type, pattern and q filter like
+	a subscription does, and is matched against entity changes by the
+	notification matcher. Changes are rendered once per format and
+	buffered per connection, each connection keeps at most the
+	configured number of entities and coalesces repeated changes.
+	"""
+
+	def __init__(self, helpers, mongodb, notifications):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Streams Module"
+
+		self.mongodb = mongodb
+		self.notifications = notifications
+
+		self.confs = self.helpers.confs["streams"]
+
+		self.channels = {}
+		self.ids = itertools.count(1)
+		self.lock = threading.Lock()
+
+		self.opened = 0
+		self.rejected = 0
+		self.totals = {"sent": 0, "coalesced": 0, "dropped": 0}
+
+		self.notifications.listen(self.changed)
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def selectors(self, arguments):
+		""" Builds the entity selectors of a stream request.
+
+		Returns None if the request is invalid.
+		"""
+
+		if arguments.get("id") and arguments.get("idPattern"):
+			return None
+		if arguments.get("type") and arguments.get("typePattern"):
+			return None
+
+		try:
+			for pattern in [arguments.get("idPattern"), arguments.get("typePattern")]:
+				if pattern is not None:
+					re.compile(pattern)
+		except re.error:
+			return None
+
+		if arguments.get("id"):
+			ids = [{"id": _id} for _id in arguments["id"].split(",")]
+		else:
+			ids = [{"idPattern": arguments.get("idPattern", ".*")}]
+
+		if arguments.get("type"):
+			types = [{"type": typeof} for typeof in arguments["type"].split(",")]
+		elif arguments.get("typePattern"):
+			types = [{"typePattern": arguments["typePattern"]}]
+		else:
+			types = [{}]
+
+		return [dict(selector, **typeof) for selector in ids for typeof in types]
+
+	def subscription(self, arguments):
+		""" Builds the subscription a stream is matched with. """
+
+		selectors = self.selectors(arguments)
+		if selectors is None:
+			return None
+
+		attrs = arguments["attrs"].split(",") if arguments.get("attrs") else []
+		options = arguments.get("options", "")
+		attrsFormat = "keyValues" if "keyValues" in options else \
+			"values" if "values" in options else "normalized"
+
+		condition = {"attrs": attrs}
+		if arguments.get("q"):
+			condition["expression"] = {"q": arguments["q"]}
+
+		return {
+			"subject": {"entities": selectors, "condition": condition},
+			"notification": {"attrs": attrs, "attrsFormat": attrsFormat},
+			"servicePath": self.mongodb.queryPath()
+		}
+
+	def open(self, arguments):
+		""" Opens a stream for the current tenant.
+
+		Returns the channel, or the error code and message key if the
+		request is invalid or too many streams are open.
+		"""
+
+		subscription = self.subscription(arguments)
+		if subscription is None:
+			return None, (400, "400p")
+
+		service = tenant.get()[0]
+		with self.lock:
+			if sum(len(channels) for channels in self.channels.values()) >= self.confs["connections"]:
+				self.rejected += 1
+				return None, (503, "503")
+			stream = channel(next(self.ids), service, subscription, self.confs["buffer"])
+			channels = dict(self.channels.get(service, {}))
+			channels[stream.id] = stream
+			self.channels[service] = channels
+			self.opened += 1
+
+		return stream, None
+
+	def close(self, stream):
+		""" Closes a stream. """
+
+		with self.lock:
+			channels = dict(self.channels.get(stream.service, {}))
+			channels.pop(stream.id, None)
+			self.channels[stream.service] = channels
+			self.totals["sent"] += stream.sent
+			self.totals["coalesced"] += stream.coalesced
+			self.totals["dropped"] += stream.dropped
+
+	def changed(self, entity, attrs):
+		""" Buffers an entity change on the matching streams.
+
+		Called by the notification dispatcher in the tenant of the change,
+		streams with the same format share the rendered change.
+		"""
+
+		rendered = {}
+		for stream in self.channels.get(tenant.get()[0], {}).values():
+			if not self.notifications.matches(stream.subscription, entity, attrs):
+				continue
+			notification = stream.subscription["notification"]
+			key = self.notifications.renderKey(notification)
+			if key not in rendered:
+				rendered[key] = json_util.dumps(self.notifications.format(notification, entity))
+			stream.put(entity.get("id"), rendered[key])
+
+	def events(self, stream):
+		""" Writes the changes of a stream as Server-Sent Events.
+
+		A comment is sent when the stream is idle so that proxies keep
+		the connection open and closed clients are detected.
+		"""
+
+		try:
+			yield "retry: " + str(self.confs["retry"]) + "\n\n"
+			while True:
+				changes = stream.take(self.confs["heartbeat"])
+				if not changes:
+					yield ": keepalive\n\n"
+					continue
+				yield "".join("id: " + str(sequence) + "\nevent: change\ndata: " + data + "\n\n"
+								for sequence, data in changes)
+		finally:
+			self.close(stream)
+
+	def getCounters(self):
+		""" Gets the stream counters. """
+
+		with self.lock:
+			channels = [stream for channels in self.channels.values() for stream in channels.values()]
+			totals = dict(self.totals)
+
+		return {
+			"open": len(channels),
+			"opened": self.opened,
+			"rejected": self.rejected,
+			"sent": totals["sent"] + sum(stream.sent for stream in channels),
+			"coalesced": totals["coalesced"] + sum(stream.coalesced for stream in channels),
+			"dropped": totals["dropped"] + sum(stream.dropped for stream in channels),
+			"buffered": sum(len(stream.buffer) for stream in channels)
+		}
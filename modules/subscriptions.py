@@ -33,6 +33,7 @@ Contributors:
 """
 
 import json
+import copy
 import os
 import uuid
 import sys
@@ -116,10 +117,34 @@ class subscriptions():
 
 		if count_opt:
 			# Sets count header
-			headers["Count"] = subscriptions.count()
+			headers["Count"] = self.broker.counts.count("Subscriptions", query)
 
 		return self.broker.respond(200, subscriptions, headers, False, accepted)
 
+	def checkTarget(self, subscription):
+		""" Checks the MQTT target of a subscription, if it has one. """
+
+		notification = subscription.get("notification")
+		if not isinstance(notification, dict) or "mqtt" not in notification:
+			return True
+
+		return self.broker.notifications.delivery.allowed(notification["mqtt"])
+
+	def applied(self, subscription, data):
+		""" Applies the fields of an update to a copy of a subscription. """
+
+		subscription = copy.deepcopy(subscription or {})
+		for update, value in data.items():
+			parts = update.split(".")
+			current = subscription
+			for part in parts[:-1]:
+				if not isinstance(current.get(part), dict):
+					current[part] = {}
+				current = current[part]
+			current[parts[-1]] = value
+
+		return subscription
+
 	def createSubscription(self, data, accepted=[]):
 		""" Creates a new HIASCDI Subscription.
 
@@ -133,13 +158,23 @@ class subscriptions():
 						- List Subscriptions
 		"""
 
+		if not self.checkTarget(data):
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400m"],
+								{}, False, accepted)
+
 		nuuid = str(uuid.uuid4())
 		newData = {"id": nuuid}
 		newData.update(data)
 		data = newData
 
+		# Only entities under the subscription's service path notify
+		data["servicePath"] = self.broker.tenants.queryPath()
+
 		try:
 			_id = self.mongodb.mongoConn.Subscriptions.insert(data)
+			self.broker.counts.clear("Subscriptions")
+			self.broker.notifications.refresh(data["id"])
+			self.broker.invalidation.subscriptions(data["id"])
 			return self.broker.respond(201, {}, {"Location": "v1/subscription/" + data["id"]},
 								False, accepted)
 		except:
@@ -194,12 +229,19 @@ class subscriptions():
 
 		updated = False
 
+		stored = self.mongodb.mongoConn.Subscriptions.find_one({"id": subscription}, {"_id": False})
+		if not self.checkTarget(self.applied(stored, data)):
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400m"],
+								{}, False, accepted)
+
 		for update in data:
 			self.mongodb.mongoConn.Subscriptions.update_one({"id" : subscription},
 						{"$set": {update: data[update]}}, upsert=True)
 			updated = True
 
 		if updated:
+			self.broker.notifications.refresh(subscription)
+			self.broker.invalidation.subscriptions(subscription)
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
 								{}, False, accepted)
 		else:
@@ -223,7 +265,10 @@ class subscriptions():
 		deleted = False
 		result = self.mongodb.mongoConn.Subscriptions.delete_one({"id": subscription})
 
-		if result.deleted_count is True:
+		if result.deleted_count == 1:
+			self.broker.counts.clear("Subscriptions")
+			self.broker.notifications.refresh(subscription)
+			self.broker.invalidation.subscriptions(subscription)
 			self.helpers.logger.info("Mongo data delete OK")
 			return self.broker.respond(204, {}, {}, False, accepted)
 		else:
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+""" HIASCDI Tenants Module.
+
+This module provides Fiware-Service multi-tenancy and
+Fiware-ServicePath scoping for HIASCDI.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import contextvars
+import re
+import threading
+
+from contextlib import contextmanager
+
+# The service and service paths of the request being served
+tenant = contextvars.ContextVar("tenant", default=("", ["/#"]))
+
+
+def current():
+	""" Gets the service of the current request, "" for the default tenant. """
+
+	return tenant.get()[0]
+
+
+class tenants():
+	""" HIASCDI Tenants Module.
+
+	This module provides Fiware-Service multi-tenancy and
+	Fiware-ServicePath scoping for HIASCDI.
+
+	It stands in for the MongoDB connection class: mongoConn resolves
+	to the database of the current tenant, so every module reads and
+	writes its own tenant's collections and indexes. Each service gets
+	its own database, the default tenant keeps the configured one.
+	"""
+
+	def __init__(self, helpers, mongodb):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Tenants Module"
+
+		self.mongodb = mongodb
+
+		self.confs = self.helpers.confs["tenants"]
+
+		self.servicePattern = re.compile(r"^[a-z0-9_]{1," + str(self.confs["serviceLength"]) + r"}$")
+		self.levelPattern = re.compile(r"^[A-Za-z0-9_]{1," + str(self.confs["levelLength"]) + r"}$")
+
+		self.databases = {"": self.mongodb.mongoConn}
+		self.setups = []
+		self.requests = {}
+		self.lock = threading.Lock()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	@property
+	def mongoConn(self):
+		""" Gets the database of the current tenant. """
+
+		return self.database(current())
+
+	@property
+	def collextions(self):
+		""" Maps the entity types to the current tenant's collections. """
+
+		if current() == "":
+			return self.mongodb.collextions
+
+		database = self.mongoConn
+		return {typeof: database[collection.name]
+					for typeof, collection in self.mongodb.collextions.items()}
+
+	def register(self, setup):
+		""" Registers a function that prepares a tenant database.
+
+		The function runs now for the tenants already in use and
+		afterwards whenever a new tenant database is opened, always
+		in the scope of the tenant it prepares.
+		"""
+
+		with self.lock:
+			self.setups.append(setup)
+			services = list(self.databases)
+
+		for service in services:
+			with self.using(service):
+				setup()
+
+	def database(self, service):
+		""" Gets the database of a tenant, preparing it on first use. """
+
+		database = self.databases.get(service)
+		if database is not None:
+			return database
+
+		with self.lock:
+			if service in self.databases:
+				return self.databases[service]
+			default = self.databases[""]
+			database = default.client[default.name + self.confs["separator"] + service]
+			self.databases[service] = database
+			setups = list(self.setups)
+
+		self.helpers.logger.info(self.program + " opened tenant " + service + ".")
+
+		with self.using(service):
+			for setup in setups:
+				setup()
+
+		return database
+
+	def services(self):
+		""" Gets the services that have a tenant database. """
+
+		default = self.databases[""]
+		prefix = default.name + self.confs["separator"]
+
+		services = [""]
+		for name in default.client.list_database_names():
+			if name.startswith(prefix) and self.servicePattern.match(name[len(prefix):]):
+				services.append(name[len(prefix):])
+
+		return services
+
+	def validPath(self, path, query):
+		""" Checks a service path, recursive paths are only valid in queries. """
+
+		if query and path.endswith("/#"):
+			path = path[:-2] or "/"
+		if not path.startswith("/"):
+			return False
+		if path == "/":
+			return True
+
+		levels = path[1:].split("/")
+		if len(levels) > self.confs["levels"]:
+			return False
+
+		return all(self.levelPattern.match(level) for level in levels)
+
+	def resolve(self, headers, query):
+		""" Gets the service and service paths of a request.
+
+		Returns None if either header is invalid. Queries may use up
+		to the configured number of comma separated paths, recursive
+		paths ending in /#, and default to the whole service.
+		"""
+
+		service = headers.get("Fiware-Service", "").strip().lower()
+		if service and not self.servicePattern.match(service):
+			return None
+		if service and self.confs["allowed"] and service not in self.confs["allowed"]:
+			return None
+
+		header = headers.get("Fiware-ServicePath")
+		if header is None or not header.strip():
+			paths = ["/#"] if query else ["/"]
+		else:
+			paths = [path.strip() for path in header.split(",")]
+			if len(paths) > (self.confs["paths"] if query else 1):
+				return None
+			if not all(self.validPath(path, query) for path in paths):
+				return None
+
+		return service, paths
+
+	def enter(self, service, paths):
+		""" Sets the tenant of the current request. """
+
+		tenant.set((service, paths))
+
+		with self.lock:
+			self.requests[service] = self.requests.get(service, 0) + 1
+
+	@contextmanager
+	def using(self, service, paths=None):
+		""" Runs a block in the scope of a tenant. """
+
+		token = tenant.set((service, paths or ["/#"]))
+		try:
+			yield
+		finally:
+			tenant.reset(token)
+
+	def headers(self):
+		""" Gets the Fiware headers that carry the current tenant to other brokers. """
+
+		service, paths = tenant.get()
+
+		headers = {"Fiware-ServicePath": ",".join(paths)}
+		if service:
+			headers["Fiware-Service"] = service
+
+		return headers
+
+	def path(self):
+		""" Gets the service path new entities are stored under. """
+
+		path = tenant.get()[1][0]
+
+		return "/" if path.endswith("#") else path
+
+	def queryPath(self):
+		""" Gets the service path subscriptions are scoped to. """
+
+		return tenant.get()[1][0]
+
+	def pathQuery(self):
+		""" Builds the servicePath filter of the current request.
+
+		Recursive paths use an anchored prefix expression so that the
+		servicePath index bounds the scan. Entities stored before
+		service paths were introduced belong to the root path.
+		"""
+
+		filters = []
+		for path in tenant.get()[1]:
+			if path == "/#":
+				return {}
+			if path.endswith("/#"):
+				filters.append({"servicePath": {"$regex": "^" + re.escape(path[:-2]) + "(/|$)"}})
+			elif path == "/":
+				filters.append({"servicePath": {"$in": ["/", None]}})
+			else:
+				filters.append({"servicePath": path})
+
+		if len(filters) == 1:
+			return filters[0]
+
+		return {"$or": filters}
+
+	def scoped(self, query):
+		""" Restricts a query to the service paths of the current request. """
+
+		paths = self.pathQuery()
+		if not paths:
+			return query
+
+		if "$or" in paths and "$or" in query:
+			return {"$and": [query, paths]}
+
+		scoped = dict(query)
+		scoped.update(paths)
+
+		return scoped
+
+	def inPath(self, path, entity):
+		""" Checks if an entity belongs to a service path. """
+
+		stored = entity.get("servicePath") or "/"
+
+		if path == "/#":
+			return True
+		if path.endswith("/#"):
+			prefix = path[:-2]
+			return stored == prefix or stored.startswith(prefix + "/")
+
+		return stored == path
+
+	def project(self, fields):
+		""" Hides the servicePath of exclusion projections. """
+
+		if any(value is True for key, value in fields.items() if key != "_id"):
+			return fields
+
+		fields = dict(fields)
+		fields["servicePath"] = False
+
+		return fields
+
+	def quota(self, service):
+		""" Gets the entity quota of a tenant, 0 means unlimited. """
+
+		quotas = self.confs["quotas"]
+
+		return quotas.get(service or "default", quotas.get("default", {})).get("entities", 0)
+
+	def remaining(self, total):
+		""" Gets how many more entities the current tenant may store.
+
+		total counts the entities the current tenant stores, it is only
+		called if the tenant has a quota.
+		"""
+
+		quota = self.quota(current())
+		if not quota:
+			return None
+
+		return max(quota - total(), 0)
+
+	def getCounters(self, total):
+		""" Gets the requests, entities and quota of each tenant. """
+
+		with self.lock:
+			requests = dict(self.requests)
+			services = list(self.databases)
+
+		counters = {}
+		for service in services:
+			with self.using(service):
+				counters[service or "default"] = {
+					"requests": requests.get(service, 0),
+					"entities": total(),
+					"quota": self.quota(service)
+				}
+
+		return counters
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+""" HIASCDI Timers Module.
+
+This module provides a hashed timer wheel for scheduling large
+numbers of HIASCDI timeouts in O(1).
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import math
+import threading
+import time
+
+
+class wheel():
+	""" HIASCDI Timer Wheel.
+
+	This module provides a hashed timer wheel for scheduling large
+	numbers of HIASCDI timeouts in O(1).
+
+	Timers are hashed into slots by their deadline, timers further away
+	than one revolution carry a number of remaining rounds. Each tick
+	only visits the timers of the current slot.
+	"""
+
+	def __init__(self, slots, resolution):
+		""" Initializes the class. """
+
+		self.resolution = resolution
+		self.slots = [{} for i in range(slots)]
+		self.index = {}
+		self.position = 0
+		self.lock = threading.Lock()
+
+	def add(self, key, seconds, item):
+		""" Schedules an item to expire after a number of seconds. """
+
+		ticks = max(1, int(math.ceil(seconds / self.resolution)))
+		slot = (self.position + ticks) % len(self.slots)
+		rounds = (ticks - 1) // len(self.slots)
+
+		with self.lock:
+			self.discard(key)
+			self.slots[slot][key] = [rounds, item]
+			self.index[key] = slot
+
+	def remove(self, key):
+		""" Cancels a scheduled item. """
+
+		with self.lock:
+			self.discard(key)
+
+	def discard(self, key):
+		""" Cancels a scheduled item, the lock must be held. """
+
+		slot = self.index.pop(key, None)
+		if slot is not None:
+			del self.slots[slot][key]
+
+	def clear(self):
+		""" Cancels all the scheduled items. """
+
+		with self.lock:
+			for slot in self.slots:
+				slot.clear()
+			self.index.clear()
+
+	def tick(self):
+		""" Advances the wheel by one slot, returns the expired items. """
+
+		expired = []
+
+		with self.lock:
+			self.position = (self.position + 1) % len(self.slots)
+			slot = self.slots[self.position]
+			for key in list(slot):
+				entry = slot[key]
+				if entry[0] > 0:
+					entry[0] -= 1
+					continue
+				expired.append(entry[1])
+				del slot[key]
+				del self.index[key]
+
+		return expired
+
+	def start(self, callback):
+		""" Ticks the wheel in the background, passing expired items to
+		the callback. """
+
+		threading.Thread(target=self.run, args=(callback,), daemon=True).start()
+
+	def run(self, callback):
+		""" Ticks the wheel at its resolution. """
+
+		due = time.monotonic()
+		while True:
+			due += self.resolution
+			delay = due - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+
+			expired = self.tick()
+			if expired:
+				callback(expired)
+
+	def __len__(self):
+		""" Gets the number of scheduled items. """
+
+		return len(self.index)
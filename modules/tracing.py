@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+""" HIASCDI Tracing Module.
+
+This module traces HIASCDI requests through the broker, MongoDB
+and notification delivery.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import contextvars
+import importlib
+import json
+import logging
+import logging.handlers as handlers
+import os
+import queue
+import random
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+# The span of the work being done
+active = contextvars.ContextVar("span", default=None)
+
+
+class span():
+	""" HIASCDI Trace Span.
+
+	A timed operation of a trace.
+	"""
+
+	__slots__ = ("trace", "id", "parent", "name", "start", "attributes", "status")
+
+	def __init__(self, trace, parent, name, attributes):
+		""" Initializes the class. """
+
+		self.trace = trace
+		self.id = "%016x" % random.getrandbits(64)
+		self.parent = parent
+		self.name = name
+		self.start = time.time_ns()
+		self.attributes = attributes
+		self.status = "ok"
+
+	def record(self, end=None):
+		""" Builds the exported record of the span. """
+
+		end = end or time.time_ns()
+
+		return {
+			"traceId": self.trace,
+			"spanId": self.id,
+			"parentId": self.parent,
+			"name": self.name,
+			"start": self.start,
+			"duration": round((end - self.start) / 1e6, 3),
+			"status": self.status,
+			"attributes": self.attributes
+		}
+
+
+class fileExporter():
+	""" HIASCDI Trace File Exporter.
+
+	Writes spans as JSON lines to an hourly rotated file in the logs
+	directory.
+	"""
+
+	def __init__(self, helpers, confs):
+		""" Initializes the class. """
+
+		self.logger = logging.getLogger("HIASCDI-Traces")
+		self.logger.setLevel(logging.INFO)
+		self.logger.propagate = False
+
+		handler = handlers.TimedRotatingFileHandler(
+			os.path.dirname(os.path.abspath(__file__)) + '/../../../logs/' + confs["file"],
+			when='H', interval=1, backupCount=confs["backups"])
+		handler.setFormatter(logging.Formatter('%(message)s'))
+		self.logger.addHandler(handler)
+
+	def export(self, spans):
+		""" Writes a batch of spans. """
+
+		for record in spans:
+			self.logger.info(json.dumps(record, default=str))
+
+
+class logExporter():
+	""" HIASCDI Trace Log Exporter.
+
+	Writes spans to the HIASCDI log.
+	"""
+
+	def __init__(self, helpers, confs):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+
+	def export(self, spans):
+		""" Logs a batch of spans. """
+
+		for record in spans:
+			self.helpers.logger.info("Span " + json.dumps(record, default=str))
+
+
+class storageSpans(monitoring.CommandListener):
+	""" HIASCDI MongoDB Tracing Listener.
+
+	Adds a span for every MongoDB command issued within a trace.
+	"""
+
+	def __init__(self, tracing):
+		""" Initializes the class. """
+
+		self.tracing = tracing
+
+	def started(self, event):
+		pass
+
+	def succeeded(self, event):
+		self.tracing.storage(event)
+
+	def failed(self, event):
+		self.tracing.storage(event, event.failure)
+
+
+class tracing():
+	""" HIASCDI Tracing Module.
+
+	This module traces HIASCDI requests through the broker, MongoDB
+	and notification delivery.
+
+	Requests join the trace of a W3C traceparent header, or start a new
+	trace for the configured sample of requests. Spans are opened for
+	the stages of a request, every MongoDB command and the notifications
+	a write causes, which carry the trace to their delivery threads and
+	to subscribers in a traceparent header. Finished spans are exported
+	in batches on a background thread, by default as JSON lines.
+
+	Exporters are classes taking the helpers and tracing settings with
+	an export method receiving a list of span records, the exporter
+	setting is file, log or a module:class path.
+	"""
+
+	exporters = {"file": fileExporter, "log": logExporter}
+
+	traceparent = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Tracing Module"
+
+		self.confs = self.helpers.confs["tracing"]
+
+		self.spans = queue.Queue(maxsize=self.confs["queue"])
+		self.exported = 0
+		self.dropped = 0
+
+		if self.confs["enabled"]:
+			self.exporter = self.load(self.confs["exporter"])
+			# Must be registered before the MongoDB client is created
+			monitoring.register(storageSpans(self))
+			threading.Thread(target=self.work, daemon=True).start()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def load(self, name):
+		""" Creates the configured exporter. """
+
+		if name in self.exporters:
+			return self.exporters[name](self.helpers, self.confs)
+
+		module, cls = name.split(":")
+
+		return getattr(importlib.import_module(module), cls)(self.helpers, self.confs)
+
+	def parse(self, header):
+		""" Parses a traceparent header, returns None if it is invalid. """
+
+		match = self.traceparent.match((header or "").strip().lower())
+		if match is None:
+			return None
+
+		trace, parent, flags = match.groups()
+		if trace == "0" * 32 or parent == "0" * 16:
+			return None
+
+		return trace, parent, int(flags, 16) & 1 == 1
+
+	def begin(self, headers, name, attributes):
+		""" Starts the span of a request.
+
+		The request joins the trace of its traceparent header if it has
+		one, otherwise a trace is started for the sampled requests.
+		"""
+
+		if not self.confs["enabled"]:
+			return
+
+		parsed = self.parse(headers.get("traceparent"))
+		if parsed is not None:
+			trace, parent, sampled = parsed
+		else:
+			trace, parent = "%032x" % random.getrandbits(128), None
+			sampled = random.random() < self.confs["sample"]
+
+		active.set(span(trace, parent, name, attributes) if sampled else None)
+
+	def end(self, attributes):
+		""" Ends the span of the current request. """
+
+		current = active.get()
+		if current is None:
+			return
+
+		current.attributes.update(attributes)
+		self.finish(current)
+		active.set(None)
+
+	@contextmanager
+	def span(self, name, **attributes):
+		""" Runs a block in a span, if the work is traced. """
+
+		parent = active.get()
+		if parent is None:
+			yield None
+			return
+
+		with self.within(parent.trace, parent.id, name, attributes) as current:
+			yield current
+
+	@contextmanager
+	def resume(self, carried, name, **attributes):
+		""" Runs a block in a span continuing a carried trace context. """
+
+		if carried is None:
+			yield None
+			return
+
+		with self.within(carried[0], carried[1], name, attributes) as current:
+			yield current
+
+	@contextmanager
+	def within(self, trace, parent, name, attributes):
+		""" Runs a block in a new span of a trace. """
+
+		current = span(trace, parent, name, attributes)
+		token = active.set(current)
+		try:
+			yield current
+		except Exception as e:
+			current.status = "error"
+			current.attributes["error"] = str(e)
+			raise
+		finally:
+			active.reset(token)
+			self.finish(current)
+
+	def carry(self):
+		""" Gets the trace context to continue on another thread. """
+
+		current = active.get()
+		if current is None:
+			return None
+
+		return (current.trace, current.id)
+
+	def headers(self, headers):
+		""" Adds the traceparent of the current span to outgoing headers. """
+
+		current = active.get()
+		if current is None:
+			return headers
+
+		headers = dict(headers)
+		headers["traceparent"] = "00-" + current.trace + "-" + current.id + "-01"
+
+		return headers
+
+	def storage(self, event, failure=None):
+		""" Adds the span of a finished MongoDB command. """
+
+		parent = active.get()
+		if parent is None:
+			return
+
+		end = time.time_ns()
+		current = span(parent.trace, parent.id, "mongodb." + event.command_name,
+						{"db.name": event.database_name})
+		current.start = end - event.duration_micros * 1000
+		if failure is not None:
+			current.status = "error"
+			current.attributes["error"] = str(failure.get("errmsg", failure))
+
+		self.put(current.record(end))
+
+	def finish(self, current):
+		""" Queues a finished span for export. """
+
+		self.put(current.record())
+
+	def put(self, record):
+		""" Queues a span record without blocking. """
+
+		try:
+			self.spans.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+	def work(self):
+		""" Exports the queued spans in batches. """
+
+		while True:
+			batch = [self.spans.get()]
+			while len(batch) < self.confs["batch"]:
+				try:
+					batch.append(self.spans.get_nowait())
+				except queue.Empty:
+					break
+
+			try:
+				self.exporter.export(batch)
+				self.exported += len(batch)
+			except Exception as e:
+				self.helpers.logger.error(self.program + " export error: " + str(e))
+
+	def getCounters(self):
+		""" Gets the tracing counters. """
+
+		return {
+			"enabled": self.confs["enabled"],
+			"sample": self.confs["sample"],
+			"exporter": self.confs["exporter"],
+			"queued": self.spans.qsize(),
+			"exported": self.exported,
+			"dropped": self.dropped
+		}
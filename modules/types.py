@@ -57,7 +57,7 @@ class types():
 
 		self.helpers.logger.info(self.program + " initialization complete.")
 
-	def getTypes(self, arguments, accepted=[]):
+	def getTypes(self, arguments, accepted=[], federate=False):
 		""" Gets entity types data from the MongoDB.
 
 		You can access this endpoint by naviating your browser to https://YourServer/hiascdi/v1/types
@@ -76,15 +76,10 @@ class types():
 
 		count_opt = False
 		values_opt = False
+		noAttrDetail_opt = False
 
-		query = {}
 		headers = {}
 
-		# Removes the MongoDB ID
-		fields = {
-			'_id': False
-		}
-
 		# Processes the options parameter
 		options = arguments.get('options') if arguments.get(
 			'options') is not None else None
@@ -93,10 +88,11 @@ class types():
 			for option in options:
 				values_opt = True if option == "values" else values_opt
 				count_opt = True if option == "count" else count_opt
+				noAttrDetail_opt = True if option == "noAttrDetail" else noAttrDetail_opt
 
 		# Prepares the offset
 		if arguments.get('offset') is None:
-			offset = False
+			offset = 0
 		else:
 			offset = int(arguments.get('offset'))
 
@@ -106,23 +102,45 @@ class types():
 		else:
 			limit = int(arguments.get('limit'))
 
-		if offset:
-			types = self.mongodb.mongoConn.Types.find(
-				query, fields).skip(offset).limit(limit)
-		else:
-			types = self.mongodb.mongoConn.Types.find(
-				query, fields).limit(limit)
+		if federate:
+			# Merges the catalogues of the federation peers, counts need every type
+			window = offset + limit if limit and not count_opt else 0
+			types = [self.broker.catalogue.render(typ)
+						for typ in self.broker.catalogue.getTypes(0, window,
+							self.broker.routing.list())]
+			peers, total, failed = self.broker.federation.query("/types",
+				self.broker.federation.arguments(arguments, window))
+			headers.update(self.broker.federation.headers(failed))
+
+			types = self.broker.federation.mergeTypes([types] + peers)
+			if count_opt:
+				# Sets count header
+				headers["Count"] = len(types)
+			types = types[offset:offset + limit if limit else None]
+
+			if values_opt:
+				# Converts data to values
+				types = [typ["type"] for typ in types]
+			elif noAttrDetail_opt:
+				for typ in types:
+					typ["attrs"] = {attr: {} for attr in typ["attrs"]}
+
+			return self.broker.respond(200, types, headers, False, accepted)
+
+		# Reads the materialized type catalogue
+		types = self.broker.catalogue.getTypes(offset, limit, self.broker.routing.list())
 
 		if count_opt:
 			# Sets count header
-			headers["Count"] = types.count()
+			headers["Count"] = self.broker.counts.count("TypeCatalogue",
+											self.broker.catalogue.listed, self.broker.routing.list())
 
 		if values_opt:
 			# Converts data to values
-			newData = []
-			for i, typ in enumerate(types):
-				newData.append(typ["type"])
-			types = newData
+			types = [typ["type"] for typ in types]
+		else:
+			types = [self.broker.catalogue.render(typ, not noAttrDetail_opt)
+						for typ in types]
 
 		return self.broker.respond(200, types, headers, False, accepted)
 
@@ -139,8 +157,17 @@ class types():
 						- Create Entity types (Custom)
 		"""
 
+		if "schema" in data and self.broker.schemas.check(data["schema"]) is not None:
+			return self.broker.respond(400, self.helpers.confs["errorMessages"]["400b"], {},
+								False, accepted)
+
 		try:
 			_id = self.mongodb.mongoConn.Types.insert(data)
+			self.broker.catalogue.declared(data["type"], data.get("attrs"))
+			self.broker.schemas.invalidate(data["type"])
+			self.broker.counts.clear("Types")
+			self.broker.counts.clear("TypeCatalogue")
+			self.broker.invalidation.type(data["type"])
 			return self.broker.respond(201, {}, {"Location": "v1/types/" + data["type"]},
 								False, accepted)
 		except:
@@ -166,10 +193,21 @@ class types():
 		updated = False
 		error = False
 
-		for update in data:
-			self.mongodb.mongoConn.Types.update_one({"type": data['type']},
-											{"$set": {update: data[update]}})
-			updated = True
+		if "schema" in data and self.broker.schemas.check(data["schema"]) is not None:
+			error = True
+		else:
+			for update in data:
+				self.mongodb.mongoConn.Types.update_one({"type": data['type']},
+												{"$set": {update: data[update]}})
+				updated = True
+
+		if updated:
+			declared = self.mongodb.mongoConn.Types.find_one({"type": data['type']}, {"_id": False})
+			if declared is not None:
+				self.broker.catalogue.declared(data['type'], declared.get("attrs"))
+			# Recompiles the type's validator on next use
+			self.broker.schemas.invalidate(data['type'])
+			self.broker.invalidation.type(data['type'])
 
 		if updated and error is False:
 			return self.broker.respond(204, self.helpers.confs["successMessage"][str(204)],
@@ -195,17 +233,19 @@ class types():
 						- Retrieve Entity type
 		"""
 
-		query = {'type': _type}
 		headers = {}
 
-		# Removes the MongoDB ID
-		fields = {
-			'_id': False,
-			'type': False
-		}
+		# Reads the materialized type catalogue
+		entry = self.broker.catalogue.getType(_type)
 
-		_type = self.mongodb.mongoConn.Types.find(
-				query, fields)
+		if entry is None:
+			self.helpers.logger.info(
+				self.program + " 404: " + self.helpers.confs["errorMessages"][str(404)]["Description"])
+
+			return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
+								{}, False, accepted)
 
-		return self.broker.respond(200, _type, headers, False, accepted)
+		entry = self.broker.catalogue.render(entry)
+		del entry["type"]
 
+		return self.broker.respond(200, entry, headers, False, accepted)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+""" HIASCDI Versions Module.
+
+This module provides entity versions, ETags and conditional
+request handling for HIASCDI.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import hashlib
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from components.hiascdi.modules.tenants import current
+
+
+class versions():
+	""" HIASCDI Versions Module.
+
+	This module provides entity versions, ETags and conditional
+	request handling for HIASCDI.
+
+	The version of an entity is its dateModified attribute, which every
+	write path sets. Recently seen versions are kept in a bounded map so
+	that conditional requests for single entities can be answered
+	without querying MongoDB. The map is keyed by tenant, type and
+	entity, entities requested without a type are stored under None.
+
+	The ETag of a response covers the version and the representation
+	requested, If-Match preconditions only compare the version.
+	"""
+
+	def __init__(self, helpers):
+		""" Initializes the class. """
+
+		self.helpers = helpers
+		self.program = "HIASCDI Versions Module"
+
+		self.ttl = self.helpers.confs["versions"]["ttl"]
+		self.size = self.helpers.confs["versions"]["size"]
+
+		self.map = OrderedDict()
+		self.lock = threading.Lock()
+
+		self.helpers.logger.info(self.program + " initialization complete.")
+
+	def now(self):
+		""" Gets the current time as an NGSI DateTime value. """
+
+		return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+	def stamp(self):
+		""" Gets a dateModified attribute for the current time. """
+
+		return {"type": "DateTime", "value": self.now()}
+
+	def modified(self, entity):
+		""" Gets the dateModified value of an entity. """
+
+		if "dateModified" not in entity:
+			return None
+
+		modified = entity["dateModified"]
+		if isinstance(modified, dict):
+			modified = modified.get("value")
+
+		return str(modified) if modified is not None else None
+
+	def etag(self, parts):
+		""" Builds a weak ETag from version parts. """
+
+		digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+		return 'W/"' + digest[:20] + '"'
+
+	def entityTag(self, _id, modified, representation=None):
+		""" Builds the ETag of a single entity version, followed by a
+		digest of the representation when one is given. """
+
+		if modified is None:
+			return None
+
+		etag = self.etag([_id, modified])
+		if representation:
+			digest = hashlib.sha1("|".join(str(part) for part in representation).encode("utf-8"))
+			etag = etag[:-1] + "-" + digest.hexdigest()[:8] + '"'
+
+		return etag
+
+	def version(self, etag):
+		""" Gets the version part of an entity ETag. """
+
+		return etag.replace("W/", "", 1).strip('"').split("-")[0]
+
+	def listTag(self, entities):
+		""" Builds the ETag and Last-Modified of a list of entities. """
+
+		parts = []
+		latest = None
+		for entity in entities:
+			modified = self.modified(entity)
+			if modified is None:
+				return None, None
+			parts.append(str(entity.get("id")) + "@" + modified)
+			latest = modified if latest is None or modified > latest else latest
+
+		return self.etag(parts), latest
+
+	def httpDate(self, modified):
+		""" Converts a dateModified value to an HTTP date. """
+
+		if modified is None:
+			return None
+
+		try:
+			stamp = datetime.fromisoformat(modified.replace("Z", "+00:00"))
+		except ValueError:
+			return None
+
+		if stamp.tzinfo is None:
+			stamp = stamp.replace(tzinfo=timezone.utc)
+
+		return format_datetime(stamp.astimezone(timezone.utc), usegmt=True)
+
+	def headers(self, etag, modified):
+		""" Builds the validator headers for a response. """
+
+		headers = {}
+		if etag is not None:
+			headers["ETag"] = etag
+		lastModified = self.httpDate(modified)
+		if lastModified is not None:
+			headers["Last-Modified"] = lastModified
+
+		return headers
+
+	def project(self, fields):
+		""" Ensures dateModified is projected so versions can be read.
+
+		Returns the updated projection and whether dateModified has to
+		be removed from the response afterwards.
+		"""
+
+		fields = dict(fields)
+		inclusive = any(value is True for key, value in fields.items() if key != "_id")
+
+		if inclusive and "dateModified" not in fields:
+			fields["dateModified"] = True
+			return fields, True
+		if fields.get("dateModified") is False:
+			del fields["dateModified"]
+			return fields, True
+
+		return fields, False
+
+	def remember(self, _id, typeof, modified):
+		""" Stores the current version of an entity. """
+
+		if modified is None:
+			return
+
+		key = (current(), typeof, _id)
+		with self.lock:
+			self.map[key] = (time.time(), modified)
+			self.map.move_to_end(key)
+			while len(self.map) > self.size:
+				self.map.popitem(last=False)
+
+	def forget(self, _id, typeof=None):
+		""" Drops the stored versions of an entity. """
+
+		with self.lock:
+			self.map.pop((current(), typeof, _id), None)
+			self.map.pop((current(), None, _id), None)
+
+	def flush(self):
+		""" Drops every stored version. """
+
+		with self.lock:
+			self.map.clear()
+
+	def written(self, _id, typeof, stamp):
+		""" Records a write to an entity. """
+
+		modified = self.modified({"dateModified": stamp})
+		self.remember(_id, typeof, modified)
+		self.remember(_id, None, modified)
+
+	def lookup(self, _id, typeof=None):
+		""" Gets the stored version of an entity if still fresh. """
+
+		key = (current(), typeof, _id)
+		with self.lock:
+			if key not in self.map:
+				return None
+			stored, modified = self.map[key]
+			if time.time() - stored > self.ttl:
+				del self.map[key]
+				return None
+
+		return modified
+
+	def tags(self, header):
+		""" Splits an If-Match or If-None-Match header. """
+
+		return [tag.strip().replace("W/", "", 1) for tag in header.split(",")]
+
+	def notModified(self, conditions, etag, modified):
+		""" Checks If-None-Match/If-Modified-Since against a version. """
+
+		if not conditions:
+			return False
+
+		if conditions.get("If-None-Match") is not None:
+			if etag is None:
+				return False
+			tags = self.tags(conditions["If-None-Match"])
+			return "*" in tags or etag.replace("W/", "", 1) in tags
+
+		if conditions.get("If-Modified-Since") is not None and modified is not None:
+			try:
+				since = parsedate_to_datetime(conditions["If-Modified-Since"])
+				lastModified = parsedate_to_datetime(self.httpDate(modified))
+			except (TypeError, ValueError):
+				return False
+			return lastModified <= since
+
+		return False
+
+	def preconditionFailed(self, conditions, etag):
+		""" Checks If-Match against the current version of an entity. """
+
+		if not conditions or conditions.get("If-Match") is None:
+			return False
+
+		tags = self.tags(conditions["If-Match"])
+		if "*" in tags:
+			return False
+
+		return etag is None or self.version(etag) not in [self.version(tag) for tag in tags]
+
+	def pinned(self, conditions):
+		""" Checks if a write must only apply to the version it was
+		checked against, which is the case for If-Match with ETags. """
+
+		if not conditions or conditions.get("If-Match") is None:
+			return False
+
+		return "*" not in self.tags(conditions["If-Match"])
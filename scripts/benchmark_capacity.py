@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+""" HIASCDI Capacity Benchmark.
+
+Measures how HIASCDI scales with the number of stored entities.
+Synthetic hospital entities, with varying attribute counts,
+categories and positions clustered around hospital sites, are
+loaded into a dedicated tenant at each scale point, then entity
+list queries are timed through the broker and the data and index
+sizes per entity read from MongoDB.
+
+Entities are written straight to the tenant database with the
+configured partitions and indexes, and counted in the type catalogue
+as the import endpoint does, so loading millions of entities does not
+go through the API. The tenant database is dropped before the first
+scale point, refusing to drop one that holds entities unless --force
+is set, and after the last one unless --keep is set. Results are
+written to a JSON report, --compare prints the change in query times
+against an earlier report.
+
+Usage:
+	python3 scripts/benchmark_capacity.py --url URL --user USER --password PASS --database DB
+		[--uri URI] [--service capacity] [--scales 10000,100000,1000000,10000000]
+		[--report capacity.json] [--compare previous.json] [--keep] [--force]
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "..", "..")))
+
+from components.hiascdi.modules.catalogue import catalogue
+from components.hiascdi.modules.storage import storage
+
+# Hospital sites entities are positioned around, as longitude and latitude
+SITES = [(-3.7038, 40.4168), (2.1734, 41.3851), (-0.3763, 39.4699),
+	(-5.9845, 37.3891), (-8.5448, 42.8782)]
+
+# Entity types with their share of the entities and categories
+TYPES = [
+	("Device", 0.6, ["Sensor", "Camera", "Robotics", "Wearable", "Monitor"]),
+	("Patient", 0.25, ["Inpatient", "Outpatient", "ICU", "Emergency"]),
+	("Staff", 0.1, ["Doctor", "Nurse", "Technician", "Administration"]),
+	("Zone", 0.05, ["Ward", "Theatre", "Laboratory", "Reception"])
+]
+
+EPOCH = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+def stamp(moment):
+	""" Builds an NGSI DateTime attribute. """
+
+	return {"type": "DateTime",
+		"value": moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")}
+
+
+def identifier(i):
+	""" Builds the id of the i-th synthetic entity. """
+
+	return "%08x-0000-4000-8000-%012x" % (i >> 48, i)
+
+
+def entity(generator, i, extra):
+	""" Builds a synthetic hospital entity.
+
+	Every entity has a category, a name, a status and a position
+	within a few kilometres of a hospital site, plus on average extra
+	attributes of its own, so documents vary in size like real ones.
+	"""
+
+	typeof, _, categories = generator.choices(TYPES, [share for _, share, _ in TYPES])[0]
+	longitude, latitude = generator.choice(SITES)
+	created = EPOCH + timedelta(seconds=generator.randrange(365 * 86400))
+
+	data = {
+		"id": identifier(i),
+		"type": typeof,
+		"category": {"type": "StructuredValue", "value": [generator.choice(categories)]},
+		"name": {"type": "Text", "value": typeof + " " + str(i)},
+		"networkStatus": {"type": "Text",
+			"value": "OFFLINE" if generator.random() < 0.1 else "ONLINE"},
+		"batteryLevel": {"type": "Number", "value": round(generator.random() * 100, 2)},
+		"location": {"type": "geo:json", "value": {"type": "Point", "coordinates": [
+			round(longitude + generator.gauss(0, 0.05), 6),
+			round(latitude + generator.gauss(0, 0.05), 6)]}},
+		"servicePath": "/",
+		"dateCreated": stamp(created),
+		"dateModified": stamp(created + timedelta(seconds=generator.randrange(86400 * 30)))
+	}
+
+	for attribute in range(generator.randint(0, 2 * extra)):
+		if attribute % 2:
+			data["reading" + str(attribute)] = {"type": "Number",
+				"value": round(generator.random() * 1000, 3),
+				"metadata": {"unitCode": {"type": "Text", "value": "CEL"}}}
+		else:
+			data["property" + str(attribute)] = {"type": "Text",
+				"value": "%x" % generator.getrandbits(64)}
+
+	return data
+
+
+def load(args, entities, typeCatalogue, loaded, generator, start, end):
+	""" Inserts the entities from start to end, returns the seconds taken.
+
+	The type catalogue is updated per batch as the import endpoint does,
+	loaded counts the entities of each type.
+	"""
+
+	began = time.perf_counter()
+
+	with ThreadPoolExecutor(max_workers=args.workers) as pool:
+		pending = []
+		for first in range(start, end, args.batch):
+			batches = {}
+			for i in range(first, min(first + args.batch, end)):
+				data = entity(generator, i, args.attributes)
+				batches.setdefault(entities.name(data["type"]), []).append(data)
+				loaded[data["type"]] = loaded.get(data["type"], 0) + 1
+			for name, batch in batches.items():
+				typeCatalogue.entitiesCreated(batch)
+				pending.append(pool.submit(entities.mongodb.mongoConn[name].insert_many,
+					batch, ordered=False))
+			# Keeps a bounded number of batches in flight
+			while len(pending) > args.workers * 2:
+				pending.pop(0).result()
+		for future in pending:
+			future.result()
+
+	return time.perf_counter() - began
+
+
+def queries(scale, probe):
+	""" Gets the timed entity list queries at a scale point. """
+
+	longitude, latitude = SITES[0]
+
+	return {
+		"id": {"id": probe},
+		"filter": {"type": "Device", "q": "networkStatus.value==OFFLINE;batteryLevel.value<20",
+			"limit": "100"},
+		"category": {"type": "Device", "q": "category.value==Camera", "limit": "100"},
+		"geo": {"georel": "near;maxDistance:2000", "geometry": "point",
+			"coords": "%s,%s" % (longitude, latitude), "limit": "100"},
+		"sortModified": {"type": "Device", "orderBy": "!dateModified.value", "limit": "100"},
+		"sortAttribute": {"type": "Device", "orderBy": "batteryLevel.value", "limit": "100"},
+		"page": {"type": "Device", "limit": "100"},
+		"deepPage": {"type": "Device", "offset": str(scale // 2), "limit": "100"},
+		"count": {"type": "Device", "options": "count", "limit": "1"},
+		"countFiltered": {"type": "Device", "q": "networkStatus.value==OFFLINE",
+			"options": "count", "limit": "1"}
+	}
+
+
+def counted(args, auth, expected, wait):
+	""" Waits until the broker counts the loaded Device entities.
+
+	The broker caches type counts for counts.typeRefresh seconds, so
+	counts from the previous scale point may be served until then.
+	Returns the last count reported.
+	"""
+
+	headers = {"Content-Type": "application/json", "Accept": "application/json",
+		"Cache-Control": "no-cache", "Fiware-Service": args.service}
+
+	deadline = time.monotonic() + wait
+	while True:
+		response = requests.get(args.url.rstrip("/") + "/entities",
+			params={"type": "Device", "options": "count", "limit": "1"}, auth=auth,
+			headers=headers, verify=not args.insecure, timeout=args.timeout)
+		count = int(response.headers.get("Count", -1))
+		if count == expected or time.monotonic() > deadline:
+			return count
+		time.sleep(5)
+
+
+def percentile(times, fraction):
+	""" Gets a percentile of sorted times. """
+
+	return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def timed(args, auth, query):
+	""" Times a query through the broker, bypassing the results cache.
+
+	The first request is reported apart, it includes opening the
+	tenant and reading cold index pages.
+	"""
+
+	headers = {"Content-Type": "application/json", "Accept": "application/json",
+		"Cache-Control": "no-cache", "Fiware-Service": args.service}
+
+	times, first, status, count, size = [], None, None, None, 0
+	for turn in range(args.rounds + 1):
+		began = time.perf_counter()
+		response = requests.get(args.url.rstrip("/") + "/entities", params=query, auth=auth,
+			headers=headers, verify=not args.insecure, timeout=args.timeout)
+		elapsed = (time.perf_counter() - began) * 1000
+		status, count, size = response.status_code, response.headers.get("Count"), len(response.content)
+		if turn:
+			times.append(elapsed)
+		else:
+			first = elapsed
+
+	times.sort()
+
+	return {
+		"status": status,
+		"count": int(count) if count is not None else None,
+		"bytes": size,
+		"firstMs": round(first, 2),
+		"minMs": round(times[0], 2),
+		"p50Ms": round(percentile(times, 0.5), 2),
+		"p95Ms": round(percentile(times, 0.95), 2),
+		"maxMs": round(times[-1], 2)
+	}
+
+
+def sizes(entities):
+	""" Gets the data and index sizes of the entity collections. """
+
+	database = entities.mongodb.mongoConn
+	collections = {}
+	for name in entities.names():
+		stats = list(database[name].aggregate([{"$collStats": {"storageStats": {}}}]))
+		if not stats:
+			continue
+		stats = stats[0]["storageStats"]
+		collections[name] = {
+			"count": stats.get("count", 0),
+			"size": stats.get("size", 0),
+			"storageSize": stats.get("storageSize", 0),
+			"totalIndexSize": stats.get("totalIndexSize", 0),
+			"indexSizes": stats.get("indexSizes", {})
+		}
+
+	count = sum(stats["count"] for stats in collections.values()) or 1
+	size = sum(stats["size"] for stats in collections.values())
+	stored = sum(stats["storageSize"] for stats in collections.values())
+	indexed = sum(stats["totalIndexSize"] for stats in collections.values())
+
+	return {
+		"collections": collections,
+		"bytesPerEntity": round(size / count, 1),
+		"storedBytesPerEntity": round(stored / count, 1),
+		"indexBytesPerEntity": round(indexed / count, 1),
+		"workingSetBytes": size + indexed
+	}
+
+
+def server(client):
+	""" Gets the MongoDB version, cache and memory use, if permitted. """
+
+	status = {"version": client.server_info().get("version")}
+	try:
+		stats = client.admin.command("serverStatus")
+		cache = stats.get("wiredTiger", {}).get("cache", {})
+		status.update({
+			"residentMB": stats.get("mem", {}).get("resident"),
+			"cacheBytes": cache.get("bytes currently in the cache"),
+			"cacheMaxBytes": cache.get("maximum bytes configured")
+		})
+	except OperationFailure:
+		pass
+
+	return status
+
+
+def compare(report, previous):
+	""" Prints the change in median query times against an earlier report. """
+
+	before = {point["entities"]: point for point in previous["scales"]}
+	for point in report["scales"]:
+		earlier = before.get(point["entities"])
+		if earlier is None:
+			continue
+		for name, result in point["queries"].items():
+			old = earlier["queries"].get(name)
+			if old is None or not old["p50Ms"]:
+				continue
+			print("%10d %-14s %9.2f ms -> %9.2f ms  %+6.1f%%" % (point["entities"], name,
+				old["p50Ms"], result["p50Ms"], (result["p50Ms"] / old["p50Ms"] - 1) * 100))
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI capacity benchmark")
+	parser.add_argument("--url", required=True, help="Broker URL, e.g. https://server/hiascdi/v1")
+	parser.add_argument("--user", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--insecure", action="store_true", help="Skips TLS verification")
+	parser.add_argument("--uri", default="mongodb://localhost:27017", help="MongoDB connection string")
+	parser.add_argument("--database", required=True, help="HIASCDI database name")
+	parser.add_argument("--service", default="capacity", help="Tenant the entities are loaded into")
+	parser.add_argument("--scales", default="10000,100000,1000000,10000000")
+	parser.add_argument("--attributes", type=int, default=6, help="Average extra attributes per entity")
+	parser.add_argument("--rounds", type=int, default=20, help="Timed requests per query")
+	parser.add_argument("--batch", type=int, default=5000)
+	parser.add_argument("--workers", type=int, default=4)
+	parser.add_argument("--timeout", type=float, default=300)
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--report", default="capacity.json")
+	parser.add_argument("--compare", help="Earlier report to compare query times with")
+	parser.add_argument("--keep", action="store_true", help="Keeps the tenant database")
+	parser.add_argument("--force", action="store_true",
+		help="Drops the tenant database even if it holds entities")
+	args = parser.parse_args()
+
+	if not args.service:
+		parser.error("--service must name a dedicated tenant, the default tenant is never loaded")
+
+	confs = json.load(open(os.path.join(ROOT, "configuration", "config.json")))
+	helpers = types.SimpleNamespace(confs=confs, logger=logging.getLogger("benchmark_capacity"))
+
+	client = MongoClient(args.uri)
+	name = args.database + confs["tenants"]["separator"] + args.service
+	# Stands in for the tenants module, indexes are created here rather than registered
+	mongodb = types.SimpleNamespace(mongoConn=client[name], collextions={},
+		register=lambda setup: None)
+	entities = storage(helpers, mongodb)
+	auth = (args.user, args.password)
+	scales = sorted(int(scale) for scale in args.scales.split(","))
+	generator = random.Random(args.seed)
+
+	report = {
+		"started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+		"host": {"platform": platform.platform(), "python": platform.python_version()},
+		"settings": {"scales": scales, "attributes": args.attributes, "rounds": args.rounds,
+			"seed": args.seed, "service": args.service,
+			"storage": {name: confs["storage"][name] for name in
+				["partitions", "indexes", "collectionIndexes", "maxTimeMS"]}},
+		"scales": []
+	}
+
+	if name in client.list_database_names() and not args.force and \
+			any(collection.estimated_document_count() for collection in entities.collections()):
+		print("Database " + name + " already holds entities, use --force to drop it")
+		client.close()
+		return 1
+
+	client.drop_database(name)
+
+	# A running broker still treats the tenant as prepared after the drop
+	entities.indexes()
+	typeCatalogue = catalogue(helpers, mongodb, entities)
+	typeCatalogue.indexes()
+
+	# near queries need a geospatial index, which is added if none is configured
+	report["settings"]["addedIndexes"] = []
+	if not any(key == ["location.value", "2dsphere"] for spec in confs["storage"]["indexes"]
+			for key in spec):
+		for collection in entities.collections():
+			collection.create_index([("location.value", "2dsphere")])
+		report["settings"]["addedIndexes"].append([["location.value", "2dsphere"]])
+
+	loaded, total = {}, 0
+	failures = 0
+	try:
+		for scale in scales:
+			seconds = load(args, entities, typeCatalogue, loaded, generator, total, scale)
+			added, total = scale - total, scale
+			print("Loaded %d entities, %d in %.1f s" % (scale, added, seconds))
+
+			reported = counted(args, auth, loaded.get("Device", 0),
+				confs["counts"]["typeRefresh"] + 30)
+			if reported != loaded.get("Device", 0):
+				failures += 1
+				print("FAIL: broker counts %d Device entities, %d loaded" % (reported,
+					loaded.get("Device", 0)))
+
+			point = {
+				"entities": scale,
+				"types": dict(loaded),
+				"load": {"entities": added, "seconds": round(seconds, 2),
+					"perSecond": round(added / seconds) if seconds else None},
+				"storage": sizes(entities),
+				"queries": {}
+			}
+			for label, query in queries(scale, identifier(scale // 2)).items():
+				point["queries"][label] = timed(args, auth, query)
+				result = point["queries"][label]
+				print("%10d %-14s p50 %9.2f ms  p95 %9.2f ms  %s" % (scale, label,
+					result["p50Ms"], result["p95Ms"], result["status"]))
+			point["countMatches"] = point["queries"]["count"]["count"] == loaded.get("Device", 0)
+			point["server"] = server(client)
+			print("%10d %.0f data and %.0f index bytes per entity" % (scale,
+				point["storage"]["bytesPerEntity"], point["storage"]["indexBytesPerEntity"]))
+
+			report["scales"].append(point)
+			with open(args.report, "w") as out:
+				json.dump(report, out, indent=4)
+	finally:
+		if not args.keep:
+			client.drop_database(name)
+
+	if args.compare:
+		compare(report, json.load(open(args.compare)))
+
+	client.close()
+
+	return 1 if failures else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+""" HIASCDI Compression Benchmark.
+
+Measures the CPU time and bandwidth saved by compressing a
+pretty-printed entity listing at different gzip levels and
+brotli qualities.
+
+Usage: python3 scripts/benchmark_compression.py [entities]
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import json
+import random
+import sys
+import time
+import zlib
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+def entity(i):
+	""" Builds a synthetic HIAS device entity. """
+
+	return {
+		"id": "%08d-0000-0000-0000-000000000000" % i,
+		"type": "Device",
+		"category": {"type": "Text", "value": [random.choice(["Sensor", "Robotics", "Camera"])]},
+		"name": {"type": "Text", "value": "Device " + str(i)},
+		"batteryLevel": {"type": "Number", "value": random.random() * 100},
+		"location": {"type": "geo:json", "value": {"type": "Point",
+			"coordinates": [random.uniform(-90, 90), random.uniform(-180, 180)]}},
+		"networkStatus": {"type": "Text", "value": random.choice(["ONLINE", "OFFLINE"])},
+		"dateCreated": {"type": "DateTime", "value": "2021-06-01T00:00:00.000Z"},
+		"dateModified": {"type": "DateTime", "value": "2021-06-01T00:00:00.000Z"}
+	}
+
+
+def gzip(data, level):
+	""" Compresses data as the compression module does for gzip. """
+
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+	return compressor.compress(data) + compressor.flush()
+
+
+def measure(name, function, data, rounds=3):
+	""" Times a compression function and prints the result. """
+
+	best = None
+	for _ in range(rounds):
+		start = time.perf_counter()
+		output = function(data)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None or elapsed < best else best
+
+	print("%-12s %10d bytes %6.1f%% %9.1f ms %8.1f MB/s" % (name, len(output),
+		100.0 * len(output) / len(data), best * 1000, len(data) / best / 1e6))
+
+
+def main():
+	total = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+	random.seed(0)
+	data = json.dumps([entity(i) for i in range(total)], indent=4).encode("utf-8")
+
+	print("%d entities, %d bytes uncompressed" % (total, len(data)))
+
+	for level in [1, 6, 9]:
+		measure("gzip-" + str(level), lambda d: gzip(d, level), data)
+
+	if brotli is None:
+		print("brotli not installed, skipping")
+		return
+
+	for quality in [1, 4, 11]:
+		measure("br-" + str(quality), lambda d: brotli.compress(d, quality=quality), data)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" HIASCDI Startup Benchmark.
+
+Measures the time it takes to load hiascdi.py and the modules it
+imports in a fresh interpreter and fails when it exceeds the
+import-time budget, so that heavy imports creeping back onto the
+startup path are caught. The HIASCDI class is created by main(),
+not on import, so it is not measured.
+
+Usage: python3 scripts/benchmark_startup.py [--budget MS] [--rounds N] [--top N]
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+# The modules hiascdi.py imports before it can serve, then hiascdi.py
+# itself, listed apart so each shows in the slowest imports
+MODULES = ["flask", "bson", "pymongo", "components.hiascdi.modules.helpers",
+	"components.hiascdi.modules.accounting", "components.hiascdi.modules.admission",
+	"components.hiascdi.modules.broker", "components.hiascdi.modules.catalogue",
+	"components.hiascdi.modules.compression", "components.hiascdi.modules.entities",
+	"components.hiascdi.modules.registrations", "components.hiascdi.modules.slowlog",
+	"components.hiascdi.modules.stats", "components.hiascdi.modules.types",
+	"components.hiascdi.modules.subscriptions", "components.hiascdi.modules.tenants",
+	"components.hiascdi.modules.tracing", "components.hiascdi.hiascdi"]
+
+
+def measure():
+	""" Imports the modules in a fresh interpreter, returns the
+	cumulative import time of each top level import in microseconds. """
+
+	code = "import sys; sys.path.insert(0, %r)\n" % ROOT + \
+		"\n".join("import " + module for module in MODULES)
+
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	if result.returncode != 0:
+		raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+	imports = {}
+	for line in result.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		_, cumulative, name = line[len("import time:"):].split("|")
+		# Nested imports are indented, their time is in their parent's
+		if name.startswith("  ") or not name.strip():
+			continue
+		name = name.strip()
+		imports[name] = imports.get(name, 0) + int(cumulative)
+
+	return imports
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI startup benchmark")
+	parser.add_argument("--budget", type=float, default=1500, help="Import-time budget in ms")
+	parser.add_argument("--rounds", type=int, default=5)
+	parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+	args = parser.parse_args()
+
+	best = None
+	for _ in range(args.rounds):
+		imports = measure()
+		if best is None or sum(imports.values()) < sum(best.values()):
+			best = imports
+
+	total = sum(best.values()) / 1000.0
+
+	print("Slowest imports:")
+	for name, cumulative in sorted(best.items(), key=lambda item: -item[1])[:args.top]:
+		print("%10.1f ms  %s" % (cumulative / 1000.0, name))
+
+	print("Import time %.1f ms, budget %.1f ms (best of %d)" % (total, args.budget, args.rounds))
+
+	if total > args.budget:
+		print("FAIL: import time over budget")
+		return 1
+
+	print("OK")
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+""" HIASCDI Validation Benchmark.
+
+Measures the time the compiled type schemas add to each entity
+write, for full entities as on create and for single attribute
+updates, and compares it with the jsonschema package when it is
+installed.
+
+Usage: python3 scripts/benchmark_validation.py [entities]
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import json
+import logging
+import os
+import random
+import sys
+import time
+import types
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "..", "..")))
+
+from components.hiascdi.modules.schemas import schemas
+
+try:
+	import jsonschema
+except ImportError:
+	jsonschema = None
+
+SCHEMA = {
+	"attrs": {
+		"category": {"type": "StructuredValue", "required": True},
+		"name": {"type": "Text", "required": True, "maxLength": 100},
+		"batteryLevel": {"type": "Number", "minimum": 0, "maximum": 100},
+		"location": {"type": "geo:json"},
+		"networkStatus": {"type": "Text", "enum": ["ONLINE", "OFFLINE"]},
+		"dateCreated": {"type": "DateTime"}
+	}
+}
+
+# The same constraints as a JSON schema, for comparison
+JSONSCHEMA = {
+	"type": "object",
+	"required": ["category", "name"],
+	"properties": {
+		"category": {"type": "object", "properties": {"value": {"type": ["object", "array"]}}, "required": ["value"]},
+		"name": {"type": "object", "properties": {"value": {"type": "string", "maxLength": 100}}, "required": ["value"]},
+		"batteryLevel": {"type": "object", "properties": {"value": {"type": "number", "minimum": 0, "maximum": 100}}, "required": ["value"]},
+		"location": {"type": "object", "properties": {"value": {"type": "object", "required": ["type", "coordinates"]}}, "required": ["value"]},
+		"networkStatus": {"type": "object", "properties": {"value": {"enum": ["ONLINE", "OFFLINE"]}}, "required": ["value"]},
+		"dateCreated": {"type": "object", "properties": {"value": {"type": "string", "format": "date-time"}}, "required": ["value"]}
+	}
+}
+
+
+def entity(i):
+	""" Builds a synthetic HIAS device entity. """
+
+	return {
+		"id": "%08d-0000-0000-0000-000000000000" % i,
+		"type": "Device",
+		"category": {"type": "StructuredValue", "value": [random.choice(["Sensor", "Robotics", "Camera"])]},
+		"name": {"type": "Text", "value": "Device " + str(i)},
+		"batteryLevel": {"type": "Number", "value": random.random() * 100},
+		"location": {"type": "geo:json", "value": {"type": "Point",
+			"coordinates": [random.uniform(-90, 90), random.uniform(-180, 180)]}},
+		"networkStatus": {"type": "Text", "value": random.choice(["ONLINE", "OFFLINE"])},
+		"dateCreated": {"type": "DateTime", "value": "2021-06-01T00:00:00.000Z"},
+		"dateModified": {"type": "DateTime", "value": "2021-06-01T00:00:00.000Z"}
+	}
+
+
+def measure(name, function, items, rounds=5):
+	""" Times a validation function over the items and prints the
+	best time per item. """
+
+	best = None
+	for _ in range(rounds):
+		start = time.perf_counter()
+		for item in items:
+			function(item)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None or elapsed < best else best
+
+	print("%-36s %8.2f us per write" % (name, best * 1e6 / len(items)))
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+	confs = json.load(open(os.path.join(ROOT, "configuration", "config.json")))
+	helpers = types.SimpleNamespace(confs=confs, logger=logging.getLogger("benchmark_validation"))
+	validation = schemas(helpers, None)
+
+	entities = [entity(i) for i in range(count)]
+	updates = [{"batteryLevel": {"type": "Number", "value": random.random() * 100}}
+					for i in range(count)]
+
+	start = time.perf_counter()
+	validate = validation.compile(SCHEMA)
+	print("%-36s %8.2f us" % ("Schema compilation", (time.perf_counter() - start) * 1e6))
+
+	measure("Body parsing (json.loads)", json.loads, [json.dumps(item) for item in entities])
+	measure("Compiled schema, entity", validate, entities)
+	measure("Compiled schema, attribute update", lambda item: validate(item, True), updates)
+
+	if jsonschema is not None:
+		validator = jsonschema.Draft7Validator(JSONSCHEMA)
+		measure("jsonschema, entity", validator.is_valid, entities)
+		measure("jsonschema, attribute update", validator.is_valid, updates)
+	else:
+		print("jsonschema is not installed, skipping the comparison")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" HIASCDI Bulk Import/Export.
+
+Streams newline delimited JSON entities to and from a HIASCDI
+broker. Files are uploaded and downloaded in chunks, so imports
+and exports of any size run in constant memory.
+
+Usage:
+	python3 scripts/bulk.py import entities.ndjson --url URL --user USER --password PASS
+	python3 scripts/bulk.py export entities.ndjson --url URL --user USER --password PASS [--type TYPE] [--q Q]
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import sys
+
+import requests
+
+FILTERS = ["type", "typePattern", "id", "idPattern", "q", "mq", "attrs",
+	"georel", "geometry", "coords", "orderBy", "offset", "limit"]
+
+
+def imports(args, auth):
+	""" Uploads an NDJSON file to the import endpoint. """
+
+	with open(args.file, "rb") as data:
+		response = requests.post(args.url.rstrip("/") + "/op/import", data=data, auth=auth,
+			headers={"Content-Type": "application/x-ndjson", "Accept": "application/json"},
+			verify=not args.insecure)
+
+	if response.status_code != 200:
+		print("Import failed: " + str(response.status_code) + " " + response.text)
+		return 1
+
+	report = response.json()
+	print("%d entities imported, %d failed" % (report["inserted"], report["failed"]))
+	for error in report["errors"]:
+		print("Line %d: %s" % (error["line"], error["error"]))
+
+	return 0 if report["failed"] == 0 else 2
+
+
+def exports(args, auth):
+	""" Downloads the entities matching the filters to an NDJSON file. """
+
+	params = {name: getattr(args, name) for name in FILTERS
+		if getattr(args, name) is not None}
+
+	with requests.get(args.url.rstrip("/") + "/op/export", params=params, auth=auth,
+			headers={"Content-Type": "application/json", "Accept": "application/x-ndjson"},
+			verify=not args.insecure, stream=True) as response:
+		if response.status_code != 200:
+			print("Export failed: " + str(response.status_code) + " " + response.text)
+			return 1
+
+		out = sys.stdout.buffer if args.file == "-" else open(args.file, "wb")
+		try:
+			for chunk in response.iter_content(chunk_size=65536):
+				out.write(chunk)
+		finally:
+			if out is not sys.stdout.buffer:
+				out.close()
+
+	return 0
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI bulk import/export")
+	parser.add_argument("command", choices=["import", "export"])
+	parser.add_argument("file", help="NDJSON file, - for stdout when exporting")
+	parser.add_argument("--url", required=True, help="Broker URL, e.g. https://server/hiascdi/v1")
+	parser.add_argument("--user", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--insecure", action="store_true", help="Skips TLS verification")
+	for name in FILTERS:
+		parser.add_argument("--" + name)
+	args = parser.parse_args()
+
+	auth = (args.user, args.password)
+	if args.command == "import":
+		return imports(args, auth)
+	return exports(args, auth)
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+""" HIASCDI Results Cache Check.
+
+Checks that entity lists served from the HIASCDI results cache are
+byte for byte identical to the uncached responses. Every query is
+sent as is, twice, and with its filters reordered, which are served
+from the cache, then with Cache-Control: no-cache, which bypasses
+the cache, and the responses are compared.
+
+With --touch the attributes of the given entity are updated between
+rounds and a list of that entity is added to the queries. The cached
+lists are requested first after each update, so they only match the
+uncached ones if the update invalidated them.
+
+Usage:
+	python3 scripts/check_results.py --url URL --user USER --password PASS --query "type=Device&limit=20"
+	python3 scripts/check_results.py --url URL --user USER --password PASS --type Device --touch ENTITY
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import sys
+
+from urllib.parse import parse_qsl
+
+import requests
+
+HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
+
+
+def queries(args):
+	""" Gets the queries to check, the given ones or a set on a type. """
+
+	if args.query:
+		return [dict(parse_qsl(query)) for query in args.query]
+
+	base = {"type": args.type} if args.type else {}
+
+	lists = [
+		dict(base),
+		dict(base, limit="10", offset="5"),
+		dict(base, options="keyValues", orderBy="!dateModified"),
+		dict(base, options="count", limit="1"),
+		dict(base, attrs="dateModified,dateCreated"),
+	]
+
+	if args.touch:
+		lists.append({"id": args.touch, "attrs": "resultsCacheCheck"})
+
+	return lists
+
+
+def reordered(query):
+	""" Reorders the parameters and list items of a query. """
+
+	reorder = {"type": ",", "id": ",", "attrs": ",", "options": ",", "q": ";", "mq": ";"}
+
+	query = {name: reorder[name].join(reversed(value.split(reorder[name])))
+				if name in reorder else value for name, value in query.items()}
+
+	return dict(reversed(list(query.items())))
+
+
+def get(args, auth, query, cached):
+	""" Gets an entity list, bypassing the cache unless cached is set. """
+
+	headers = dict(HEADERS)
+	if not cached:
+		headers["Cache-Control"] = "no-cache"
+
+	response = requests.get(args.url.rstrip("/") + "/entities", params=query, auth=auth,
+		headers=headers, verify=not args.insecure)
+
+	return response.status_code, response.headers.get("Count"), response.content
+
+
+def touch(args, auth, turn):
+	""" Updates the check attribute of the touched entity. """
+
+	response = requests.post(args.url.rstrip("/") + "/entities/" + args.touch + "/attrs",
+		json={"resultsCacheCheck": {"type": "Number", "value": turn}}, auth=auth,
+		headers=HEADERS, verify=not args.insecure)
+
+	if response.status_code != 204:
+		print("Touch failed: " + str(response.status_code) + " " + response.text)
+		return False
+
+	return True
+
+
+def check(args, auth):
+	""" Compares the cached and uncached responses of every query.
+
+	The cached variants are requested before the uncached one, which
+	also stores its response, so that after an update they are served
+	from whatever the update left in the cache.
+	"""
+
+	failures = 0
+	rounds = 3 if args.touch else 1
+
+	for turn in range(rounds):
+		if turn and not touch(args, auth, turn):
+			return 1
+		for query in queries(args):
+			cached = [(variant, get(args, auth, variant, True))
+						for variant in [query, query, reordered(query)]]
+			expected = get(args, auth, query, False)
+			for variant, actual in cached:
+				if actual != expected:
+					failures += 1
+					print("MISMATCH %s: %s %s bytes uncached, %s %s bytes cached" % (
+						variant, expected[0], len(expected[2]), actual[0], len(actual[2])))
+			print("Round %d %s: %d bytes" % (turn + 1, query, len(expected[2])))
+
+	print("%d mismatches" % failures)
+
+	return 1 if failures else 0
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI results cache check")
+	parser.add_argument("--url", required=True, help="Broker URL, e.g. https://server/hiascdi/v1")
+	parser.add_argument("--user", required=True)
+	parser.add_argument("--password", required=True)
+	parser.add_argument("--insecure", action="store_true", help="Skips TLS verification")
+	parser.add_argument("--type", help="Entity type the default queries select")
+	parser.add_argument("--query", action="append", help="List query string, may be repeated")
+	parser.add_argument("--touch", help="Entity to update between rounds")
+	args = parser.parse_args()
+
+	return check(args, (args.user, args.password))
+
+
+if __name__ == "__main__":
+	sys.exit(main())
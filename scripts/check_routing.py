@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+""" HIASCDI Read Routing Check.
+
+Checks the read routing of HIASCDI against a MongoDB replica set.
+Records which member serves each read and verifies that list reads
+go to the secondaries while entities written by this worker are
+read back from the primary.
+
+With --start a throwaway three member replica set is started on
+local ports with mongod, otherwise --uri must point at a replica set.
+
+Usage:
+	python3 scripts/check_routing.py --start
+	python3 scripts/check_routing.py --uri "mongodb://h1,h2,h3/?replicaSet=rs0"
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+from pymongo import MongoClient, monitoring
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "..", "..")))
+
+from components.hiascdi.modules.routing import routing
+from components.hiascdi.modules.storage import storage
+from components.hiascdi.modules.tenants import tenants
+
+
+class reads(monitoring.CommandListener):
+	""" Records the member that served each read. """
+
+	def __init__(self):
+		self.served = []
+
+	def started(self, event):
+		if event.command_name in ["find", "count", "aggregate"]:
+			self.served.append((event.command_name, event.connection_id))
+
+	def succeeded(self, event):
+		pass
+
+	def failed(self, event):
+		pass
+
+
+def start(ports):
+	""" Starts a local replica set, returns its URI and processes. """
+
+	base = tempfile.mkdtemp(prefix="hiascdi-rs-")
+	processes = []
+	for port in ports:
+		path = os.path.join(base, str(port))
+		os.makedirs(path)
+		processes.append(subprocess.Popen(["mongod", "--replSet", "rs0", "--port", str(port),
+			"--dbpath", path, "--bind_ip", "127.0.0.1"],
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+	time.sleep(2)
+	admin = MongoClient("127.0.0.1", ports[0], directConnection=True).admin
+	admin.command("replSetInitiate", {"_id": "rs0", "members": [
+		{"_id": i, "host": "127.0.0.1:" + str(port), "priority": 2 if i == 0 else 1}
+			for i, port in enumerate(ports)]})
+
+	uri = "mongodb://" + ",".join("127.0.0.1:" + str(port) for port in ports) + "/?replicaSet=rs0"
+	client = MongoClient(uri)
+	while client.primary is None or len(client.secondaries) < len(ports) - 1:
+		time.sleep(0.5)
+	client.close()
+
+	return uri, processes, base
+
+
+def check(uri):
+	""" Runs the routing checks, returns the number of failures. """
+
+	listener = reads()
+	client = MongoClient(uri, event_listeners=[listener])
+	while client.primary is None or not client.secondaries:
+		time.sleep(0.5)
+
+	confs = json.load(open(os.path.join(ROOT, "configuration", "config.json")))
+	helpers = types.SimpleNamespace(confs=confs, logger=logging.getLogger("check_routing"))
+
+	database = client["hiascdi_routing_check"]
+	mongodb = tenants(helpers, types.SimpleNamespace(mongoConn=database, collextions={}))
+	router = routing(helpers)
+	entities = storage(helpers, mongodb)
+
+	failures = 0
+
+	def served(label, expected, run):
+		nonlocal failures
+		listener.served.clear()
+		run()
+		members = set(address for _, address in listener.served)
+		ok = bool(members) and all((address == client.primary) == (expected == "primary")
+								for address in members)
+		failures += 0 if ok else 1
+		print(("PASS " if ok else "FAIL ") + label + ": " + ", ".join(
+			"%s:%d" % address for address in members) + " (expected " + expected + ")")
+
+	entities.collection("Check").insert_one({"id": "written", "type": "Check"})
+	entities.collection("Check").insert_one({"id": "other", "type": "Check"})
+	router.written("written")
+
+	served("list read", "secondary", lambda: list(entities.find(["Check"], {}, {"_id": False},
+										read=router.list())))
+	served("entity read after write", "primary", lambda: entities.lookup({"id": "written"},
+										"Check", {"_id": False}, router.entity("written")))
+	served("entity read", "secondary", lambda: entities.lookup({"id": "other"},
+										"Check", {"_id": False}, router.entity("other")))
+
+	client.drop_database("hiascdi_routing_check")
+	client.close()
+
+	return failures
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI read routing check")
+	parser.add_argument("--uri", help="Replica set connection string")
+	parser.add_argument("--start", action="store_true", help="Starts a local replica set with mongod")
+	parser.add_argument("--ports", default="27117,27118,27119")
+	args = parser.parse_args()
+
+	if not args.start and not args.uri:
+		parser.error("one of --uri or --start is required")
+
+	processes, base = [], None
+	uri = args.uri
+	try:
+		if args.start:
+			uri, processes, base = start([int(port) for port in args.ports.split(",")])
+		failures = check(uri)
+	finally:
+		for process in processes:
+			process.terminate()
+			process.wait()
+		if base is not None:
+			shutil.rmtree(base, ignore_errors=True)
+
+	return 1 if failures else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+""" HIASCDI Load Shedding Check.
+
+Checks that the background MongoDB commands of HIASCDI do not make
+the admission module shed requests. Starts the invalidation watcher
+on a change stream, whose getMores each wait about a second for new
+events, leaves it running on an idle broker and verifies that reads
+are still admitted and that the commands of a request are timed.
+
+With --start a throwaway three member replica set is started on
+local ports with mongod, otherwise --uri must point at a replica set.
+
+Usage:
+	python3 scripts/check_shedding.py --start
+	python3 scripts/check_shedding.py --uri "mongodb://h1,h2,h3/?replicaSet=rs0"
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import types
+
+from pymongo import MongoClient
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.abspath(os.path.join(ROOT, "..", "..")))
+
+from check_routing import start
+
+from components.hiascdi.modules.admission import admission
+from components.hiascdi.modules.invalidation import invalidation
+from components.hiascdi.modules.tenants import tenants
+
+
+def check(uri, seconds):
+	""" Runs the shedding checks, returns the number of failures. """
+
+	confs = json.load(open(os.path.join(ROOT, "configuration", "config.json")))
+	confs["admission"]["enabled"] = True
+	confs["invalidation"]["transport"] = "changeStream"
+	confs["invalidation"]["heartbeat"] = 1
+	helpers = types.SimpleNamespace(confs=confs, logger=logging.getLogger("check_shedding"))
+
+	# The latency listener must be registered before the client is created
+	gate = admission(helpers)
+
+	client = MongoClient(uri)
+	while client.primary is None:
+		time.sleep(0.5)
+
+	database = client["hiascdi_shedding_check"]
+	mongodb = tenants(helpers, types.SimpleNamespace(mongoConn=database, collextions={}))
+	bus = invalidation(helpers, mongodb, None, None)
+
+	failures = 0
+
+	def verify(label, ok, detail):
+		nonlocal failures
+		failures += 0 if ok else 1
+		print(("PASS " if ok else "FAIL ") + label + ": " + detail)
+
+	verify("transport", bus.transport == "changeStream", bus.transport)
+
+	for _ in range(seconds):
+		bus.entity("check")
+		time.sleep(1)
+
+	read = types.SimpleNamespace(method="GET", remote_addr="127.0.0.1", headers={})
+	latency = gate.getCounters()["mongoLatency"]
+	verify("idle latency", latency <= confs["admission"]["maxLatency"], "%.3f ms" % latency)
+
+	rejected = gate.admit(read)
+	verify("idle read admitted", rejected is None, str(rejected))
+	if rejected is None:
+		observed = gate.observed
+		database.Check.find_one({"id": "check"})
+		verify("request command timed", gate.observed != observed, "%.3f ms" % (
+			gate.getCounters()["mongoLatency"]))
+		gate.release()
+
+	print("Invalidation: " + json.dumps(bus.getCounters(), default=str))
+	print("Admission: " + json.dumps(gate.getCounters()))
+
+	client.drop_database("hiascdi_shedding_check")
+	client.close()
+
+	return failures
+
+
+def main():
+	parser = argparse.ArgumentParser(description="HIASCDI load shedding check")
+	parser.add_argument("--uri", help="Replica set connection string")
+	parser.add_argument("--start", action="store_true", help="Starts a local replica set with mongod")
+	parser.add_argument("--ports", default="27117,27118,27119")
+	parser.add_argument("--seconds", type=int, default=10, help="Seconds the watcher runs idle")
+	args = parser.parse_args()
+
+	if not args.start and not args.uri:
+		parser.error("one of --uri or --start is required")
+
+	processes, base = [], None
+	uri = args.uri
+	try:
+		if args.start:
+			uri, processes, base = start([int(port) for port in args.ports.split(",")])
+		failures = check(uri, args.seconds)
+	finally:
+		for process in processes:
+			process.terminate()
+			process.wait()
+		if base is not None:
+			shutil.rmtree(base, ignore_errors=True)
+
+	return 1 if failures else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())